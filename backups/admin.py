@@ -1,65 +1,104 @@
 from django.contrib import admin
+from django.urls import reverse
 from django.utils.html import format_html
+from django.views.decorators.csrf import csrf_exempt
 
-from backups.db_connectors import get_db_connector
-from backups.media_manager import compress_media_file, restore_media_file
-from backups.models import Backup, Restore
+from backups import jobs
+from backups.models import Backup, Restore, Schedule
+from backups.scheduler import get_next_run
+from backups.uploads import BackupUploadHandler
 from django.conf import settings
 
 
+class JobStatsMixin:
+    @admin.display(description='Duration')
+    def duration(self, obj):
+        return obj.get_duration() or '-'
+
+    @admin.display(description='Throughput')
+    def throughput(self, obj):
+        stage = obj.get_main_stage()
+        rates = []
+        for name, unit in (('rows', 'rows'), ('statements', 'statements'), ('files', 'files')):
+            if stage.get(f'{name}_per_second'):
+                rates.append(f"{stage[f'{name}_per_second']} {unit}/s")
+        if stage.get('bytes_per_second'):
+            rates.append(f"{stage['bytes_per_second'] / 1024 / 1024:.1f} MB/s")
+        return ', '.join(rates) or '-'
+
+
 @admin.register(Backup)
-class BackupBackupAdmin(admin.ModelAdmin):
-    list_display = ['type', 'file_link', 'created_at', 'created_by']
-    list_filter = ['created_at']
-    readonly_fields = ['file', 'created_at', 'created_by']
+class BackupBackupAdmin(JobStatsMixin, admin.ModelAdmin):
+    list_display = ['type', 'kind', 'status', 'file_link', 'parent', 'size', 'verified', 'created_at', 'created_by',
+                    'duration', 'throughput']
+    list_filter = ['created_at', 'kind', 'status']
+    readonly_fields = ['file', 'parent', 'size', 'checksum', 'verified_at', 'verify_error', 'status', 'error',
+                       'created_at', 'created_by', 'started_at', 'finished_at', 'stats']
+
+    @admin.display(description='Verified', boolean=True)
+    def verified(self, obj):
+        if obj.verified_at is None:
+            return None
+        return not obj.verify_error
 
     def file_link(self, obj):
         if obj.file:
-            return format_html("<a href='%s'>download backup</a>" % (obj.file.url,))
+            return format_html("<a href='{}'>download backup</a>", reverse('backups:download', args=[obj.pk]))
         else:
             return "No attachment"
 
     def save_model(self, request, obj, form, change):
-        if obj.type == 'database':
-            connector = get_db_connector()
-            #  Create the backup file
-            backup_file_path = connector.create_backup()
-            
-            # Associate the backup with the saved model instance
-            obj.file.name = backup_file_path
-        else:
-            
-            backup_file_path = compress_media_file()
-            
-            obj.file.name= backup_file_path
-
+        # The dump runs in the background, the request only queues it
         obj.created_by = request.user
+        obj.status = 'queued'
         obj.save()
+        jobs.enqueue(obj)
 
     def has_change_permission(self, request, obj=None):
         return False
 
 
 @admin.register(Restore)
-class RestoreBackupAdmin(admin.ModelAdmin):
-    list_display = ['type', 'restored_at', 'restored_by']
-    list_filter = ['restored_at']
-    readonly_fields = ['restored_at', 'restored_by']
+class RestoreBackupAdmin(JobStatsMixin, admin.ModelAdmin):
+    list_display = ['type', 'status', 'backup', 'restored_at', 'restored_by', 'duration', 'throughput']
+    list_filter = ['restored_at', 'status']
+    readonly_fields = ['status', 'error', 'restored_at', 'restored_by', 'started_at', 'finished_at', 'stats']
 
-    def save_model(self, request, obj, form, change):
-        # Associate the backup with the saved model instance
-        obj.restored_by = request.user
-        
-        if obj.type == 'database':
-            connector = get_db_connector()
+    @csrf_exempt
+    def add_view(self, request, form_url='', extra_context=None):
+        # Upload handlers must be set before anything reads the body, the CSRF check of changeform_view still runs
+        request.upload_handlers = [BackupUploadHandler(request)]
+        return super().add_view(request, form_url, extra_context)
 
-            # Restore the backup file
-            connector.restore_backup(obj.file)
-        else:
-            connector= restore_media_file()
-            obj.file = connector
-        obj.save()    
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        # Only finished backups can be restored, of the restore's type when it is passed in the URL (?type=media)
+        if db_field.name == 'backup':
+            backups = Backup.objects.filter(status='done')
+            if request.GET.get('type'):
+                backups = backups.filter(type=request.GET['type'])
+            kwargs['queryset'] = backups
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
+    def save_model(self, request, obj, form, change):
+        # Associate the backup with the saved model instance, the restore itself runs in the background
+        obj.restored_by = request.user
+        obj.status = 'queued'
+        obj.save()
+        jobs.enqueue(obj)
 
     def has_change_permission(self, request, obj=None):
         return False
+
+
+@admin.register(Schedule)
+class ScheduleAdmin(admin.ModelAdmin):
+    list_display = ['name', 'type', 'kind', 'cron', 'jitter', 'enabled', 'last_run_at', 'next_run_at']
+    list_filter = ['type', 'enabled']
+    readonly_fields = ['last_run_at', 'next_run_at', 'created_by']
+
+    def save_model(self, request, obj, form, change):
+        # Backups queued by the schedule are created by whoever saved it
+        if not change:
+            obj.created_by = request.user
+        obj.next_run_at = get_next_run(obj)
+        obj.save()
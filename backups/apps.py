@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class BackupsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "backups"
+
+    def ready(self):
+        from django.core.signals import request_started
+
+        from backups import jobs
+
+        request_started.connect(jobs.start_queued_jobs, dispatch_uid='backups-start-queued-jobs')
@@ -0,0 +1,121 @@
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from django.conf import settings
+
+# Magic bytes each codec starts its output with, used to detect it on restore
+CODEC_MAGIC = {
+    'gzip': b'\x1f\x8b',
+    'zstd': b'\x28\xb5\x2f\xfd',
+}
+CODEC_EXTENSIONS = {
+    'none': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+DEFAULT_LEVELS = {
+    'gzip': 6,
+    'zstd': 3,
+}
+
+
+def get_codec():
+    return check_codec(getattr(settings, 'BACKUP_COMPRESSION', 'gzip') or 'none')
+
+
+def check_codec(codec):
+    # Raises unless codec is known and the package it needs is installed
+    if codec not in CODEC_EXTENSIONS:
+        raise Exception(f"Compression codec '{codec}' is not supported for backup.")
+    if codec == 'zstd' and zstandard is None:
+        raise Exception("The 'zstandard' package is required for zstd compressed backups.")
+    return codec
+
+
+def get_level(codec):
+    level = getattr(settings, 'BACKUP_COMPRESSION_LEVEL', None)
+    return DEFAULT_LEVELS.get(codec) if level is None else level
+
+
+class CompressedWriter:
+    # A codec's writer over file_obj, closing it finishes the compressed stream and then closes file_obj
+    def __init__(self, writer, file_obj):
+        self.writer = writer
+        self.file_obj = file_obj
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        try:
+            self.writer.close()
+        finally:
+            self.file_obj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_writer(path, codec=None, level=None):
+    # Binary file object that compresses everything written to it into path,
+    # path can also be a writable file object, closed along with the writer
+    codec = codec or get_codec()
+    level = get_level(codec) if level is None else level
+    file_obj = path if hasattr(path, 'write') else open(path, 'wb')
+    if codec == 'gzip':
+        return CompressedWriter(gzip.GzipFile(fileobj=file_obj, mode='wb', compresslevel=level), file_obj)
+    if codec == 'zstd':
+        return CompressedWriter(zstandard.ZstdCompressor(level=level).stream_writer(file_obj, closefd=False), file_obj)
+    return file_obj
+
+
+def iter_compressed(file_obj, codec, level=None, chunk_size=1024 * 1024):
+    # Yield file_obj compressed with codec chunk by chunk, for responses compressed on the fly
+    level = get_level(codec) if level is None else level
+    if codec == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif codec == 'zstd' and zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    else:
+        raise Exception(f"Compression codec '{codec}' is not supported for downloads.")
+    while True:
+        data = file_obj.read(chunk_size)
+        if not data:
+            break
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def detect_codec(file_obj):
+    position = file_obj.tell()
+    magic = file_obj.read(4)
+    file_obj.seek(position)
+    for codec, codec_magic in CODEC_MAGIC.items():
+        if magic.startswith(codec_magic):
+            return codec
+    return 'none'
+
+
+def open_reader(file_obj):
+    # Wrap a binary file object so reads return decompressed data whatever codec wrote it
+    codec = detect_codec(file_obj)
+    if codec == 'gzip':
+        return gzip.GzipFile(fileobj=file_obj, mode='rb')
+    if codec == 'zstd':
+        if zstandard is None:
+            raise Exception("The 'zstandard' package is required to restore zstd compressed backups.")
+        return zstandard.ZstdDecompressor().stream_reader(file_obj)
+    return file_obj
@@ -1,39 +1,247 @@
+import hashlib
+import io
+import json
+import os
+import shlex
+import shutil
+import sqlite3
 import subprocess
+import tarfile
+import tempfile
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from graphlib import CycleError, TopologicalSorter
+from itertools import chain
+from pathlib import Path
 
+from django.apps import apps
 from django.conf import settings
+from django.core.management.color import no_style
 from django.db import connections, DEFAULT_DB_ALIAS, OperationalError, IntegrityError, transaction
 from django.utils.timezone import now
 import re
 
+from backups.compression import CODEC_EXTENSIONS, get_codec, get_level, open_reader, open_writer
+from backups.file_io import copy_fileobj
+from backups.instrumentation import MeteredFile, Stats
+from backups.portable import (PORTABLE_EXTENSION, PORTABLE_VERSION, CopyRowsFile, get_table_columns,
+                              is_portable_backup, iter_lines, iter_load_rows, iter_table_rows)
+from backups.sql_parser import (COPY_END_MARKER, DEFAULT_CHUNK_SIZE, CopyStatement, SpooledCopyData,
+                                iter_statements)
+from backups.storage import MirroredFile, file_checksum, mirror_file
+
 DUMP_TABLES = """
 SELECT "name", "type", "sql"
-FROM "sqlite_master"
+FROM "{schema}"."sqlite_master"
 WHERE "sql" NOT NULL AND "type" == 'table'
 ORDER BY "name"
 """
 
+# Row count and the sum of a 64 bit hash of every row. The sum doesn't depend on
+# the order rows are read in and needs no memory or sort for large tables.
+PG_TABLE_FINGERPRINT = """
+SELECT count(*), coalesce(sum(('x' || left(md5("t"::text), 16))::bit(64)::bigint::numeric), 0)
+FROM {table} AS "t"
+"""
+
+PG_FOREIGN_KEYS = """
+SELECT "src"."relname", "dst"."relname"
+FROM "pg_constraint"
+JOIN "pg_class" AS "src" ON "src"."oid" = "pg_constraint"."conrelid"
+JOIN "pg_class" AS "dst" ON "dst"."oid" = "pg_constraint"."confrelid"
+JOIN "pg_namespace" ON "pg_namespace"."oid" = "src"."relnamespace"
+WHERE "pg_constraint"."contype" = 'f' AND "pg_namespace"."nspname" = current_schema()
+"""
+
+PG_TABLES = """
+SELECT "tablename" FROM "pg_tables" WHERE "schemaname" = current_schema()
+"""
+
+# Primary key, unique and exclusion constraints of a table, they are added to its shadow table once loaded
+PG_TABLE_CONSTRAINTS = """
+SELECT "conname", pg_get_constraintdef("oid") FROM "pg_constraint"
+WHERE "conrelid" = %s::regclass AND "contype" IN ('p', 'u', 'x')
+"""
+
+# Other indexes of a table, pg_get_indexdef() always writes the table name with its schema
+PG_TABLE_INDEXES = """
+SELECT pg_get_indexdef("i"."indexrelid"), quote_ident("n"."nspname") || '.' || quote_ident("c"."relname")
+FROM "pg_index" "i"
+JOIN "pg_class" "c" ON "c"."oid" = "i"."indrelid"
+JOIN "pg_namespace" "n" ON "n"."oid" = "c"."relnamespace"
+WHERE "i"."indrelid" = %s::regclass AND NOT EXISTS (
+    SELECT 1 FROM "pg_constraint" WHERE "conindid" = "i"."indexrelid" AND "conrelid" = "i"."indrelid"
+    AND "contype" IN ('p', 'u', 'x')
+)
+"""
+
+# Foreign keys from or to the given tables, and whether they belong to one of them
+PG_TABLES_FOREIGN_KEYS = """
+SELECT "conrelid"::regclass::text, "conname", pg_get_constraintdef("oid"), "conrelid" = ANY(%s::regclass[])
+FROM "pg_constraint"
+WHERE "contype" = 'f' AND ("conrelid" = ANY(%s::regclass[]) OR "confrelid" = ANY(%s::regclass[]))
+"""
 
-def get_db_connector():
+# Sequences of serial columns of the given tables, they are dropped with the table that owns them
+PG_OWNED_SEQUENCES = """
+SELECT "d"."objid"::regclass::text, "d"."refobjid"::regclass::text, "a"."attname"
+FROM "pg_depend" "d"
+JOIN "pg_class" "s" ON "s"."oid" = "d"."objid" AND "s"."relkind" = 'S'
+JOIN "pg_attribute" "a" ON "a"."attrelid" = "d"."refobjid" AND "a"."attnum" = "d"."refobjsubid"
+WHERE "d"."classid" = 'pg_class'::regclass AND "d"."deptype" = 'a' AND "d"."refobjid" = ANY(%s::regclass[])
+"""
+
+# Schemas staged restores load shadow tables into, and move the replaced tables to while swapping
+PG_STAGING_SCHEMA = 'backups_staging'
+PG_REPLACED_SCHEMA = 'backups_replaced'
+
+MANIFEST_NAME = 'manifest.json'
+
+# Session settings pg_dump writes at the top of its output: SET and
+# SELECT pg_catalog.set_config('search_path', '', false)
+SESSION_STATEMENT = re.compile(r'(?:SET\b|SELECT\s+(?:pg_catalog\.)?set_config\s*\()', re.IGNORECASE)
+
+# Table a restore statement writes to, with an optional schema in front of it
+STATEMENT_TABLE = re.compile(
+    r'(?:INSERT\s+INTO|DELETE\s+FROM|COPY|CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+'
+    r'(?P<target>(?:(?:"[^"]+"|\w+)\.)?(?P<name>"(?:[^"]|"")+"|\w+))',
+    re.IGNORECASE,
+)
+# Statements whose row count is the number of rows they loaded
+INSERT_STATEMENT = re.compile(r'INSERT\s', re.IGNORECASE)
+
+WITHOUT_ROWID = re.compile(r'\)[^)]*\bWITHOUT\s+ROWID\b[^)]*$', re.IGNORECASE)
+ROWID_ALIASES = ('rowid', '_rowid_', 'oid')
+# Staged SQLite restores load each table into a shadow table with this prefix, renamed over the live one at the end
+SQLITE_SHADOW_PREFIX = 'backups_staged_'
+# Name of the table a CREATE TABLE statement creates
+CREATE_TABLE_NAME = re.compile(
+    r'^(CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?)("(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|[^\s(]+)',
+    re.IGNORECASE,
+)
+# Indexes and triggers of a table, DROP TABLE takes them with it
+TABLE_SCHEMA_OBJECTS = """
+SELECT "sql" FROM "{schema}"."sqlite_master"
+WHERE "type" IN ('index', 'trigger') AND "tbl_name" = ? AND "sql" NOT NULL
+"""
+
+# Every SQLite database file starts with this header
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+
+def get_db_connector(stats=None):
     # Determine the database type
     database_engine = settings.DATABASES[DEFAULT_DB_ALIAS]['ENGINE']
 
     # Create a backup based on the database type
     if 'sqlite3' in database_engine:
-        return SqliteConnector()
+        return SqliteConnector(stats)
     elif 'postgresql' in database_engine:
-        return PostgresConnector()
+        return PostgresConnector(stats)
     else:
         raise Exception(f"Database type '{database_engine}' is not supported for backup.")
 
 
+def get_statement_table(statement):
+    # Name of the table a dump statement writes to, None for statements like SET or setval()
+    match = STATEMENT_TABLE.match(statement)
+    if match is None:
+        return None
+    name = match.group('name')
+    if name.startswith('"'):
+        return name[1:-1].replace('""', '"')
+    return name
+
+
+def replace_statement_table(statement, table_ref):
+    # The statement writing to table_ref instead, COPY statements keep their rows
+    match = STATEMENT_TABLE.match(statement)
+    replaced = f"{statement[:match.start('target')]}{table_ref}{statement[match.end('target'):]}"
+    if isinstance(statement, CopyStatement):
+        replaced = CopyStatement(replaced)
+        replaced.data = statement.data
+    return replaced
+
+
+def sort_tables_by_dependencies(dependencies):
+    """
+    Order table names so every table comes after the tables it references.
+    ``dependencies`` maps a table name to the names it has foreign keys to.
+    Tables in a reference cycle fall back to name order.
+    """
+    names = sorted(dependencies)
+    sorter = TopologicalSorter({name: sorted(set(dependencies[name]) & set(names) - {name}) for name in names})
+    try:
+        return list(sorter.static_order())
+    except CycleError:
+        return names
+
+
+def get_manifest_path(backup_path):
+    # Incremental backup manifests are stored next to the backup file
+    return f'{backup_path}.manifest.json'
+
+
+def read_backup_manifest(backup_path):
+    manifest_path = get_manifest_path(backup_path)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def extract_tar(tar, path):
+    # filter='data' only exists from Python 3.10.12 and 3.11.4, older versions check the members here
+    if hasattr(tarfile, 'data_filter'):
+        tar.extractall(path, filter='data')
+        return
+    root = os.path.abspath(path)
+    for member in tar.getmembers():
+        target = os.path.abspath(os.path.join(root, member.name))
+        if not (member.isfile() or member.isdir()) or not target.startswith(root + os.sep):
+            raise Exception(f"Refusing to extract '{member.name}' from the backup")
+    tar.extractall(path)
+
+
+def is_parallel_backup(backup_file):
+    # Parallel backups are a tar of one part per table plus a manifest
+    return str(backup_file.name).endswith('.tar')
+
+
 class BaseDBConnector:
-    def __init__(self):
+    def __init__(self, stats=None):
         self.backup_root = settings.BACKUP_ROOT
         self.media_root = settings.MEDIA_ROOT
         self.connection = connections[DEFAULT_DB_ALIAS]
-        self.exclude_tables = ['django_migrations', 'django_session']
+        # The backup app's own tables are left out so a restore never rewinds job status and stats
+        self.exclude_tables = ['django_migrations', 'django_session', 'backups_backup', 'backups_restore',
+                               'backups_schedule', 'backups_joblock']
+        # Tables picked with select_tables(), None for every table
+        self.include_tables = None
+        self.selective = False
+        # Number of statements run per transaction on restore, 0 restores everything in one transaction
+        self.restore_batch_size = getattr(settings, 'BACKUP_RESTORE_BATCH_SIZE', 1000)
+        # Size of the chunks the backup file is read in while parsing statements
+        self.restore_chunk_size = getattr(settings, 'BACKUP_RESTORE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+        # Worker count for per-table parallel dump and restore, 0 or 1 keeps the single file dump
+        self.parallel_workers = getattr(settings, 'BACKUP_PARALLEL_WORKERS', 0)
+        self.compression = get_codec()
+        # 'portable' backups hold typed rows any engine can load, 'native' ones are the engine's own SQL or files
+        self.portable = getattr(settings, 'BACKUP_DATABASE_FORMAT', 'native') == 'portable'
+        # 'staged' restores load into tables the site doesn't use and swap them in at the end
+        self.staged = getattr(settings, 'BACKUP_RESTORE_MODE', 'direct') == 'staged'
+        # Seconds the swap of a staged restore waits for the live tables
+        self.lock_timeout = getattr(settings, 'BACKUP_RESTORE_LOCK_TIMEOUT', 30)
+        self.stats = stats or Stats()
         self.backup_path = self.get_backup_path()
+        # Set once the backup file was streamed to the offsite storages while being written
+        self.mirrored = False
+        # SHA-256 of the backup file, computed while it is written when it is streamed
+        self.checksum = None
+        # [rows, seconds] per table of the statements restored so far, see count_table_rows()
+        self.table_rows = {}
 
     @staticmethod
     def get_relative_media_file_path(absolute_file_path):
@@ -43,124 +251,1316 @@ class BaseDBConnector:
         relative_file_path = relative_file_path.replace('\\', '/')
         return relative_file_path
 
-    def create_backup(self):
+    def select_tables(self, include_tables=None, exclude_tables=None):
+        # Limit backups and restores to include_tables (all tables when empty) minus exclude_tables
+        if include_tables:
+            self.include_tables = list(include_tables)
+        if exclude_tables:
+            self.exclude_tables = self.exclude_tables + list(exclude_tables)
+        self.selective = bool(include_tables or exclude_tables)
+
+    def is_table_selected(self, table_name):
+        if table_name in self.exclude_tables:
+            return False
+        return self.include_tables is None or table_name in self.include_tables
+
+    def get_table_order(self):
+        # Table names of the live database, referenced tables first
+        raise NotImplementedError
+
+    def select_statements(self, statements):
+        """
+        Keep the statements of the selected tables, replayed table by table in
+        foreign key order. Each table's statements are spooled to a temporary
+        file as the dump streams, statements of no table are passed on at once.
+        """
+        if not self.selective:
+            yield from statements
+            return
+
+        spools = {}
+        try:
+            for statement in statements:
+                table_name = get_statement_table(statement)
+                if table_name is None:
+                    yield statement
+                    continue
+                if not self.is_table_selected(table_name):
+                    if isinstance(statement, CopyStatement):
+                        statement.data.drain()
+                    continue
+                if table_name not in spools:
+                    spools[table_name] = tempfile.SpooledTemporaryFile(max_size=DEFAULT_CHUNK_SIZE * 16,
+                                                                       dir=self.backup_root)
+                spool = spools[table_name]
+                spool.write(f'{statement};\n'.encode())
+                if isinstance(statement, CopyStatement):
+                    # COPY rows follow their statement up to the end marker, as in pg_dump's output
+                    while True:
+                        line = statement.data.readline()
+                        if not line:
+                            break
+                        spool.write(line.encode())
+                    spool.write(f'{COPY_END_MARKER}\n'.encode())
+
+            # Tables missing from the live database, e.g. created by the backup itself, keep the dump's order
+            order = [table_name for table_name in self.get_table_order() if table_name in spools]
+            order += [table_name for table_name in spools if table_name not in order]
+            for table_name in order:
+                spool = spools[table_name]
+                spool.seek(0)
+                yield from iter_statements(spool, chunk_size=self.restore_chunk_size)
+        finally:
+            for spool in spools.values():
+                spool.close()
+
+    def ensure_connection(self):
+        # is_usable() is always True for SQLite, so also open connections that were never made
+        if self.connection.connection is not None and not self.connection.is_usable():
+            self.connection.close()
+        self.connection.ensure_connection()
+
+    def create_backup(self, parent_manifest=None):
+        """
+        Dump the database and return the backup path relative to MEDIA_ROOT.
+        Given the manifest of a previous backup, only the tables whose
+        fingerprint changed since then are dumped.
+        """
         raise NotImplementedError
 
     def restore_backup(self, backup_file):
         raise NotImplementedError
 
-    def get_backup_path(self):
+    @staticmethod
+    def get_key_columns(sql, table_info):
+        """
+        Columns a table's rows are paged by: its rowid, or the primary key of
+        WITHOUT ROWID tables. None when columns named like every rowid alias
+        hide it, such a table is read in one go.
+        """
+        column_names = {str(column[1]).lower() for column in table_info}
+        rowid_aliases = [alias for alias in ROWID_ALIASES if alias not in column_names]
+        if WITHOUT_ROWID.search(sql):
+            # pk is the column's position in the primary key, 0 for other columns
+            return [str(column[1]) for column in sorted(table_info, key=lambda column: column[5]) if column[5]]
+        return rowid_aliases[:1] or None
+
+    @staticmethod
+    def quote_key_columns(key_columns):
+        return ', '.join(f'"{column}"' if column not in ROWID_ALIASES else column
+                         for column in (column.replace('"', '""') for column in key_columns))
+
+    def get_table_fingerprints(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def get_changed_tables(fingerprints, parent_manifest):
+        previous = parent_manifest['fingerprints']
+        return [table_name for table_name, fingerprint in fingerprints.items()
+                if previous.get(table_name) != fingerprint]
+
+    def write_manifest(self, fingerprints, changed_tables=None):
+        manifest = {
+            'engine': self.connection.vendor,
+            'kind': 'full' if changed_tables is None else 'incremental',
+            'fingerprints': fingerprints,
+            'tables': list(fingerprints) if changed_tables is None else changed_tables,
+        }
+        manifest_path = get_manifest_path(self.backup_path)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        mirror_file(manifest_path)
+        return manifest
+
+    def create_portable_backup(self, parent_manifest=None):
+        """
+        Dump the selected tables in the portable format: a tar holding a
+        manifest with every table's columns and their types, then a file of
+        JSON rows per table in foreign key order. Any engine can restore it.
+        """
+        fingerprints = self.get_table_fingerprints()
+        changed_tables = None
+        if parent_manifest is not None:
+            changed_tables = self.get_changed_tables(fingerprints, parent_manifest)
+        self.backup_path = self.get_backup_path(PORTABLE_EXTENSION)
+        tables = [table_name for table_name in self.get_table_order() if self.is_table_selected(table_name)
+                  and (changed_tables is None or table_name in changed_tables)]
+
+        extension = CODEC_EXTENSIONS[self.compression]
+        manifest = {'format': 'portable', 'version': PORTABLE_VERSION, 'engine': self.connection.vendor,
+                    'tables': []}
+        with self.stats.stage('dump'), tempfile.TemporaryDirectory(dir=self.backup_root) as tmp_dir:
+            with self.connection.cursor() as cursor:
+                for index, table_name in enumerate(tables):
+                    started = time.perf_counter()
+                    columns = get_table_columns(self.connection, cursor, table_name)
+                    rows = 0
+                    # Server side cursors keep PostgreSQL from sending the whole table at once
+                    with self.connection.chunked_cursor() as rows_cursor, \
+                            self.open_writer(os.path.join(tmp_dir, f'{index:04d}')) as f:
+                        for line in iter_table_rows(self.connection, rows_cursor, table_name, columns):
+                            f.write(line.encode())
+                            rows += 1
+                    manifest['tables'].append({'name': table_name, 'file': f'tables/{index:04d}.jsonl{extension}',
+                                               'rows': rows, 'columns': columns})
+                    self.stats.add_table(table_name, rows, time.perf_counter() - started)
+
+            manifest_path = os.path.join(tmp_dir, MANIFEST_NAME)
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f, indent=2)
+            # Manifest first and tables in dependency order, so restore can read the tar front to back
+            with tarfile.open(self.backup_path, 'w') as tar:
+                tar.add(manifest_path, arcname=MANIFEST_NAME)
+                for index, table in enumerate(manifest['tables']):
+                    tar.add(os.path.join(tmp_dir, f'{index:04d}'), arcname=table['file'])
+        self.stats.add('dump', rows=sum(table['rows'] for table in manifest['tables']))
+        self.finish_backup_file()
+
+        self.write_manifest(fingerprints, changed_tables)
+        return self.get_relative_media_file_path(self.backup_path)
+
+    def restore_portable_backup(self, backup_file):
+        """
+        Load a portable backup, whichever engine wrote it. Tables have to
+        exist already (run migrate first). The rows of every selected table
+        are replaced by the backup's in one transaction, columns are matched
+        by name and each engine's bulk loader inserts them.
+        """
+        self.ensure_connection()
+        with tarfile.open(fileobj=backup_file, mode='r:') as tar:
+            manifest = json.load(tar.extractfile(MANIFEST_NAME))
+            tables = [table for table in manifest['tables'] if self.is_table_selected(table['name'])]
+            live_tables = set(self.connection.introspection.table_names())
+            missing = [table['name'] for table in tables if table['name'] not in live_tables]
+            if missing:
+                raise Exception(f"Tables missing from the database, run migrate first: {', '.join(missing)}")
+
+            loaded = 0
+            with self.stats.stage('restore'), transaction.atomic(using=self.connection.alias), \
+                    self.connection.cursor() as cursor:
+                # Foreign keys are checked at commit, so rows can be deleted and loaded in any order
+                for table in reversed(tables):
+                    cursor.execute(f"DELETE FROM {self.connection.ops.quote_name(table['name'])}")
+                for table in tables:
+                    started = time.perf_counter()
+                    source_columns = [tuple(column) for column in table['columns']]
+                    source_names = {column for column, _ in source_columns}
+                    target_columns = [column for column in get_table_columns(self.connection, cursor, table['name'])
+                                      if column[0] in source_names]
+                    data = MeteredFile(open_reader(MeteredFile(tar.extractfile(table['file']), self.stats, 'read')),
+                                       self.stats, 'decompress')
+                    rows = iter_load_rows(iter_lines(data), source_columns, target_columns, self.connection)
+                    count = self.load_rows(cursor, table['name'], [column for column, _ in target_columns], rows)
+                    loaded += count
+                    self.stats.add_table(table['name'], count, time.perf_counter() - started)
+                self.reset_sequences(cursor, [table['name'] for table in tables])
+            self.stats.add('restore', rows=loaded)
+        print(f"Loaded {loaded} rows into {len(tables)} tables from a {manifest['engine']} backup")
+        return {'tables': len(tables), 'rows': loaded}
+
+    def load_rows(self, cursor, table_name, columns, rows):
+        # Bulk insert rows into columns of table_name, returns the number of rows
+        raise NotImplementedError
+
+    def reset_sequences(self, cursor, table_names):
+        pass
+
+    def can_stage(self, backup_file):
+        return False
+
+    def restore_staged(self, backup_files):
+        # Restore the chain into staging tables and swap them in, see BACKUP_RESTORE_MODE
+        raise NotImplementedError
+
+    def restore_backup_chain(self, backup_files):
+        """
+        Restore a full backup followed by the incremental backups taken after it.
+        Each incremental replaces the rows of the tables it holds in one
+        transaction, so deferred foreign keys are only checked once it is done.
+        Staged restores load the whole chain before swapping it in once.
+        """
+        if self.staged:
+            if all(self.can_stage(backup_file) for backup_file in backup_files):
+                return self.restore_staged(backup_files)
+            print("These backups can't be staged, they are restored into the live tables")
+
+        full_backup, *incremental_backups = backup_files
+        results = [self.restore_backup(full_backup)]
+        for backup_file in incremental_backups:
+            with transaction.atomic(using=self.connection.alias):
+                results.append(self.restore_backup(backup_file))
+        return results
+
+    def execute_statements(self, statements):
+        """
+        Run restore statements in batches, each batch inside a single transaction.
+        A failing batch is rolled back and replayed statement by statement so one
+        bad row only costs its own statement. With a batch size of 0 the whole
+        restore is one transaction and a failing statement rolls all of it back.
+        """
+        self.ensure_connection()
+        cursor = self.connection.cursor()
+
+        executed = failed = 0
+        started = time.monotonic()
+        if not self.restore_batch_size:
+            executed = self._execute_all(cursor, statements)
+        else:
+            batch = []
+            for statement in statements:
+                if isinstance(statement, CopyStatement):
+                    # COPY rows are streamed and can't be replayed, run them on their own
+                    if batch:
+                        ok, errors = self._execute_batch(cursor, batch)
+                        executed, failed = executed + ok, failed + errors
+                        batch = []
+                    ok, errors = self._execute_copy(cursor, statement)
+                    executed, failed = executed + ok, failed + errors
+                    continue
+                batch.append(statement)
+                if len(batch) >= self.restore_batch_size:
+                    ok, errors = self._execute_batch(cursor, batch)
+                    executed, failed = executed + ok, failed + errors
+                    batch = []
+            if batch:
+                ok, errors = self._execute_batch(cursor, batch)
+                executed, failed = executed + ok, failed + errors
+        cursor.close()
+        rows = self.flush_table_rows()
+
+        elapsed = time.monotonic() - started
+        rate = executed / elapsed if elapsed else 0
+        print(f"Restored {executed} statements ({failed} failed) in {elapsed:.2f}s, {rate:.0f} statements/s")
+        self.stats.add('restore', seconds=elapsed, statements=executed, failed=failed, rows=rows)
+        return {'executed': executed, 'failed': failed, 'seconds': elapsed}
+
+    def _execute(self, cursor, statement):
+        # Run one statement, returns the rows it loaded and the seconds it took
+        started = time.perf_counter()
+        if isinstance(statement, CopyStatement):
+            cursor.copy_expert(statement, statement.data)
+            rows = statement.data.rows
+        else:
+            cursor.execute(statement)
+            rows = max(cursor.rowcount, 0) if INSERT_STATEMENT.match(statement) else 0
+        return rows, time.perf_counter() - started
+
+    def count_table_rows(self, statement, rows, seconds):
+        # Rows and seconds of a statement that ran, added to the stats per table by flush_table_rows()
+        table_name = get_statement_table(statement)
+        if table_name is not None:
+            counts = self.table_rows.setdefault(table_name, [0, 0])
+            counts[0] += rows
+            counts[1] += seconds
+
+    def flush_table_rows(self):
+        # Counted once per table rather than per statement, returns the rows of all tables
+        rows = 0
+        for table_name, (table_rows, seconds) in self.table_rows.items():
+            self.stats.add_table(table_name, table_rows, seconds)
+            rows += table_rows
+        self.table_rows = {}
+        return rows
+
+    def _execute_all(self, cursor, statements):
+        # One transaction for the whole restore, statements run as they are parsed so none are held in memory
+        executed = 0
+        with transaction.atomic(using=self.connection.alias):
+            for statement in statements:
+                self.count_table_rows(statement, *self._execute(cursor, statement))
+                executed += 1
+        return executed
+
+    def _execute_batch(self, cursor, batch):
+        try:
+            with transaction.atomic(using=self.connection.alias):
+                counts = [self._execute(cursor, statement) for statement in batch]
+        except (OperationalError, IntegrityError):
+            pass
+        else:
+            for statement, (rows, seconds) in zip(batch, counts):
+                self.count_table_rows(statement, rows, seconds)
+            return len(batch), 0
+
+        # Fall back to one transaction per statement to isolate the failing ones
+        failed = 0
+        for statement in batch:
+            try:
+                with transaction.atomic(using=self.connection.alias):
+                    rows, seconds = self._execute(cursor, statement)
+            except (OperationalError, IntegrityError) as err:
+                warnings.warn(f"Error in db restore: {err}")
+                failed += 1
+            else:
+                self.count_table_rows(statement, rows, seconds)
+        return len(batch) - failed, failed
+
+    def _execute_copy(self, cursor, statement):
+        """
+        Run a COPY block in its own transaction. Its rows are spooled as COPY
+        reads them, if the block fails it is rolled back and its rows are
+        replayed one COPY each, so a duplicate key only costs its own row
+        like it does for INSERT statements.
+        """
+        started = time.perf_counter()
+        with tempfile.SpooledTemporaryFile(max_size=DEFAULT_CHUNK_SIZE * 16, mode='w+', dir=self.backup_root) as spool:
+            data = SpooledCopyData(statement.data, spool)
+            try:
+                with transaction.atomic(using=self.connection.alias):
+                    cursor.copy_expert(statement, data)
+                self.count_table_rows(statement, statement.data.rows, time.perf_counter() - started)
+                return 1, 0
+            except (OperationalError, IntegrityError) as err:
+                warnings.warn(f"Error in db restore, replaying the rows of '{statement}' one by one: {err}")
+            data.drain()
+            spool.seek(0)
+
+            # COPY's text format escapes newlines inside values, every line is a row
+            executed = failed = 0
+            for line in spool:
+                try:
+                    with transaction.atomic(using=self.connection.alias):
+                        cursor.copy_expert(statement, io.StringIO(line))
+                    executed += 1
+                except (OperationalError, IntegrityError) as err:
+                    warnings.warn(f"Error in db restore: {err}")
+                    failed += 1
+            self.count_table_rows(statement, executed, time.perf_counter() - started)
+            return executed, failed
+
+    def iter_statements(self, backup_file):
+        # 'read' meters the backup as stored, 'decompress' the SQL coming out of the codec
+        backup_file = MeteredFile(backup_file, self.stats, 'read')
+        sql_file = MeteredFile(open_reader(backup_file), self.stats, 'decompress')
+        return iter_statements(sql_file, chunk_size=self.restore_chunk_size)
+
+    def open_writer(self, path):
+        # Time spent in the writer is compressing and writing to disk
+        return MeteredFile(open_writer(path, self.compression), self.stats, 'compress')
+
+    @contextmanager
+    def open_backup_writer(self):
+        # Compressed output goes to the backup file and is uploaded to the offsite
+        # storages at the same time, uploads are dropped if the dump fails
+        output = MirroredFile(self.backup_path)
+        try:
+            with self.open_writer(output) as f:
+                yield f
+        except BaseException:
+            output.abort()
+            raise
+        output.complete()
+        self.mirrored = True
+        self.checksum = output.checksum()
+
+    def finish_backup_file(self):
+        self.stats.add('dump', output_bytes=os.path.getsize(self.backup_path))
+        if not self.mirrored:
+            # Snapshots and tars are written with seeks, they are hashed and uploaded once complete
+            with self.stats.stage('checksum'):
+                self.checksum = file_checksum(self.backup_path)
+            with self.stats.stage('upload'):
+                mirror_file(self.backup_path)
+
+    @property
+    def parallel(self):
+        return self.parallel_workers > 1
+
+    @property
+    def backup_extension(self):
+        # Parallel backups compress each part, so the tar itself stays uncompressed
+        return 'tar' if self.parallel else self.sql_extension
+
+    @property
+    def sql_extension(self):
+        return f'sql{CODEC_EXTENSIONS[self.compression]}'
+
+    def get_backup_path(self, extension=None):
         timestamp = now().strftime('%d-%m-%Y-%H::%M')
-        backup_filename = f'backup_{timestamp}.sql'
-        return self.backup_root / backup_filename
+        extension = extension or self.backup_extension
+        backup_filename = f'backup_{timestamp}.{extension}'
+        # Queued jobs can run several backups in the same minute, never overwrite one
+        backup_path = self.backup_root / backup_filename
+        counter = 1
+        while backup_path.exists():
+            backup_path = self.backup_root / f'backup_{timestamp}_{counter}.{extension}'
+            counter += 1
+        return backup_path
+
+
+class DumpRowCounter:
+    """
+    Wraps the file pg_dump's plain SQL output is written to and records the
+    rows of every table in stats as it streams past: the lines of its COPY
+    block, or its INSERT statements with --inserts. A table's seconds run
+    from its first row to the next table's.
+    """
+
+    def __init__(self, file_obj, stats):
+        self.file_obj = file_obj
+        self.stats = stats
+        # Incomplete last line of the output so far
+        self.pending = b''
+        self.in_copy = False
+        self.table_name = self.insert_prefix = None
+        self.rows = 0
+        self.started = None
+
+    def write(self, data):
+        self.file_obj.write(data)
+        buf = self.pending + data
+        pos = 0
+        while True:
+            if self.in_copy:
+                # Rows are counted by their newlines, only the end marker is looked for
+                end = pos if buf.startswith(b'\\.\n', pos) else buf.find(b'\n\\.\n', pos)
+                if end == -1:
+                    last = buf.rfind(b'\n', pos)
+                    if last != -1:
+                        self.rows += buf.count(b'\n', pos, last + 1)
+                        pos = last + 1
+                    break
+                if end != pos:
+                    end += 1
+                self.rows += buf.count(b'\n', pos, end)
+                self.in_copy = False
+                pos = end + 3
+                continue
+            end = buf.find(b'\n', pos)
+            if end == -1:
+                break
+            line = buf[pos:end]
+            pos = end + 1
+            if line.startswith(b'COPY '):
+                self.start_table(line)
+                self.in_copy = True
+            elif line.startswith(b'INSERT INTO '):
+                if self.insert_prefix is None or not line.startswith(self.insert_prefix):
+                    self.start_table(line)
+                self.rows += 1
+        self.pending = buf[pos:]
+
+    def start_table(self, line):
+        self.finish()
+        statement = line.decode(errors='replace')
+        match = STATEMENT_TABLE.match(statement)
+        self.table_name = get_statement_table(statement)
+        self.insert_prefix = line[:match.end('target')] + b' ' if match and line.startswith(b'INSERT') else None
+        self.started = time.perf_counter()
+
+    def finish(self):
+        # Record the table being counted, called once more after the dump ends
+        if self.table_name is not None:
+            self.stats.add_table(self.table_name, self.rows, time.perf_counter() - self.started)
+            self.stats.add('dump', rows=self.rows)
+        self.table_name = self.insert_prefix = None
+        self.rows = 0
 
 
 class PostgresConnector(BaseDBConnector):
-    def __init__(self):
+    def __init__(self, stats=None):
         db = settings.DATABASES[DEFAULT_DB_ALIAS]
         self.db_host = db['HOST']
         self.db_port = db['PORT'] or '5432'
         self.db_name = db['NAME']
         self.db_user = db['USER']
         self.db_password = db['PASSWORD']
-        super().__init__()
+        super().__init__(stats)
+
+    def run_command(self, command, output=None):
+        # output is a file object the command's stdout is streamed into
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=stderr,
+                                       env={**os.environ, 'PGPASSWORD': self.db_password or ''})
+            if output is not None:
+                shutil.copyfileobj(process.stdout, output, DEFAULT_CHUNK_SIZE)
+                stdout = b''
+            else:
+                stdout = process.stdout.read()
+            process.stdout.close()
+            process.wait()
+
+            if process.returncode != 0:
+                # Handle any errors that occurred during the dump or restore process
+                stderr.seek(0)
+                raise Exception(f'Error occurred during database backup or restore:\n{stderr.read().decode()}')
+        return stdout
 
-    def create_backup(self):
-        extra_args = '--no-comments --data-only --inserts --no-owner'
+    @property
+    def connection_args(self):
+        return f'-U {self.db_user} -h {self.db_host} -p {self.db_port}'
+
+    def create_backup(self, parent_manifest=None):
+        if self.portable:
+            return self.create_portable_backup(parent_manifest)
+        # 'copy' dumps table data as COPY blocks restored with COPY FROM STDIN,
+        # 'inserts' writes one INSERT statement per row
+        extra_args = '--no-comments --data-only --no-owner'
+        if getattr(settings, 'BACKUP_POSTGRES_FORMAT', 'copy') == 'inserts' and not self.parallel:
+            extra_args += ' --inserts'
         exclude_table_string = ' '.join([f'--exclude-table={table}' for table in self.exclude_tables])
+        if self.include_tables is not None:
+            exclude_table_string += ' ' + ' '.join(
+                ['--table=' + shlex.quote('"%s"' % table_name) for table_name in self.include_tables])
 
-        command = f'PGPASSWORD={self.db_password} pg_dump {extra_args} {exclude_table_string} -U {self.db_user} -h' \
-                  f' {self.db_host} -p {self.db_port} -F p {self.db_name} > {self.backup_path}'
+        fingerprints = self.get_table_fingerprints()
+        changed_tables = None
+        if parent_manifest is not None:
+            changed_tables = self.get_changed_tables(fingerprints, parent_manifest)
 
-        # Execute the pg_dump command using subprocess
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
+        with self.stats.stage('dump'):
+            if changed_tables is not None:
+                self.create_incremental_backup(extra_args, changed_tables)
+            elif self.parallel:
+                self.create_parallel_backup(f'{extra_args} {exclude_table_string}')
+            else:
+                # pg_dump's output is compressed as it streams in, the plain SQL never hits the disk
+                with self.open_backup_writer() as f:
+                    counter = DumpRowCounter(f, self.stats)
+                    self.run_command(f'pg_dump {extra_args} {exclude_table_string} {self.connection_args}'
+                                     f' -F p {self.db_name}', output=counter)
+                    counter.finish()
+        self.finish_backup_file()
 
-        if process.returncode != 0:
-            # Handle any errors that occurred during the restore process
-            raise Exception(f'Error occurred during database restore:\n{stderr.decode()}')
+        self.write_manifest(fingerprints, changed_tables)
         return self.get_relative_media_file_path(self.backup_path)
 
+    def get_table_fingerprints(self):
+        # Hash the rows of every selected table. The statistics collector's
+        # write counters lag behind commits and TRUNCATE leaves them as they
+        # were, so they can't tell whether a table changed.
+        self.ensure_connection()
+        fingerprints = {}
+        with self.connection.cursor() as cursor:
+            cursor.execute(PG_TABLES)
+            table_names = sorted(table_name for table_name, in cursor.fetchall() if self.is_table_selected(table_name))
+            for table_name in table_names:
+                started = time.perf_counter()
+                cursor.execute(PG_TABLE_FINGERPRINT.format(table=self.connection.ops.quote_name(table_name)))
+                count, row_hash = cursor.fetchone()
+                fingerprints[table_name] = f'{count}:{row_hash}'
+                self.stats.add('fingerprint', seconds=time.perf_counter() - started, rows=count)
+        return fingerprints
+
+    def create_incremental_backup(self, extra_args, tables):
+        # Incrementals are a single SQL file, even when full backups are parallel tars
+        self.backup_path = self.get_backup_path(self.sql_extension)
+        # Clear the changed tables before their rows are copied back in
+        # Quotes inside a name are doubled, in SQL and in pg_dump's patterns alike
+        quoted_names = [self.connection.ops.quote_name(table_name.replace('"', '""')) for table_name in tables]
+        with self.open_backup_writer() as f:
+            for quoted_name in quoted_names:
+                f.write(f'DELETE FROM {quoted_name};\n'.encode())
+            if tables:
+                # Double quotes keep pg_dump from case folding the table names
+                table_string = ' '.join(['--table=' + shlex.quote(quoted_name) for quoted_name in quoted_names])
+                counter = DumpRowCounter(f, self.stats)
+                self.run_command(f'pg_dump {extra_args} {table_string} {self.connection_args}'
+                                 f' -F p {self.db_name}', output=counter)
+                counter.finish()
+
+    def create_parallel_backup(self, extra_args):
+        # pg_dump dumps tables concurrently in directory format, its toc.dat
+        # is the manifest pg_restore uses to order the restore
+        # pg_dump compresses the directory format files itself, a bare level means gzip
+        compress = '0'
+        if self.compression == 'gzip':
+            compress = get_level('gzip')
+        elif self.compression == 'zstd':
+            compress = f'zstd:{get_level("zstd")}'
+        with tempfile.TemporaryDirectory(dir=self.backup_root) as tmp_dir:
+            dump_dir = os.path.join(tmp_dir, 'dump')
+            self.run_command(f'pg_dump {extra_args} {self.connection_args} -F d -j {self.parallel_workers}'
+                             f' --compress={compress} -f {dump_dir} {self.db_name}')
+            with tarfile.open(self.backup_path, 'w') as tar:
+                tar.add(dump_dir, arcname='dump')
+
     def restore_backup(self, backup_file):
-        if not self.connection.is_usable():
-            self.connection.connect()
-        cursor = self.connection.cursor()
+        if is_portable_backup(backup_file):
+            return self.restore_portable_backup(backup_file)
+        if is_parallel_backup(backup_file):
+            return self.restore_parallel_backup(backup_file)
+
+        statements = self.filter_statements(self.iter_statements(backup_file))
+        return self.execute_statements(self.select_statements(statements))
 
-        self.clean_sql(backup_file.path)
+    def load_rows(self, cursor, table_name, columns, rows):
+        # COPY FROM STDIN is PostgreSQL's bulk load, rows are turned into its text format as it reads them
+        data = CopyRowsFile(rows)
+        names = ', '.join(self.connection.ops.quote_name(column) for column in columns)
+        cursor.copy_expert(f'COPY {self.connection.ops.quote_name(table_name)} ({names}) FROM STDIN', data)
+        return data.count
 
-        for line in backup_file.readlines():
+    def reset_sequences(self, cursor, table_names):
+        # Ids were loaded as they were, serial columns have to continue after them
+        models = [model for model in apps.get_models(include_auto_created=True)
+                  if model._meta.db_table in table_names]
+        for sql in self.connection.ops.sequence_reset_sql(no_style(), models):
+            cursor.execute(sql)
+
+    def can_stage(self, backup_file):
+        # pg_restore and portable backups write to the live tables themselves
+        return not is_portable_backup(backup_file) and not is_parallel_backup(backup_file)
+
+    def restore_staged(self, backup_files):
+        """
+        Load the backups into shadow tables in a staging schema, which have no
+        indexes or constraints but the columns and checks of the live tables.
+        Their keys and indexes are built once the rows are in, then a single
+        transaction takes the live tables' locks and swaps the shadow tables
+        in. The site only waits for that swap, never for the load. Foreign keys
+        to and from the swapped tables are added back NOT VALID and validated
+        once the locks are released.
+        """
+        self.ensure_connection()
+        quote = self.connection.ops.quote_name
+        tables = []
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DROP SCHEMA IF EXISTS {quote(PG_STAGING_SCHEMA)} CASCADE')
+            cursor.execute(f'CREATE SCHEMA {quote(PG_STAGING_SCHEMA)}')
             try:
-                with transaction.atomic():
-                    cursor.execute(line.strip().decode("UTF-8"))
-            except (OperationalError, IntegrityError) as err:
-                warnings.warn(f"Error in db restore: {err}")
+                with self.stats.stage('staging'):
+                    for backup_file in backup_files:
+                        with transaction.atomic(using=self.connection.alias):
+                            self.load_staged(cursor, self.filter_statements(self.iter_statements(backup_file)),
+                                             tables)
+                with self.stats.stage('index'):
+                    self.build_staged_indexes(cursor, tables)
+                with self.stats.stage('swap'):
+                    started = time.monotonic()
+                    with transaction.atomic(using=self.connection.alias):
+                        foreign_keys = self.swap_staged_tables(cursor, tables)
+                    print(f'Swapped {len(tables)} restored tables in {time.monotonic() - started:.2f}s')
+                    self.validate_foreign_keys(cursor, foreign_keys)
+            finally:
+                cursor.execute(f'DROP SCHEMA IF EXISTS {quote(PG_STAGING_SCHEMA)} CASCADE')
+        return {'tables': len(tables)}
 
-    @staticmethod
-    def clean_sql(file_path):
-        # Read the file content
-        with open(file_path, 'r', encoding='utf-8') as file:
-            file_content = file.read()
+    def load_staged(self, cursor, statements, tables):
+        # Run the statements of the selected tables on their shadow tables, created when first written to
+        quote = self.connection.ops.quote_name
+        live_tables = set(self.connection.introspection.table_names(cursor))
+        executed = 0
+        for statement in statements:
+            table_name = get_statement_table(statement)
+            # setval() calls are left out, sequences are reset after the swap
+            if table_name is None or not self.is_table_selected(table_name):
+                if isinstance(statement, CopyStatement):
+                    statement.data.drain()
+                continue
+            shadow = f'{quote(PG_STAGING_SCHEMA)}.{quote(table_name)}'
+            if table_name not in tables:
+                if table_name not in live_tables:
+                    raise Exception(f"Table '{table_name}' is missing from the database, run migrate first")
+                cursor.execute(f'CREATE TABLE {shadow} (LIKE {quote(table_name)} INCLUDING ALL EXCLUDING INDEXES)')
+                tables.append(table_name)
+            self.count_table_rows(statement, *self._execute(cursor, replace_statement_table(statement, shadow)))
+            executed += 1
+        self.stats.add('staging', statements=executed, rows=self.flush_table_rows())
+
+    def build_staged_indexes(self, cursor, tables):
+        # Keys and indexes are built from the loaded rows in one pass each, not updated row by row
+        quote = self.connection.ops.quote_name
+        for table_name in tables:
+            shadow = f'{quote(PG_STAGING_SCHEMA)}.{quote(table_name)}'
+            cursor.execute(PG_TABLE_CONSTRAINTS, [quote(table_name)])
+            for constraint_name, definition in cursor.fetchall():
+                cursor.execute(f'ALTER TABLE {shadow} ADD CONSTRAINT {quote(constraint_name)} {definition}')
+            cursor.execute(PG_TABLE_INDEXES, [quote(table_name)])
+            for definition, table_ref in cursor.fetchall():
+                cursor.execute(definition.replace(f' {table_ref} USING ', f' {shadow} USING ', 1))
+            cursor.execute(f'ANALYZE {shadow}')
+            self.stats.add('index', tables=1)
+
+    def swap_staged_tables(self, cursor, tables):
+        """
+        Replace the live tables with their shadow tables, inside the caller's
+        transaction. Returns the foreign keys that were re-created.
+        """
+        quote = self.connection.ops.quote_name
+        names = [quote(table_name) for table_name in tables]
+        # Queries already holding a table are waited for, up to lock_timeout
+        cursor.execute(f"SET LOCAL lock_timeout = '{int(self.lock_timeout * 1000)}ms'")
+        cursor.execute(f"LOCK TABLE {', '.join(names)} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(PG_TABLES_FOREIGN_KEYS, [names, names, names])
+        foreign_keys = cursor.fetchall()
+        cursor.execute(PG_OWNED_SEQUENCES, [names])
+        sequences = cursor.fetchall()
+        cursor.execute('SELECT current_schema()')
+        schema = quote(cursor.fetchone()[0])
 
-        # Remove SQL comments starting with "--"
-        pattern = r'^\s*--.*?$'
-        modified_content = re.sub(pattern, '', file_content, flags=re.MULTILINE)
+        # Constraints of the replaced tables go away with them, the others still point at them
+        for owner, constraint_name, _, swapped in foreign_keys:
+            if not swapped:
+                cursor.execute(f'ALTER TABLE {owner} DROP CONSTRAINT {quote(constraint_name)}')
+        # Serial column defaults refer to their sequence, the shadow tables keep using it
+        for sequence, _, _ in sequences:
+            cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY NONE')
+        cursor.execute(f'CREATE SCHEMA {quote(PG_REPLACED_SCHEMA)}')
+        for name in names:
+            cursor.execute(f'ALTER TABLE {name} SET SCHEMA {quote(PG_REPLACED_SCHEMA)}')
+            cursor.execute(f'ALTER TABLE {quote(PG_STAGING_SCHEMA)}.{name} SET SCHEMA {schema}')
+        for sequence, table_ref, column in sequences:
+            cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table_ref}.{quote(column)}')
+        # Names resolve to the restored tables now
+        for owner, constraint_name, definition, _ in foreign_keys:
+            cursor.execute(f'ALTER TABLE {owner} ADD CONSTRAINT {quote(constraint_name)} {definition} NOT VALID')
+        # Without CASCADE, views on the replaced tables make the swap fail instead of disappearing
+        cursor.execute(f"DROP TABLE {', '.join(f'{quote(PG_REPLACED_SCHEMA)}.{name}' for name in names)}")
+        cursor.execute(f'DROP SCHEMA {quote(PG_REPLACED_SCHEMA)}')
+        self.reset_sequences(cursor, tables)
+        return foreign_keys
 
-        # Remove lines containing SET statements
-        pattern_set = r'^\s*SET\b.*?$'
-        modified_content = re.sub(pattern_set, '', modified_content, flags=re.MULTILINE)
+    def validate_foreign_keys(self, cursor, foreign_keys):
+        # Validating only blocks schema changes, the site keeps writing meanwhile
+        failed = []
+        for owner, constraint_name, _, _ in foreign_keys:
+            try:
+                with transaction.atomic(using=self.connection.alias):
+                    cursor.execute(f'ALTER TABLE {owner} VALIDATE CONSTRAINT '
+                                   f'{self.connection.ops.quote_name(constraint_name)}')
+            except IntegrityError as err:
+                failed.append(f'{owner}.{constraint_name}: {err}')
+        if failed:
+            raise Exception('The restored tables were swapped in, but these foreign keys are left NOT VALID:\n'
+                            + '\n'.join(failed))
 
-        # Remove empty lines
-        pattern_empty_lines = r'^\s*\n'
-        modified_content = re.sub(pattern_empty_lines, '', modified_content, flags=re.MULTILINE)
+    def get_table_order(self):
+        self.ensure_connection()
+        with self.connection.cursor() as cursor:
+            cursor.execute(PG_TABLES)
+            dependencies = {table_name: set() for table_name, in cursor.fetchall()}
+            cursor.execute(PG_FOREIGN_KEYS)
+            for table_name, referenced_table in cursor.fetchall():
+                dependencies.setdefault(table_name, set()).add(referenced_table)
+        return sort_tables_by_dependencies(dependencies)
 
-        # Write the modified content back to the file
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(modified_content)
+    def restore_parallel_backup(self, backup_file):
+        workers = max(self.parallel_workers, 1)
+        with tempfile.TemporaryDirectory(dir=self.backup_root) as tmp_dir, self.stats.stage('restore'):
+            with tarfile.open(fileobj=backup_file, mode='r:') as tar:
+                extract_tar(tar, tmp_dir)
+            dump_dir = os.path.join(tmp_dir, 'dump')
+            list_args = ''
+            if self.selective:
+                # pg_restore replays only the entries of its table of contents kept in the list file
+                list_path = os.path.join(tmp_dir, 'restore.list')
+                with open(list_path, 'w') as f:
+                    f.write(self.select_toc_entries(self.run_command(f'pg_restore -l {dump_dir}').decode()))
+                list_args = f'-L {list_path}'
+            self.run_command(f'pg_restore --data-only --no-owner {self.connection_args} -j {workers} {list_args}'
+                             f' -d {self.db_name} {dump_dir}')
+
+    def select_toc_entries(self, toc):
+        # Table of contents lines look like '3345; 0 16390 TABLE DATA public table_name owner'
+        lines = []
+        for line in toc.splitlines():
+            parts = line.split()
+            if not line.startswith(';') and parts[3:5] == ['TABLE', 'DATA'] and len(parts) > 6:
+                if not self.is_table_selected(parts[6]):
+                    continue
+            lines.append(line)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def filter_statements(statements):
+        # Drop the session settings pg_dump writes at the top of its output: SET
+        # statements and set_config('search_path', ...) calls. Replayed on the
+        # Django connection, an empty search_path would break every unqualified
+        # query it runs afterwards, job updates included. Everything else,
+        # COPY blocks included, is passed on as the backup streams.
+        for statement in statements:
+            if not isinstance(statement, CopyStatement) and SESSION_STATEMENT.match(statement):
+                continue
+            yield statement
 
 
 class SqliteConnector(BaseDBConnector):
-    def _write_dump(self, file_obj):
+    def __init__(self, stats=None):
+        # 'sql' dumps INSERT statements, 'snapshot' copies the database pages with the online backup API
+        self.mode = getattr(settings, 'BACKUP_SQLITE_MODE', 'sql')
+        # Pages copied per backup step, other connections can write in between steps
+        self.snapshot_pages = getattr(settings, 'BACKUP_SQLITE_PAGES_PER_STEP', 1024)
+        # Rows read per query when dumping a table, 0 reads each table with a single query
+        self.export_chunk_rows = getattr(settings, 'BACKUP_SQLITE_CHUNK_ROWS', 10000)
+        # Bytes of snapshot and staging files SQLite reads through a memory map instead of its own cache
+        self.mmap_size = getattr(settings, 'BACKUP_SQLITE_MMAP_SIZE', 1024 * 1024 * 1024)
+        super().__init__(stats)
+
+    @property
+    def parallel(self):
+        # Workers open their own connections, which an in-memory database doesn't allow
+        return super().parallel and not self.connection.is_in_memory_db()
+
+    @property
+    def backup_extension(self):
+        return 'db' if self.mode == 'snapshot' else super().backup_extension
+
+    def get_tables(self, cursor, schema='main'):
+        # (name, create sql) of the tables to back up, ordered so referenced tables come first
+        cursor.execute(DUMP_TABLES.format(schema=schema))
+        tables = {
+            table_name: sql for table_name, _, sql in cursor.fetchall()
+            if not table_name.startswith(("sqlite_", SQLITE_SHADOW_PREFIX)) and self.is_table_selected(table_name)
+        }
+        dependencies = {}
+        for table_name in tables:
+            table_name_ident = table_name.replace('"', '""')
+            res = cursor.execute(f'PRAGMA "{schema}".foreign_key_list("{table_name_ident}")')
+            dependencies[table_name] = {row[2] for row in res.fetchall()}
+        return [(table_name, tables[table_name]) for table_name in sort_tables_by_dependencies(dependencies)]
+
+    def _write_dump(self, file_obj, include_tables=None):
+        # include_tables limits the dump to those tables and makes it replace their rows
         cursor = self.connection.connection.cursor()
-        cursor.execute(DUMP_TABLES)
-        for table_name, _, sql in cursor.fetchall():
-            if table_name.startswith("sqlite_") or table_name in self.exclude_tables:
-                continue
-            if sql.startswith("CREATE TABLE"):
-                sql = sql.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS")
-                # Make SQL commands in 1 line
-                sql = sql.replace("\n    ", "")
-                sql = sql.replace("\n)", ")")
+        fingerprints = {}
+        for table_name, sql in self.get_tables(cursor):
+            if include_tables is None:
+                fingerprints[table_name] = self._write_table(cursor, table_name, sql, file_obj)
+            elif table_name in include_tables:
+                fingerprints[table_name] = self._write_table(cursor, table_name, sql, file_obj, replace=True)
+        cursor.close()
+        return fingerprints
+
+    def _write_table(self, cursor, table_name, sql, file_obj, replace=False):
+        # Writes the table to file_obj (skipped when None) and returns a fingerprint of its rows
+        if sql.startswith("CREATE TABLE"):
+            sql = sql.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS")
+            # Make SQL commands in 1 line
+            sql = sql.replace("\n    ", "")
+            sql = sql.replace("\n)", ")")
+
+        table_name_ident = table_name.replace('"', '""')
+        if file_obj is not None:
             file_obj.write(f"{sql};\n".encode())
+            if replace:
+                file_obj.write(f'DELETE FROM "{table_name_ident}";\n'.encode())
 
-            table_name_ident = table_name.replace('"', '""')
-            res = cursor.execute(f'PRAGMA table_info("{table_name_ident}")')
-            column_names = [str(table_info[1]) for table_info in res.fetchall()]
-            q = """SELECT 'INSERT INTO "{0}" VALUES({1})' FROM "{0}";\n""".format(
-                table_name_ident,
-                ",".join(
-                    """'||quote("{}")||'""".format(col.replace('"', '""'))
-                    for col in column_names
-                ),
-            )
-            query_res = cursor.execute(q)
-            for row in query_res:
-                file_obj.write(f"{row[0]};\n".encode())
+        res = cursor.execute(f'PRAGMA table_info("{table_name_ident}")')
+        table_info = res.fetchall()
+        column_names = [str(column[1]) for column in table_info]
+        insert = """'INSERT INTO "{0}" VALUES({1})'""".format(
+            table_name_ident,
+            ",".join(
+                """'||quote("{}")||'""".format(col.replace('"', '""'))
+                for col in column_names
+            ),
+        )
+        started = time.perf_counter()
+        digest = hashlib.sha1()
+        count = 0
+        for row in self._iter_table_rows(cursor, table_name_ident, sql, table_info, insert):
+            line = f"{row};\n".encode()
+            digest.update(line)
+            count += 1
+            if file_obj is not None:
+                file_obj.write(line)
+
+        seconds = time.perf_counter() - started
+        if file_obj is not None:
+            self.stats.add_table(table_name, count, seconds)
+        else:
+            self.stats.add('fingerprint', seconds=seconds, rows=count)
+        return f'{count}:{digest.hexdigest()}'
+
+    def _iter_table_rows(self, cursor, table_name_ident, sql, table_info, insert):
+        """
+        Yield the INSERT statement of every row, read in chunks of
+        export_chunk_rows ordered by rowid, or by primary key for WITHOUT ROWID
+        tables. Every chunk is a statement of its own that runs to completion,
+        so the read is released in between and writers and WAL checkpoints
+        aren't held up by a long dump. Rows are yielded in key order, so a
+        table's fingerprint only depends on the rows written.
+        """
+        key_columns = self.get_key_columns(sql, table_info)
+        if not self.export_chunk_rows or not key_columns:
+            yield from (row[0] for row in cursor.execute(f'SELECT {insert} FROM "{table_name_ident}"'))
+            return
+        keys = self.quote_key_columns(key_columns)
+        # Identifiers may hold braces, so the queries are concatenated rather than formatted
+        select = f'SELECT {insert}, {keys} FROM "{table_name_ident}" '
+        order = f' ORDER BY {keys} LIMIT ?'
+        first_query = select + order
+        # Row value comparison pages on composite keys too
+        next_query = select + f'WHERE ({keys}) > ({", ".join("?" * len(key_columns))})' + order
+
+        last_key = None
+        while True:
+            if last_key is None:
+                rows = cursor.execute(first_query, (self.export_chunk_rows,)).fetchall()
+            else:
+                rows = cursor.execute(next_query, (*last_key, self.export_chunk_rows)).fetchall()
+            for row in rows:
+                yield row[0]
+            self.stats.add('dump', chunks=1)
+            if len(rows) < self.export_chunk_rows:
+                return
+            last_key = rows[-1][1:]
+
+    def get_table_fingerprints(self):
+        # SQLite keeps no per-table change counter, so hash the rows without writing them
+        cursor = self.connection.connection.cursor()
+        fingerprints = {
+            table_name: self._write_table(cursor, table_name, sql, None)
+            for table_name, sql in self.get_tables(cursor)
+        }
+        cursor.close()
+        return fingerprints
+
+    def _write_parallel_dump(self, tar_path):
+        cursor = self.connection.connection.cursor()
+        tables = self.get_tables(cursor)
         cursor.close()
+        database_uri = Path(self.connection.settings_dict['NAME']).resolve().as_uri() + '?mode=ro'
+
+        def dump_table(part_path, table_name, sql):
+            # sqlite3 connections can't be shared between threads, each worker opens its own
+            connection = sqlite3.connect(database_uri, uri=True)
+            try:
+                with self.open_writer(part_path) as f:
+                    return self._write_table(connection.cursor(), table_name, sql, f)
+            finally:
+                connection.close()
+
+        extension = CODEC_EXTENSIONS[self.compression]
+        with tempfile.TemporaryDirectory(dir=self.backup_root) as tmp_dir:
+            manifest = {'engine': 'sqlite', 'tables': []}
+            with ThreadPoolExecutor(self.parallel_workers) as pool:
+                futures = []
+                for index, (table_name, sql) in enumerate(tables):
+                    part_name = f'tables/{index:04d}.sql{extension}'
+                    manifest['tables'].append({'name': table_name, 'file': part_name})
+                    part_path = os.path.join(tmp_dir, f'{index:04d}.sql{extension}')
+                    futures.append(pool.submit(dump_table, part_path, table_name, sql))
+                fingerprints = {table_name: future.result() for (table_name, _), future in zip(tables, futures)}
+
+            manifest_path = os.path.join(tmp_dir, MANIFEST_NAME)
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f, indent=2)
+
+            # Manifest first and parts in dependency order, so restore can read the tar front to back
+            with tarfile.open(tar_path, 'w') as tar:
+                tar.add(manifest_path, arcname=MANIFEST_NAME)
+                for index, table in enumerate(manifest['tables']):
+                    tar.add(os.path.join(tmp_dir, f'{index:04d}.sql{extension}'), arcname=table['file'])
+        return fingerprints
+
+    def _write_snapshot(self, path):
+        # Page level copy of the live database. The copy restarts when another
+        # connection writes between steps, so the result is always consistent.
+        page_count = 0
+
+        def progress(status, remaining, total):
+            nonlocal page_count
+            page_count = total
 
-    def create_backup(self):
-        if not self.connection.is_usable():
-            self.connection.connect()
-        with open(self.backup_path, "wb") as f:
-            self._write_dump(f)
+        tmp_path = f'{path}.tmp'
+        target = sqlite3.connect(tmp_path)
+        try:
+            self.connection.connection.backup(target, pages=self.snapshot_pages, progress=progress)
+        finally:
+            target.close()
+        os.replace(tmp_path, path)
+        self.stats.add('dump', pages=page_count)
+
+    def create_backup(self, parent_manifest=None):
+        self.ensure_connection()
+        if self.portable:
+            return self.create_portable_backup(parent_manifest)
+
+        changed_tables = None
+        if parent_manifest is not None:
+            current_fingerprints = self.get_table_fingerprints()
+            changed_tables = self.get_changed_tables(current_fingerprints, parent_manifest)
+            # Incremental backups only hold some tables, so they are always a single SQL file,
+            # never a snapshot or a parallel tar
+            self.backup_path = self.get_backup_path(self.sql_extension)
+        elif self.mode == 'snapshot' and self.selective:
+            # Snapshots copy the whole database file, a selection of tables is dumped as SQL
+            self.backup_path = self.get_backup_path(super().backup_extension)
+
+        if changed_tables is None and self.mode == 'snapshot' and not self.selective:
+            with self.stats.stage('dump'):
+                self._write_snapshot(self.backup_path)
+            self.finish_backup_file()
+            # Hashing the rows is what snapshots avoid, incrementals built on
+            # one compare against no fingerprints and dump every table
+            self.write_manifest({})
+            return self.get_relative_media_file_path(self.backup_path)
+
+        with self.stats.stage('dump'):
+            if changed_tables is None and self.parallel:
+                fingerprints = self._write_parallel_dump(self.backup_path)
+            else:
+                with self.open_backup_writer() as f:
+                    fingerprints = self._write_dump(f, changed_tables)
+        self.stats.add('dump', rows=sum(table['rows'] for table in self.stats.tables.values()))
+        self.finish_backup_file()
+        if changed_tables is not None:
+            fingerprints = {**current_fingerprints, **fingerprints}
+
+        self.write_manifest(fingerprints, changed_tables)
         return self.get_relative_media_file_path(self.backup_path)
 
     def restore_backup(self, backup_file):
-        if not self.connection.is_usable():
-            self.connection.connect()
-        cursor = self.connection.cursor()
-        for line in backup_file.readlines():
+        if is_portable_backup(backup_file):
+            return self.restore_portable_backup(backup_file)
+        if is_parallel_backup(backup_file):
+            return self.restore_parallel_backup(backup_file)
+        if self.is_snapshot(backup_file):
+            return self.restore_snapshot(backup_file)
+        return self.execute_statements(self.select_statements(self.iter_statements(backup_file)))
+
+    def get_table_order(self):
+        self.ensure_connection()
+        cursor = self.connection.connection.cursor()
+        try:
+            return [table_name for table_name, _ in self.get_tables(cursor)]
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def is_snapshot(backup_file):
+        position = backup_file.tell()
+        magic = backup_file.read(len(SQLITE_MAGIC))
+        backup_file.seek(position)
+        return magic == SQLITE_MAGIC
+
+    def restore_snapshot(self, backup_file):
+        """
+        Replace the contents of the backed up tables with the snapshot's. The
+        snapshot is attached and copied table by table inside SQLite, tables
+        left out of backups keep their live rows.
+        """
+        with tempfile.TemporaryDirectory(dir=self.backup_root) as tmp_dir:
             try:
-                with transaction.atomic():
-                    cursor.execute(line.strip().decode("UTF-8"))
-            except (OperationalError, IntegrityError) as err:
-                warnings.warn(f"Error in db restore: {err}")
+                snapshot_path = backup_file.path
+            except (AttributeError, NotImplementedError, ValueError):
+                # Uploads that aren't stored on disk yet are copied to a temporary file
+                snapshot_path = os.path.join(tmp_dir, 'snapshot.db')
+                with open(snapshot_path, 'wb') as f:
+                    copy_fileobj(backup_file, f)
+            self.restore_snapshot_file(snapshot_path)
+
+    def can_stage(self, backup_file):
+        return not is_portable_backup(backup_file)
+
+    def restore_staged(self, backup_files):
+        """
+        Rebuild the backed up tables in a separate database file: a copy of
+        the snapshot or an empty file, with the SQL backups of the chain
+        replayed into it. Nothing touches the live database until the staging
+        file is complete, then it is swapped in by swap_staged_file(). A
+        statement failing while staging fails the restore and leaves the live
+        database as it was.
+        """
+        sql_backups = backup_files
+        with tempfile.TemporaryDirectory(dir=self.backup_root) as tmp_dir:
+            staging_path = os.path.join(tmp_dir, 'staging.db')
+            with self.stats.stage('staging'):
+                if self.is_snapshot(backup_files[0]):
+                    with open(staging_path, 'wb') as f:
+                        copy_fileobj(backup_files[0], f)
+                    sql_backups = backup_files[1:]
+                staging = sqlite3.connect(staging_path, isolation_level=None)
+                try:
+                    # Nothing needs to survive a crash of the staging file
+                    staging.execute('PRAGMA journal_mode = OFF')
+                    staging.execute('PRAGMA synchronous = OFF')
+                    staging.execute(f'PRAGMA mmap_size = {self.mmap_size}')
+                    for backup_file in sql_backups:
+                        self.load_staged(staging, backup_file)
+                finally:
+                    staging.close()
+
+            self.swap_staged_file(staging_path)
+        return {'tables': len(self.stats.tables)}
+
+    def swap_staged_file(self, staging_path):
+        """
+        Copy the staging file's tables into shadow tables of the live database,
+        export_chunk_rows rows per transaction so the site's writers get the
+        database in between, then swap them in with one transaction: the live
+        tables are dropped and the shadow tables renamed over them. The live
+        tables' indexes and triggers are created again inside that transaction,
+        building the indexes is its only work that grows with the tables.
+        """
+        self.ensure_connection()
+        cursor = self.connection.connection.cursor()
+        # Writers of the live database are waited for, up to lock_timeout
+        busy_timeout = cursor.execute('PRAGMA busy_timeout').fetchone()[0]
+        cursor.execute(f'PRAGMA busy_timeout = {int(self.lock_timeout * 1000)}')
+        # ATTACH is not allowed inside a transaction
+        cursor.execute('ATTACH DATABASE ? AS "snapshot"', (str(staging_path),))
+        tables = []
+        # Shadow tables reference the live tables, foreign keys are checked once all of them are swapped in
+        constraints_disabled = self.connection.disable_constraint_checking()
+        try:
+            if not constraints_disabled:
+                raise Exception("Foreign key checks can't be turned off for the swap, a transaction is open")
+            cursor.execute(f'PRAGMA "snapshot".mmap_size = {self.mmap_size}')
+            tables = self.get_tables(cursor, schema='snapshot')
+            with self.stats.stage('restore'):
+                shadow_tables = [self._load_shadow_table(cursor, table_name, sql) for table_name, sql in tables]
+            started = time.monotonic()
+            self._swap_shadow_tables(cursor, shadow_tables)
+            print(f'Swapped in the restored tables in {time.monotonic() - started:.2f}s')
+        except Exception:
+            for table_name, _ in tables:
+                shadow_name = (SQLITE_SHADOW_PREFIX + table_name).replace('"', '""')
+                cursor.execute(f'DROP TABLE IF EXISTS "main"."{shadow_name}"')
+            raise
+        finally:
+            self.connection.enable_constraint_checking()
+            cursor.execute('DETACH DATABASE "snapshot"')
+            cursor.execute(f'PRAGMA busy_timeout = {busy_timeout}')
+            cursor.close()
+
+    def _load_shadow_table(self, cursor, table_name, sql):
+        # Returns (table name, shadow table name, sql of the indexes and triggers to create after the swap)
+        started = time.perf_counter()
+        table_name_ident = table_name.replace('"', '""')
+        shadow_name = SQLITE_SHADOW_PREFIX + table_name
+        shadow_name_ident = shadow_name.replace('"', '""')
+        # The live table's definition is kept when it exists, like restore_snapshot_file() does
+        live_sql = cursor.execute('SELECT "sql" FROM "main"."sqlite_master" WHERE "type" = \'table\' AND "name" = ?',
+                                  (table_name,)).fetchone()
+        schema = 'main' if live_sql else 'snapshot'
+        schema_objects = [row[0] for row in cursor.execute(TABLE_SCHEMA_OBJECTS.format(schema=schema), (table_name,))]
+        cursor.execute(f'DROP TABLE IF EXISTS "main"."{shadow_name_ident}"')
+        cursor.execute(CREATE_TABLE_NAME.sub(lambda match: f'{match.group(1)}"main"."{shadow_name_ident}"',
+                                             live_sql[0] if live_sql else sql, count=1))
+
+        table_info = cursor.execute(f'PRAGMA "snapshot".table_info("{table_name_ident}")').fetchall()
+        columns = ", ".join('"{}"'.format(str(column[1]).replace('"', '""')) for column in table_info)
+        insert = (f'INSERT INTO "main"."{shadow_name_ident}" ({columns}) '
+                  f'SELECT {columns} FROM "snapshot"."{table_name_ident}"')
+        key_columns = self.get_key_columns(sql, table_info)
+        rows = 0
+        if not self.export_chunk_rows or not key_columns:
+            cursor.execute(insert)
+            rows = cursor.rowcount
+        else:
+            # Each chunk ends at the key export_chunk_rows rows on and commits on its own
+            keys = self.quote_key_columns(key_columns)
+            placeholders = ', '.join('?' * len(key_columns))
+            last_key = ()
+            while True:
+                where = f'WHERE ({keys}) > ({placeholders})' if last_key else 'WHERE 1'
+                end_key = cursor.execute(
+                    f'SELECT {keys} FROM "snapshot"."{table_name_ident}" {where} ORDER BY {keys} LIMIT 1 OFFSET ?',
+                    (*last_key, self.export_chunk_rows - 1)).fetchone()
+                if end_key is None:
+                    # The last chunk takes the remaining rows
+                    cursor.execute(f'{insert} {where}', last_key)
+                else:
+                    cursor.execute(f'{insert} {where} AND ({keys}) <= ({placeholders})', (*last_key, *end_key))
+                rows += cursor.rowcount
+                self.stats.add('restore', chunks=1)
+                if end_key is None:
+                    break
+                last_key = tuple(end_key)
+        self.stats.add('restore', rows=rows)
+        self.stats.add_table(table_name, rows, time.perf_counter() - started)
+        return table_name, shadow_name, schema_objects
+
+    def _swap_shadow_tables(self, cursor, shadow_tables):
+        with transaction.atomic(using=self.connection.alias):
+            for table_name, shadow_name, schema_objects in shadow_tables:
+                table_name_ident = table_name.replace('"', '""')
+                shadow_name_ident = shadow_name.replace('"', '""')
+                cursor.execute(f'DROP TABLE IF EXISTS "main"."{table_name_ident}"')
+                cursor.execute(f'ALTER TABLE "main"."{shadow_name_ident}" RENAME TO "{table_name_ident}"')
+                for sql in schema_objects:
+                    cursor.execute(sql)
+            # Rows referencing rows the restore left out fail the swap, the live tables are kept
+            self.connection.check_constraints(table_names=[table[0] for table in shadow_tables])
+
+    def load_staged(self, staging, backup_file):
+        if is_parallel_backup(backup_file):
+            with tarfile.open(fileobj=backup_file, mode='r:') as tar:
+                manifest = json.load(tar.extractfile(MANIFEST_NAME))
+                for table in manifest['tables']:
+                    if self.is_table_selected(table['name']):
+                        self.execute_staged(staging, self.iter_statements(tar.extractfile(table['file'])))
+        else:
+            self.execute_staged(staging, self.iter_statements(backup_file))
+
+    def execute_staged(self, staging, statements):
+        # Foreign keys are off in the staging file, tables can be loaded in any order
+        executed = 0
+        staging.execute('BEGIN')
+        for statement in statements:
+            table_name = get_statement_table(statement)
+            if table_name is not None and not self.is_table_selected(table_name):
+                continue
+            try:
+                staging.execute(statement)
+            except sqlite3.Error as err:
+                raise Exception(f'Statement {executed + 1} failed while staging the restore: {err}')
+            executed += 1
+        staging.execute('COMMIT')
+        self.stats.add('staging', statements=executed)
+
+    def load_rows(self, cursor, table_name, columns, rows):
+        # One prepared INSERT run for every row by the sqlite3 module
+        count = 0
+
+        def counted():
+            nonlocal count
+            for row in rows:
+                count += 1
+                yield row
+
+        names = ', '.join(self.connection.ops.quote_name(column) for column in columns)
+        placeholders = ', '.join('?' * len(columns))
+        self.connection.connection.executemany(
+            f'INSERT INTO {self.connection.ops.quote_name(table_name)} ({names}) VALUES ({placeholders})', counted())
+        return count
+
+    def restore_snapshot_file(self, snapshot_path):
+        self.ensure_connection()
+        cursor = self.connection.connection.cursor()
+        # ATTACH is not allowed inside a transaction
+        cursor.execute('ATTACH DATABASE ? AS "snapshot"', (str(snapshot_path),))
+        try:
+            cursor.execute(f'PRAGMA "snapshot".mmap_size = {self.mmap_size}')
+            with self.stats.stage('restore'), transaction.atomic(using=self.connection.alias):
+                for table_name, sql in self.get_tables(cursor, schema='snapshot'):
+                    self._copy_snapshot_table(cursor, table_name, sql)
+        finally:
+            cursor.execute('DETACH DATABASE "snapshot"')
+            cursor.close()
+
+    def _copy_snapshot_table(self, cursor, table_name, sql):
+        started = time.perf_counter()
+        table_name_ident = table_name.replace('"', '""')
+        cursor.execute(sql.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+        res = cursor.execute(f'PRAGMA "snapshot".table_info("{table_name_ident}")')
+        columns = ", ".join('"{}"'.format(str(table_info[1]).replace('"', '""')) for table_info in res.fetchall())
+        # Indexes are dropped while the rows are copied and built again from all of them, which is
+        # faster than updating them row by row. Indexes of UNIQUE and PRIMARY KEY constraints stay.
+        indexes = cursor.execute('SELECT "name", "sql" FROM "main"."sqlite_master" '
+                                 'WHERE "type" = \'index\' AND "tbl_name" = ? AND "sql" NOT NULL',
+                                 (table_name,)).fetchall()
+        for index_name, _ in indexes:
+            cursor.execute('DROP INDEX "main"."{}"'.format(index_name.replace('"', '""')))
+        cursor.execute(f'DELETE FROM "main"."{table_name_ident}"')
+        cursor.execute(f'INSERT INTO "main"."{table_name_ident}" ({columns}) '
+                       f'SELECT {columns} FROM "snapshot"."{table_name_ident}"')
+        rows = cursor.rowcount
+        for _, index_sql in indexes:
+            cursor.execute(index_sql)
+        self.stats.add('restore', rows=rows)
+        self.stats.add_table(table_name, rows, time.perf_counter() - started)
+
+    def restore_parallel_backup(self, backup_file):
+        # SQLite allows a single writer, so the selected parts are replayed one
+        # after the other in the manifest's dependency order
+        with tarfile.open(fileobj=backup_file, mode='r:') as tar:
+            manifest = json.load(tar.extractfile(MANIFEST_NAME))
+            statements = chain.from_iterable(
+                self.iter_statements(tar.extractfile(table['file'])) for table in manifest['tables']
+                if self.is_table_selected(table['name'])
+            )
+            return self.execute_statements(statements)
@@ -0,0 +1,159 @@
+import errno
+import mmap
+import os
+import shutil
+from contextlib import contextmanager
+
+COPY_BUFFER_SIZE = 1024 * 1024
+# Largest copy asked of the kernel at once, copies stay interruptible
+KERNEL_COPY_SIZE = 1024 * 1024 * 1024
+# Errors of a kernel copy that isn't supported for these two files, the next way of copying is tried
+UNSUPPORTED_COPY_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+
+def drop_cache(fd, offset=0, length=0):
+    # Backup files are read once, their pages shouldn't push the site's data out of the page cache
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
+@contextmanager
+def open_mapped(path):
+    """
+    Read-only memoryview over a memory map of the file at path, slices of it
+    are handed to hashlib and friends without copying the bytes into Python.
+    The file's pages are dropped from the page cache when done.
+    """
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            # Empty files can't be mapped
+            yield memoryview(b'')
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+        drop_cache(f.fileno())
+
+
+def _copy_file_range(source_fd, target_fd, offset, count):
+    return os.copy_file_range(source_fd, target_fd, count, offset)
+
+
+def _sendfile(source_fd, target_fd, offset, count):
+    return os.sendfile(target_fd, source_fd, offset, count)
+
+
+def _read_write(source_fd, target_fd, offset, count):
+    data = os.pread(source_fd, min(count, COPY_BUFFER_SIZE), offset)
+    written = 0
+    while written < len(data):
+        written += os.write(target_fd, data[written:])
+    return len(data)
+
+
+def copy_range(source_fd, target_fd, offset, count):
+    """
+    Copy count bytes of source_fd from offset to the position of target_fd
+    without passing them through Python. copy_file_range() lets filesystems
+    share blocks or copy server side (btrfs, XFS, NFS), sendfile() copies
+    within the page cache, plain reads and writes are the last resort.
+    Returns the bytes copied, fewer than count only if source_fd ends first.
+    """
+    copies = [_sendfile, _read_write]
+    if hasattr(os, 'copy_file_range'):
+        copies.insert(0, _copy_file_range)
+    copied = 0
+    for copy in copies:
+        while copied < count:
+            try:
+                length = copy(source_fd, target_fd, offset + copied, min(count - copied, KERNEL_COPY_SIZE))
+            except OSError as e:
+                if copy is _read_write or e.errno not in UNSUPPORTED_COPY_ERRORS:
+                    raise
+                break
+            if not length:
+                return copied
+            copied += length
+        else:
+            return copied
+    return copied
+
+
+def copy_file(source_path, target_path):
+    # Copy a whole file, returns its size
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        copied = copy_range(source.fileno(), target.fileno(), 0, os.fstat(source.fileno()).st_size)
+        drop_cache(source.fileno())
+    return copied
+
+
+def copy_fileobj(source, target):
+    """
+    Copy source from its position to its end into target, in the kernel when
+    both are regular files (uploads held in memory are copied by shutil).
+    """
+    try:
+        source_fd, target_fd = source.fileno(), target.fileno()
+    except (AttributeError, OSError, ValueError):
+        shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+        return
+    offset, position = source.tell(), target.tell()
+    # Bytes still in target's buffer go first, file objects are re-positioned past what the kernel copied
+    target.flush()
+    copied = copy_range(source_fd, target_fd, offset, max(os.fstat(source_fd).st_size - offset, 0))
+    source.seek(offset + copied)
+    target.seek(position + copied)
+
+
+class FileRange:
+    """
+    Readable file over bytes start to end of the file at path. FileResponse
+    passes it to the server's wsgi.file_wrapper, servers using sendfile()
+    (e.g. gunicorn) send the range from fileno()'s position up to the
+    Content-Length without reading it into Python. Others read() it.
+    """
+
+    def __init__(self, path, start, end):
+        self.name = str(path)
+        self.file_obj = open(path, 'rb')
+        self.start = start
+        self.size = end - start + 1
+        self.position = 0
+        self.file_obj.seek(start)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.fileno(), start, self.size, os.POSIX_FADV_SEQUENTIAL)
+
+    def fileno(self):
+        return self.file_obj.fileno()
+
+    def read(self, size=-1):
+        remaining = self.size - self.position
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        data = self.file_obj.read(size)
+        self.position += len(data)
+        return data
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = min(max(offset, 0), self.size)
+        self.file_obj.seek(self.start + self.position)
+        return self.position
+
+    def close(self):
+        if not self.file_obj.closed:
+            drop_cache(self.fileno(), self.start, self.size)
+            self.file_obj.close()
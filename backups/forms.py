@@ -8,11 +8,15 @@ from backups.models import Backup, Restore
 class BackupForm(forms.ModelForm):
     class Meta:
         model = Backup
-        fields = ('type', )
+        fields = ('type', 'kind', 'include_tables', 'exclude_tables')
 
 
 class RestoreForm(forms.ModelForm):
     class Meta:
         model = Restore
-        fields = ('type',)
+        fields = ('type', 'file', 'backup', 'paths', 'include_tables', 'exclude_tables')
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Only finished backups can be restored
+        self.fields['backup'].queryset = Backup.objects.filter(status='done')
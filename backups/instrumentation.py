@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Counters reported as a per second rate of their stage
+RATE_COUNTERS = ('bytes', 'rows', 'statements', 'files')
+
+
+class Stats:
+    """
+    Timings and counters collected while a backup or restore runs.
+
+    Stages ('dump', 'compress', 'restore', ...) accumulate seconds plus any
+    counters such as bytes or rows, tables record rows and seconds per table.
+    PostgreSQL's parallel dumps and restores run inside pg_dump and
+    pg_restore, they only record stage totals. Workers of parallel dumps
+    share one instance, so updates are locked.
+    """
+
+    def __init__(self):
+        self.stages = defaultdict(lambda: defaultdict(int))
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                self.stages[stage][name] += value
+
+    @contextmanager
+    def stage(self, stage, **counters):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, seconds=time.perf_counter() - started, **counters)
+
+    def add_table(self, table_name, rows, seconds):
+        # Adds up over calls, a restore of an incremental chain loads a table once per backup
+        with self.lock:
+            table = self.tables.get(table_name, {'rows': 0, 'seconds': 0})
+            rows, seconds = table['rows'] + rows, table['seconds'] + seconds
+            self.tables[table_name] = {
+                'rows': rows,
+                'seconds': round(seconds, 6),
+                'rows_per_second': round(rows / seconds) if seconds else None,
+            }
+
+    def as_dict(self):
+        stages = {}
+        with self.lock:
+            # Jobs save their stats while workers still add to them
+            snapshot = {stage: dict(counters) for stage, counters in self.stages.items()}
+            tables = dict(self.tables)
+        for stage, counters in snapshot.items():
+            stages[stage] = {name: round(value, 6) if isinstance(value, float) else value
+                             for name, value in counters.items()}
+            seconds = counters.get('seconds')
+            for name in RATE_COUNTERS:
+                if seconds and counters.get(name):
+                    stages[stage][f'{name}_per_second'] = round(counters[name] / seconds)
+        return {'stages': stages, 'tables': tables}
+
+
+class MeteredFile:
+    # Wraps a file object, timing reads and writes and counting their bytes into a stage
+    def __init__(self, file_obj, stats, stage):
+        self.file_obj = file_obj
+        self.stats = stats
+        self.stage = stage
+
+    def write(self, data):
+        started = time.perf_counter()
+        result = self.file_obj.write(data)
+        self.stats.add(self.stage, seconds=time.perf_counter() - started, bytes=len(data))
+        return result
+
+    def read(self, size=-1):
+        started = time.perf_counter()
+        data = self.file_obj.read(size)
+        self.stats.add(self.stage, seconds=time.perf_counter() - started, bytes=len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.file_obj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file_obj.close()
@@ -0,0 +1,289 @@
+import os
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from backups.db_connectors import get_db_connector, read_backup_manifest
+from backups.instrumentation import Stats
+from backups.media_manager import backup_media, restore_media
+from backups.models import Backup, JobLock, Restore
+from backups.retention import get_backup_size, prune_backups
+from backups.storage import file_checksum
+from backups.wal_archive import restore_to_time
+
+_executor = None
+_executor_lock = threading.Lock()
+# Seconds a thread waits before retrying a job whose lock is held by another job
+LOCK_POLL_INTERVAL = 5
+
+
+def get_executor():
+    # Process wide pool running jobs in the background of the web process
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = getattr(settings, 'BACKUP_JOB_WORKERS', 1)
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backup-job')
+        return _executor
+
+
+def enqueue(job):
+    """
+    Queue a saved Backup or Restore. With BACKUP_JOB_RUNNER = 'thread' it runs
+    in a local thread pool once the current transaction commits, with
+    'command' it waits for the backup_worker management command to pick it up.
+    Jobs still queued when the web process restarts are picked up by
+    start_queued_jobs().
+    """
+    if getattr(settings, 'BACKUP_JOB_RUNNER', 'thread') == 'thread':
+        transaction.on_commit(lambda: get_executor().submit(run_in_thread, type(job), job.pk))
+
+
+def run_in_thread(model, pk):
+    try:
+        while True:
+            job = claim_job(model, pk)
+            if job is not None:
+                run_job(job)
+                return
+            # Either another worker took it or a job of the same type holds the lock, wait for the latter
+            if not model.objects.filter(pk=pk, status='queued').exists():
+                return
+            time.sleep(LOCK_POLL_INTERVAL)
+    finally:
+        # Threads get their own connections, don't leave them open
+        connections.close_all()
+
+
+def run_queued_jobs():
+    # Run every queued job, waiting on jobs whose lock is held by another job
+    try:
+        fail_stale_jobs()
+        while Backup.objects.filter(status='queued').exists() or Restore.objects.filter(status='queued').exists():
+            job = claim_next_job()
+            if job is None:
+                time.sleep(LOCK_POLL_INTERVAL)
+                continue
+            run_job(job)
+    finally:
+        connections.close_all()
+
+
+def start_queued_jobs(**kwargs):
+    """
+    Connected to request_started by BackupsConfig.ready(). Jobs queued before
+    the web process restarted were submitted to the old process's pool, the
+    first request of this one hands them to the new pool.
+    """
+    request_started.disconnect(start_queued_jobs, dispatch_uid='backups-start-queued-jobs')
+    if getattr(settings, 'BACKUP_JOB_RUNNER', 'thread') == 'thread':
+        get_executor().submit(run_queued_jobs)
+
+
+def get_lock_owner():
+    # Jobs are claimed and run by the same thread
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def acquire_lock(name, owner, timeout):
+    """
+    Take the JobLock row called name for owner, or extend it if owner holds it
+    already. A lock whose holder died is taken over once it expires.
+    """
+    expires_at = now() + timedelta(seconds=timeout)
+    if JobLock.objects.filter(name=name).filter(Q(owner=owner) | Q(expires_at__lt=now())) \
+            .update(owner=owner, expires_at=expires_at):
+        return True
+    try:
+        with transaction.atomic():
+            JobLock.objects.create(name=name, owner=owner, expires_at=expires_at)
+    except IntegrityError:
+        return False
+    return True
+
+
+def extend_lock(name, owner, timeout):
+    # Push back the expiry of a lock owner still holds, returns False if it lost it
+    return bool(JobLock.objects.filter(name=name, owner=owner).update(expires_at=now() + timedelta(seconds=timeout)))
+
+
+def release_lock(name, owner):
+    JobLock.objects.filter(name=name, owner=owner).delete()
+
+
+def get_lock_timeout():
+    return getattr(settings, 'BACKUP_LOCK_TIMEOUT', 24 * 60 * 60)
+
+
+def get_job_lock_name(job):
+    # Backups and restores of the same type never run at the same time, so a
+    # database is never dumped twice at once or dumped while it is restored
+    return f'job-{job.type}'
+
+
+def claim_job(model, pk):
+    job = model.objects.filter(pk=pk, status='queued').first()
+    if job is None:
+        return None
+    lock_name, owner = get_job_lock_name(job), get_lock_owner()
+    if not acquire_lock(lock_name, owner, get_lock_timeout()):
+        return None
+    # Only one worker wins the queued -> running update
+    claimed = model.objects.filter(pk=pk, status='queued').update(status='running', started_at=now())
+    if not claimed:
+        release_lock(lock_name, owner)
+        return None
+    return model.objects.get(pk=pk)
+
+
+def is_lock_live(name):
+    return JobLock.objects.filter(name=name, expires_at__gte=now()).exists()
+
+
+def fail_stale_jobs():
+    """
+    Fail jobs nothing will ever finish: running jobs whose lock is gone or
+    expired, as their worker died, and jobs queued for longer than
+    BACKUP_LOCK_TIMEOUT. Returns the number of jobs failed.
+    """
+    timeout = get_lock_timeout()
+    failed = 0
+    for model, date_field in ((Backup, 'created_at'), (Restore, 'restored_at')):
+        running_types = set(model.objects.filter(status='running').values_list('type', flat=True))
+        for job_type in running_types:
+            # Running jobs hold their type's lock until they are saved as done or failed
+            if not is_lock_live(f'job-{job_type}'):
+                failed += model.objects.filter(status='running', type=job_type).update(
+                    status='failed', error='The worker running this job stopped', finished_at=now())
+        failed += model.objects.filter(status='queued', **{f'{date_field}__lt': now() - timedelta(seconds=timeout)}) \
+            .update(status='failed', error='No worker picked this job up', finished_at=now())
+    return failed
+
+
+def claim_next_job():
+    for model, date_field in ((Backup, 'created_at'), (Restore, 'restored_at')):
+        for pk in model.objects.filter(status='queued').order_by(date_field).values_list('pk', flat=True)[:10]:
+            job = claim_job(model, pk)
+            if job is not None:
+                return job
+    return None
+
+
+def save_progress(job, stats, finished, lock_name, owner):
+    """
+    Extend the job's lock while it runs, so a job running for longer than
+    BACKUP_LOCK_TIMEOUT isn't taken for dead, and save its stats so far every
+    BACKUP_PROGRESS_INTERVAL seconds so the admin shows how far it got.
+    """
+    timeout = get_lock_timeout()
+    progress_interval = getattr(settings, 'BACKUP_PROGRESS_INTERVAL', 10)
+    # Without progress saves the lock is still extended well before it expires
+    interval = min(progress_interval or timeout, timeout / 4)
+    try:
+        while not finished.wait(interval):
+            try:
+                extend_lock(lock_name, owner, timeout)
+                if progress_interval:
+                    type(job).objects.filter(pk=job.pk, status='running').update(stats=stats.as_dict())
+            except DatabaseError:
+                # e.g. SQLite locked by a restore, the next interval tries again
+                pass
+    finally:
+        connections.close_all()
+
+
+def run_job(job):
+    stats = Stats()
+    finished = threading.Event()
+    lock_name, owner = get_job_lock_name(job), get_lock_owner()
+    threading.Thread(target=save_progress, args=(job, stats, finished, lock_name, owner), daemon=True).start()
+    try:
+        if isinstance(job, Backup):
+            run_backup(job, stats)
+        else:
+            run_restore(job, stats)
+    except Exception:
+        job.status = 'failed'
+        job.error = traceback.format_exc()
+        if isinstance(job, Backup):
+            # A failed incremental holds nothing, it must not keep its parent from being pruned
+            job.parent = None
+    else:
+        job.status = 'done'
+    finally:
+        finished.set()
+    try:
+        job.stats = stats.as_dict()
+        job.finished_at = now()
+        job.save()
+    finally:
+        # A save that fails must not keep other jobs of this type waiting for the lock to expire
+        release_lock(lock_name, owner)
+    if isinstance(job, Backup) and job.status == 'done' and getattr(settings, 'BACKUP_PRUNE_AFTER_BACKUP', True):
+        prune_after_backup()
+    return job
+
+
+def prune_after_backup():
+    # Rotation runs after every finished backup, a failed prune leaves the backup itself done
+    try:
+        prune_backups()
+    except Exception:
+        traceback.print_exc()
+
+
+def run_backup(backup, stats):
+    if backup.type == 'database':
+        connector = get_db_connector(stats)
+        connector.select_tables(backup.get_include_tables(), backup.get_exclude_tables())
+        parent_manifest = None
+        if backup.kind == 'incremental':
+            # Build on the latest finished database backup, incremental or not
+            backup.parent = Backup.objects.filter(type='database', status='done').exclude(pk=backup.pk) \
+                .order_by('-created_at').first()
+            if backup.parent is not None:
+                parent_manifest = read_backup_manifest(backup.parent.file.path)
+            if parent_manifest is None:
+                backup.kind, backup.parent = 'full', None
+
+        #  Create the backup file
+        backup.file.name = connector.create_backup(parent_manifest)
+        backup.checksum = connector.checksum
+    else:
+        backup.file.name = backup_media(stats)
+        # Archives are patched with seeks and manifests are small, both are hashed once written
+        with stats.stage('checksum'):
+            backup.checksum = file_checksum(backup.file.path)
+    backup.size = get_backup_size(backup, stats)
+
+
+def run_restore(restore, stats):
+    if restore.type == 'database':
+        connector = get_db_connector(stats)
+        connector.select_tables(restore.get_include_tables(), restore.get_exclude_tables())
+        if restore.point_in_time is not None:
+            # Base snapshot plus the WAL segments archived up to the requested time
+            recovered_at = restore_to_time(connector, restore.point_in_time)
+            print(f'Restored the database as of {recovered_at}')
+        elif restore.backup is not None:
+            # Restore an existing backup, replaying its incremental chain
+            with ExitStack() as stack:
+                backup_files = [stack.enter_context(backup.file.open('rb')) for backup in restore.backup.get_chain()]
+                connector.restore_backup_chain(backup_files)
+        else:
+            # Restore the backup file
+            with restore.file.open('rb') as backup_file:
+                connector.restore_backup_chain([backup_file])
+    else:
+        backup_file = restore.backup.file if restore.backup is not None else restore.file or None
+        restore.file = restore_media(backup_file, stats, restore.get_paths())
@@ -0,0 +1,43 @@
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from backups import jobs
+from backups.wal_archive import WalArchiver
+
+ARCHIVER_LOCK = 'wal-archiver'
+
+
+class Command(BaseCommand):
+    help = 'Copy the SQLite WAL into BACKUP_WAL_ROOT for point in time restores, runs until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=getattr(settings, 'BACKUP_WAL_INTERVAL', 10),
+                            help='Seconds between copies of new WAL frames, the most a restore to a time can miss')
+
+    def handle(self, *args, **options):
+        owner = f'{socket.gethostname()}:{os.getpid()}'
+        interval = options['interval']
+        archiver = None
+        try:
+            while True:
+                # A single archiver copies the WAL, others stand by until its lock expires
+                if jobs.acquire_lock(ARCHIVER_LOCK, owner, interval * 3):
+                    if archiver is None:
+                        archiver = WalArchiver()
+                        archiver.open()
+                    frames = archiver.archive()
+                    if frames:
+                        self.stdout.write(f'Archived {frames} WAL frames')
+                elif archiver is not None:
+                    # Another archiver took over, it starts a generation of its own
+                    archiver.close()
+                    archiver = None
+                time.sleep(interval)
+        finally:
+            if archiver is not None:
+                archiver.close()
+            jobs.release_lock(ARCHIVER_LOCK, owner)
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from backups import jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued backups and restores, polling the database for new jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to wait between polls when idle')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            job = jobs.claim_next_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                continue
+
+            self.stdout.write(f'Running {job}')
+            jobs.run_job(job)
+            if job.status == 'failed':
+                self.stderr.write(f'{job} failed:\n{job.error}')
+            else:
+                self.stdout.write(self.style.SUCCESS(f'{job} done'))
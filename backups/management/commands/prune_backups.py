@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from backups.retention import get_max_bytes, get_retention_policy, prune_backups
+
+
+class Command(BaseCommand):
+    help = 'Delete backups outside of BACKUP_RETENTION and BACKUP_MAX_BYTES, then unreferenced media chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='List the backups that would be deleted')
+        parser.add_argument('--max-bytes', type=int, help='Override BACKUP_MAX_BYTES')
+
+    def handle(self, *args, **options):
+        max_bytes = options['max_bytes'] if options['max_bytes'] is not None else get_max_bytes()
+        if not get_retention_policy() and not max_bytes:
+            self.stdout.write('No retention policy configured, keeping every backup')
+            return
+
+        backups, freed = prune_backups(max_bytes=max_bytes, dry_run=options['dry_run'])
+        if options['dry_run']:
+            for backup in backups:
+                self.stdout.write(f'Would delete {backup} ({backup.size or 0} bytes)')
+            self.stdout.write(f'{len(backups)} backups, {freed} bytes')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Deleted {len(backups)} backups, {freed} bytes freed'))
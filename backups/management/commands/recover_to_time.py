@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware
+
+from backups.wal_archive import recover_to_time
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the SQLite database as it was at a time from the WAL archive into a new file. '
+            'Restores with a point in time replace the live database instead.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('timestamp',
+                            help="Time to recover, e.g. '2026-10-17 14:30:00', local time unless it has an offset")
+        parser.add_argument('output', help='Path of the database file to write')
+
+    def handle(self, *args, **options):
+        target = parse_datetime(options['timestamp'])
+        if target is None:
+            raise CommandError(f"Invalid timestamp '{options['timestamp']}'")
+        if is_naive(target):
+            target = make_aware(target)
+        recovered_at = recover_to_time(target, options['output'])
+        self.stdout.write(self.style.SUCCESS(f"Recovered the database as of {recovered_at} into {options['output']}"))
@@ -0,0 +1,34 @@
+import os
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+
+from backups import jobs, scheduler
+
+SCHEDULER_LOCK = 'scheduler'
+
+
+class Command(BaseCommand):
+    help = 'Queue backups of enabled schedules when they are due, runs until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=30, help='Seconds between checks for due schedules')
+        parser.add_argument('--once', action='store_true', help='Check once and exit')
+
+    def handle(self, *args, **options):
+        owner = f'{socket.gethostname()}:{os.getpid()}'
+        interval = options['interval']
+        try:
+            while True:
+                # Only one scheduler queues backups, others stand by until its lock expires
+                if jobs.acquire_lock(SCHEDULER_LOCK, owner, interval * 3):
+                    for backup in scheduler.run_due_schedules():
+                        self.stdout.write(f'Queued {backup}')
+                elif options['once']:
+                    self.stderr.write('Another scheduler is running')
+                if options['once']:
+                    return
+                time.sleep(interval)
+        finally:
+            jobs.release_lock(SCHEDULER_LOCK, owner)
@@ -0,0 +1,29 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from backups.db_connectors import get_manifest_path
+from backups.models import Backup
+from backups.storage import get_storage_name, get_storages
+
+
+class Command(BaseCommand):
+    help = 'Copy finished backups missing from the BACKUP_STORAGES, resuming interrupted uploads'
+
+    def handle(self, *args, **options):
+        storages = get_storages()
+        if not storages:
+            self.stdout.write('No BACKUP_STORAGES configured')
+            return
+
+        for backup in Backup.objects.filter(status='done').exclude(file='').order_by('created_at'):
+            for path in (backup.file.path, get_manifest_path(backup.file.path)):
+                if not os.path.exists(path):
+                    continue
+                name = get_storage_name(path)
+                for storage in storages:
+                    if storage.size(name) == os.path.getsize(path):
+                        continue
+                    self.stdout.write(f'Uploading {name} to {type(storage).__name__}')
+                    storage.upload_file(path, name)
+        self.stdout.write(self.style.SUCCESS('Backups are in sync'))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from backups.models import Backup
+from backups.verification import verify_backups
+
+
+class Command(BaseCommand):
+    help = 'Re-hash finished backups against their checksums and test-restore them into a scratch SQLite database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('backup_ids', nargs='*', type=int, help='Backups to verify, every finished one by default')
+        parser.add_argument('--checksum-only', action='store_true', help='Only compare checksums, skip test restores')
+        parser.add_argument('--workers', type=int, help='Override BACKUP_VERIFY_WORKERS')
+
+    def handle(self, *args, **options):
+        backups = Backup.objects.filter(status='done').exclude(file='').order_by('created_at')
+        if options['backup_ids']:
+            backups = backups.filter(pk__in=options['backup_ids'])
+
+        failed = 0
+        for backup, error, stats in verify_backups(list(backups), not options['checksum_only'], options['workers']):
+            stages = stats.as_dict()['stages']
+            seconds = sum(stage.get('seconds', 0) for stage in stages.values())
+            if error:
+                failed += 1
+                self.stdout.write(self.style.ERROR(f'{backup}: {error}'))
+            else:
+                self.stdout.write(f'{backup}: ok ({seconds:.2f}s)')
+        if failed:
+            raise CommandError(f'{failed} backups failed verification')
+        self.stdout.write(self.style.SUCCESS('Backups verified'))
@@ -0,0 +1,231 @@
+import math
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from backups.instrumentation import Stats
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Formats that are compressed already, deflating them only burns CPU
+COMPRESSED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp4', '.m4v', '.mov', '.mkv', '.webm', '.avi', '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.woff', '.woff2',
+}
+# Files of unknown type are sampled, above this many bits per byte they are stored
+ENTROPY_THRESHOLD = 7.5
+ENTROPY_SAMPLE_SIZE = 64 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+# Compressed entries are kept in memory up to this size, larger ones spill to a temporary file
+SPOOL_SIZE = 16 * 1024 * 1024
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_COUNT_LIMIT = 0xFFFF
+UTF8_FLAG = 0x800
+
+
+def sample_entropy(path):
+    # Shannon entropy in bits per byte of the start of the file
+    with open(path, 'rb') as f:
+        data = f.read(ENTROPY_SAMPLE_SIZE)
+    if not data:
+        return 0
+    length = len(data)
+    return -sum(count / length * math.log2(count / length) for count in Counter(data).values())
+
+
+def choose_compression(path):
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return ZIP_STORED
+    if sample_entropy(path) > ENTROPY_THRESHOLD:
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+def dos_date_time(timestamp):
+    t = time.localtime(max(timestamp, 315532800))  # zip dates start in 1980
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class ZipEntry:
+    def __init__(self, name, path, level=6):
+        self.name = name
+        self.path = path
+        self.method = None
+        self.level = level
+        file_stat = os.stat(path)
+        self.mode = file_stat.st_mode
+        self.mtime = file_stat.st_mtime
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.offset = 0
+        self.data = None
+
+    def prepare(self):
+        # Runs in a worker thread: picks the method and deflates, zlib releases the GIL while it compresses
+        self.method = choose_compression(self.path)
+        if self.method == ZIP_STORED:
+            return self
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        self.data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(COPY_BUFFER_SIZE)
+                if not chunk:
+                    break
+                self.crc = zlib.crc32(chunk, self.crc)
+                self.file_size += len(chunk)
+                self.data.write(compressor.compress(chunk))
+        self.data.write(compressor.flush())
+        self.compress_size = self.data.tell()
+        self.data.seek(0)
+        return self
+
+    def local_header(self):
+        name = self.name.encode('utf-8')
+        zip64 = self.file_size >= ZIP64_LIMIT or self.compress_size >= ZIP64_LIMIT
+        extra = struct.pack('<HHQQ', 0x0001, 16, self.file_size, self.compress_size) if zip64 else b''
+        dos_time, dos_date = dos_date_time(self.mtime)
+        return struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, UTF8_FLAG, self.method, dos_time, dos_date, self.crc,
+            ZIP64_LIMIT if zip64 else self.compress_size, ZIP64_LIMIT if zip64 else self.file_size,
+            len(name), len(extra),
+        ) + name + extra
+
+    def central_header(self):
+        name = self.name.encode('utf-8')
+        # ZIP64 central entries only carry the fields that overflowed, in this order
+        values = []
+        if self.file_size >= ZIP64_LIMIT:
+            values.append(self.file_size)
+        if self.compress_size >= ZIP64_LIMIT:
+            values.append(self.compress_size)
+        if self.offset >= ZIP64_LIMIT:
+            values.append(self.offset)
+        extra = struct.pack(f'<HH{len(values)}Q', 0x0001, 8 * len(values), *values) if values else b''
+        dos_time, dos_date = dos_date_time(self.mtime)
+        version = 45 if values else 20
+        return struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, UTF8_FLAG, self.method, dos_time,
+            dos_date, self.crc, min(self.compress_size, ZIP64_LIMIT), min(self.file_size, ZIP64_LIMIT),
+            len(name), len(extra), 0, 0, 0, (self.mode & 0xFFFF) << 16, min(self.offset, ZIP64_LIMIT),
+        ) + name + extra
+
+
+class ParallelZipWriter:
+    """
+    Write a standard zip archive whose entries are compressed by a thread pool.
+
+    Each entry is deflated or stored according to its type, compressed data is
+    written in submission order, and the central directory at the end lets
+    readers seek straight to any member. ZIP64 records are added as needed.
+    """
+
+    def __init__(self, file_obj, workers=None, level=6, stats=None):
+        self.file_obj = file_obj
+        self.workers = workers or os.cpu_count() or 1
+        self.level = level
+        self.stats = stats or Stats()
+        self.entries = []
+
+    def write_entry(self, entry):
+        entry.offset = self.file_obj.tell()
+        if entry.method == ZIP_STORED:
+            # Stored data is streamed, the header is patched once the CRC is known
+            self.file_obj.write(entry.local_header())
+            with open(entry.path, 'rb') as f:
+                while True:
+                    chunk = f.read(COPY_BUFFER_SIZE)
+                    if not chunk:
+                        break
+                    entry.crc = zlib.crc32(chunk, entry.crc)
+                    entry.file_size += len(chunk)
+                    self.file_obj.write(chunk)
+            entry.compress_size = entry.file_size
+            end = self.file_obj.tell()
+            header = entry.local_header()
+            if len(header) != end - entry.offset - entry.file_size:
+                # Grew past 4GB and needs a ZIP64 header, rewrite the entry
+                self.file_obj.seek(entry.offset)
+                self.file_obj.truncate()
+                self.file_obj.write(header)
+                with open(entry.path, 'rb') as f:
+                    shutil.copyfileobj(f, self.file_obj, COPY_BUFFER_SIZE)
+            else:
+                self.file_obj.seek(entry.offset)
+                self.file_obj.write(header)
+                self.file_obj.seek(end)
+        else:
+            self.file_obj.write(entry.local_header())
+            shutil.copyfileobj(entry.data, self.file_obj, COPY_BUFFER_SIZE)
+            entry.data.close()
+            entry.data = None
+
+        self.entries.append(entry)
+        self.stats.add('archive', files=1, bytes=entry.file_size, stored_files=int(entry.method == ZIP_STORED))
+
+    def write_files(self, files):
+        # files yields (archive name, path). Only a bounded number of entries are
+        # in flight so memory and spooled data stay limited.
+        pending = deque()
+        with ThreadPoolExecutor(self.workers) as pool:
+            for name, path in files:
+                pending.append(pool.submit(ZipEntry(name, path, self.level).prepare))
+                while len(pending) > self.workers * 2:
+                    self.write_entry(pending.popleft().result())
+            while pending:
+                self.write_entry(pending.popleft().result())
+
+    def close(self):
+        start = self.file_obj.tell()
+        for entry in self.entries:
+            self.file_obj.write(entry.central_header())
+        size = self.file_obj.tell() - start
+        count = len(self.entries)
+
+        if count >= ZIP_COUNT_LIMIT or start >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+            zip64_end = self.file_obj.tell()
+            self.file_obj.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, size, start))
+            self.file_obj.write(struct.pack('<IIQI', 0x07064b50, 0, zip64_end, 1))
+        self.file_obj.write(struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, ZIP_COUNT_LIMIT), min(count, ZIP_COUNT_LIMIT),
+            min(size, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0,
+        ))
+
+
+def write_media_archive(source_dir, archive_path, stats=None):
+    """
+    Archive source_dir into a zip at archive_path, compressing files in
+    parallel with MEDIA_ARCHIVE_WORKERS threads.
+    """
+    stats = stats or Stats()
+    workers = getattr(settings, 'MEDIA_ARCHIVE_WORKERS', None)
+    level = getattr(settings, 'MEDIA_ARCHIVE_LEVEL', 6)
+
+    def iter_files():
+        for dir_path, dir_names, file_names in os.walk(source_dir):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                path = os.path.join(dir_path, file_name)
+                yield os.path.relpath(path, source_dir).replace('\\', '/'), path
+
+    tmp_path = f'{archive_path}.tmp'
+    with stats.stage('archive'), open(tmp_path, 'wb') as f:
+        writer = ParallelZipWriter(f, workers, level, stats)
+        writer.write_files(iter_files())
+        writer.close()
+    os.replace(tmp_path, archive_path)
+    stats.add('archive', output_bytes=os.path.getsize(archive_path))
+    return archive_path
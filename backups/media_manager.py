@@ -1,46 +1,230 @@
+import json
 import os
 import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
 from zipfile import ZipFile
 from django.conf import settings
+from django.core.files import File
+from django.utils.timezone import now
 
+from backups.instrumentation import Stats
+from backups.media_archive import write_media_archive
+from backups.media_store import MediaStore
+from backups.storage import mirror_file
 
-def compress_media_file():
-    # Get the file name and extension
+
+def directory_size(path):
+    # Number of files and total bytes under path
+    files = size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            files += 1
+            size += os.path.getsize(os.path.join(dir_path, file_name))
+    return files, size
+
+
+def compress_media_file(stats=None):
+    stats = stats or Stats()
     parent_dir= os.path.join(settings.MEDIA_ROOT,'backups')
-    new_path=os.path.join(settings.MEDIA_ROOT,'media_backup')
-
-    if os.path.exists(new_path):
-        print("File already exists!! plz 'rename' or 'delete' the existing one first")
-    else:
-        shutil.make_archive(new_path, 'zip', parent_dir)
-        
-        # shutil.rmtree(parent_dir)
-        basename2=os.path.basename(new_path)
-        dir_name= ".zip"
-        new_dir_name2= basename2+dir_name
-        new_path2 = os.path.join(new_path, new_dir_name2)
-        if os.path.exists(new_path2):
-            print("ZIP folder created")
-        else:
-            print("ZIP folder not created")
-        
-    return relative_file_path(new_path2)
+    archive_path = get_media_archive_path()
+
+    # Files are compressed in parallel, already compressed types are stored as is
+    write_media_archive(parent_dir, archive_path, stats)
+    # The archive is written with seeks, so it goes offsite once complete
+    with stats.stage('upload'):
+        mirror_file(archive_path)
+    return relative_file_path(archive_path)
+
+
+def get_media_archive_path():
+    # Every zip backup gets its own archive, next to the directory it archives
+    timestamp = now().strftime('%d-%m-%Y-%H::%M')
+    archive_path = os.path.join(settings.MEDIA_ROOT, f'media_backup_{timestamp}.zip')
+    counter = 1
+    while os.path.exists(archive_path):
+        archive_path = os.path.join(settings.MEDIA_ROOT, f'media_backup_{timestamp}_{counter}.zip')
+        counter += 1
+    return archive_path
+
 
 def relative_file_path(new_path2):
     
     relative_path = os.path.basename(new_path2)
     return relative_path
   
-def restore_media_file():
-    parent_dir= os.path.join(settings.MEDIA_ROOT,'media_backup.zip')
-    print(parent_dir)
-    if os.path.exists(parent_dir):
-            with ZipFile(parent_dir, 'r') as zObject:
-                dir_name= os.path.dirname(parent_dir)
-                new_path = os.path.join(dir_name,'restored_media')
-                zObject.extractall(new_path)
-                # os.remove(parent_dir)
-                print("file uncompressed successfully ")
-                return new_path
-    else:
-            print("please give path to ZIP file")
\ No newline at end of file
+def restore_media_file(backup_file=None, stats=None, patterns=None):
+    stats = stats or Stats()
+    if backup_file is None:
+        # Archives were written to this one path before they got their own names
+        legacy_path = os.path.join(settings.MEDIA_ROOT, 'media_backup.zip')
+        if not os.path.exists(legacy_path):
+            print("please give path to ZIP file")
+            return None
+        backup_file = File(open(legacy_path, 'rb'), name=legacy_path)
+    new_path = os.path.join(settings.MEDIA_ROOT, 'restored_media')
+    with backup_file.open('rb') as archive_file, ZipFile(archive_file, 'r') as zObject:
+        # The central directory lists every member, only the matching ones are read
+        members = [member for member in zObject.infolist()
+                   if not member.is_dir() and match_media_path(member.filename, patterns)]
+
+        def extract(member):
+            path = get_restore_path(new_path, member.filename)
+            if (os.path.exists(path) and os.path.getsize(path) == member.file_size
+                    and file_crc32(path) == member.CRC):
+                stats.add('extract', skipped_files=1)
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # ZipFile can hand out readers to several threads, each gets its own view of the file
+            with zObject.open(member) as source, open(path, 'wb') as f:
+                shutil.copyfileobj(source, f, 1024 * 1024)
+            mode = member.external_attr >> 16
+            if mode:
+                os.chmod(path, mode & 0o777)
+            stats.add('extract', files=1, bytes=member.file_size)
+
+        with stats.stage('extract'):
+            run_in_parallel(extract, members)
+    print("file uncompressed successfully ")
+    return new_path
+
+
+def match_media_path(path, patterns=None):
+    # Patterns are path prefixes ('photos/2023') or globs ('*.pdf'), no patterns match everything
+    if not patterns:
+        return True
+    for pattern in patterns:
+        pattern = pattern.strip().lstrip('/')
+        prefix = pattern.rstrip('/')
+        if fnmatch(path, pattern) or path == prefix or path.startswith(prefix + '/'):
+            return True
+    return False
+
+
+def get_restore_path(root, name):
+    path = os.path.abspath(os.path.join(root, name))
+    if not path.startswith(os.path.abspath(root) + os.sep):
+        raise Exception(f"Refusing to restore '{name}' outside of {root}")
+    return path
+
+
+def file_crc32(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                return crc
+            crc = zlib.crc32(data, crc)
+
+
+def run_in_parallel(function, items):
+    workers = getattr(settings, 'MEDIA_RESTORE_WORKERS', None) or os.cpu_count() or 1
+    with ThreadPoolExecutor(workers) as pool:
+        # Consume the results so errors raised by workers propagate
+        for _ in pool.map(function, items):
+            pass
+
+
+def get_media_source():
+    return getattr(settings, 'MEDIA_BACKUP_SOURCE', os.path.join(settings.MEDIA_ROOT, 'backups'))
+
+
+def iter_media_files(source, exclude_dirs=()):
+    exclude_dirs = {os.path.abspath(path) for path in exclude_dirs}
+    for dir_path, dir_names, file_names in os.walk(source):
+        dir_names[:] = sorted(name for name in dir_names
+                              if os.path.abspath(os.path.join(dir_path, name)) not in exclude_dirs)
+        for file_name in sorted(file_names):
+            yield os.path.join(dir_path, file_name)
+
+
+def backup_media(stats=None):
+    # MEDIA_BACKUP_ENGINE 'store' keeps deduplicated incremental backups, 'zip' archives everything every time
+    if getattr(settings, 'MEDIA_BACKUP_ENGINE', 'store') == 'zip':
+        return compress_media_file(stats)
+    return backup_media_to_store(stats)
+
+
+def restore_media(backup_file=None, stats=None, patterns=None):
+    if backup_file and str(backup_file.name).endswith('.json'):
+        return restore_media_from_store(backup_file, stats, patterns)
+    return restore_media_file(backup_file, stats, patterns)
+
+
+def backup_media_to_store(stats=None):
+    """
+    Back up the media directory into the content addressed store and return the
+    path of the backup's manifest relative to MEDIA_ROOT. Files whose size and
+    mtime match the previous backup reuse its chunks without being read.
+    """
+    stats = stats or Stats()
+    store = MediaStore()
+    source = get_media_source()
+    previous_index = store.load_index()
+    index = {}
+    files = []
+
+    with stats.stage('archive'):
+        for path in iter_media_files(source, exclude_dirs=[store.root]):
+            relative_path = os.path.relpath(path, source).replace('\\', '/')
+            file_stat = os.stat(path)
+            entry = previous_index.get(relative_path)
+            if (entry and entry['size'] == file_stat.st_size and entry['mtime_ns'] == file_stat.st_mtime_ns
+                    and all(store.has(digest) for digest in entry['chunks'])):
+                chunks = entry['chunks']
+                stats.add('archive', reused_files=1)
+            else:
+                chunks = store.put_file(path, stats)
+            index[relative_path] = {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns, 'chunks': chunks}
+            files.append({'path': relative_path, 'mode': file_stat.st_mode & 0o777, **index[relative_path]})
+            stats.add('archive', files=1, bytes=file_stat.st_size)
+
+    manifest_path = get_media_manifest_path(store)
+    with open(manifest_path, 'w') as f:
+        json.dump({'created_at': now().isoformat(), 'files': files}, f)
+    # New chunks went offsite as they were stored, the manifest follows them
+    mirror_file(manifest_path, store.storages)
+    store.save_index(index)
+    stats.add('archive', output_bytes=os.path.getsize(manifest_path))
+    return os.path.relpath(manifest_path, settings.MEDIA_ROOT).replace('\\', '/')
+
+
+def get_media_manifest_path(store):
+    manifest_dir = store.root / 'manifests'
+    manifest_dir.mkdir(parents=True, exist_ok=True)
+    timestamp = now().strftime('%d-%m-%Y-%H::%M')
+    manifest_path = manifest_dir / f'media_{timestamp}.json'
+    counter = 1
+    while manifest_path.exists():
+        manifest_path = manifest_dir / f'media_{timestamp}_{counter}.json'
+        counter += 1
+    return manifest_path
+
+
+def restore_media_from_store(manifest_file, stats=None, patterns=None):
+    stats = stats or Stats()
+    store = MediaStore()
+    with manifest_file.open('rb') as f:
+        manifest = json.load(f)
+    new_path = os.path.join(settings.MEDIA_ROOT, 'restored_media')
+    entries = [entry for entry in manifest['files'] if match_media_path(entry['path'], patterns)]
+
+    def extract(entry):
+        path = get_restore_path(new_path, entry['path'])
+        if (os.path.exists(path) and os.path.getsize(path) == entry['size']
+                and store.file_digests(path) == entry['chunks']):
+            stats.add('extract', skipped_files=1)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            for data in store.read_chunks(entry['chunks']):
+                f.write(data)
+        os.chmod(path, entry.get('mode', 0o644))
+        os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        stats.add('extract', files=1, bytes=entry['size'])
+
+    with stats.stage('extract'):
+        run_in_parallel(extract, entries)
+    return new_path
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from django.conf import settings
+
+from backups.storage import get_storages, mirror_file
+
+# Files are split in chunks of this size so a large file that changed in
+# place only stores its changed chunks again
+MEDIA_CHUNK_SIZE = 4 * 1024 * 1024
+INDEX_NAME = 'index.json'
+
+
+def get_media_store_root():
+    return Path(getattr(settings, 'MEDIA_BACKUP_STORE', Path(settings.BACKUP_ROOT) / 'media_store'))
+
+
+class MediaStore:
+    """
+    Content addressed chunk store for media backups.
+
+    Chunks live under objects/<first two hex digits>/<sha256>, so identical
+    content is only ever stored once. index.json remembers the size, mtime and
+    chunks of every file seen by the last backup, letting unchanged files be
+    skipped without reading them.
+    """
+
+    def __init__(self, root=None, storages=None):
+        self.root = Path(root or get_media_store_root())
+        # Offsite storages new chunks are copied to
+        self.storages = get_storages() if storages is None else storages
+        self.objects_dir = self.root / 'objects'
+        self.index_path = self.root / INDEX_NAME
+
+    def object_path(self, digest):
+        return self.objects_dir / digest[:2] / digest
+
+    def has(self, digest):
+        return self.object_path(digest).exists()
+
+    def put(self, data):
+        # Returns the chunk's digest and whether it was new to the store
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if path.exists():
+            return digest, False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, a crash never leaves a truncated chunk under its digest
+        tmp_path = path.with_name(f'{digest}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        mirror_file(path, self.storages)
+        return digest, True
+
+    def put_file(self, path, stats=None):
+        chunks = []
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(MEDIA_CHUNK_SIZE)
+                if not data:
+                    break
+                digest, stored = self.put(data)
+                chunks.append(digest)
+                if stats is not None:
+                    stats.add('archive', read_bytes=len(data), stored_bytes=len(data) if stored else 0)
+        return chunks
+
+    def file_digests(self, path):
+        # Chunk digests of a file on disk, compared against a manifest entry without touching the store
+        digests = []
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(MEDIA_CHUNK_SIZE)
+                if not data:
+                    return digests
+                digests.append(hashlib.sha256(data).hexdigest())
+
+    def read_chunks(self, chunks):
+        for digest in chunks:
+            with open(self.object_path(digest), 'rb') as f:
+                yield f.read()
+
+    def load_index(self):
+        if not self.index_path.exists():
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def save_index(self, index):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_name(f'{INDEX_NAME}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.30 on 2026-10-17 15:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backups", "0003_restore_file"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="backup",
+            name="kind",
+            field=models.CharField(
+                choices=[("full", "Full"), ("incremental", "Incremental")],
+                default="full",
+                max_length=12,
+            ),
+        ),
+        migrations.AddField(
+            model_name="backup",
+            name="parent",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="children",
+                to="backups.backup",
+            ),
+        ),
+        migrations.AddField(
+            model_name="restore",
+            name="backup",
+            field=models.ForeignKey(
+                blank=True,
+                help_text="Restore this backup and its incremental chain instead of an uploaded file",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="backups.backup",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="restore",
+            name="file",
+            field=models.FileField(blank=True, upload_to="backups/"),
+        ),
+    ]
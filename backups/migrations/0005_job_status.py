@@ -0,0 +1,78 @@
+# Generated by Django 4.2.30 on 2026-10-17 15:09
+
+from django.db import migrations, models
+
+
+def mark_existing_jobs_done(apps, schema_editor):
+    # Backups and restores made before the job queue ran synchronously
+    for model_name in ("Backup", "Restore"):
+        apps.get_model("backups", model_name).objects.update(status="done")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backups", "0004_backup_kind_parent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="backup",
+            name="error",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="backup",
+            name="finished_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="backup",
+            name="started_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="backup",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("queued", "Queued"),
+                    ("running", "Running"),
+                    ("done", "Done"),
+                    ("failed", "Failed"),
+                ],
+                default="queued",
+                max_length=10,
+            ),
+        ),
+        migrations.AddField(
+            model_name="restore",
+            name="error",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="restore",
+            name="finished_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="restore",
+            name="started_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="restore",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("queued", "Queued"),
+                    ("running", "Running"),
+                    ("done", "Done"),
+                    ("failed", "Failed"),
+                ],
+                default="queued",
+                max_length=10,
+            ),
+        ),
+        migrations.RunPython(mark_existing_jobs_done, migrations.RunPython.noop),
+    ]
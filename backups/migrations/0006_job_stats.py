@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-17 15:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backups", "0005_job_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="backup",
+            name="stats",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name="restore",
+            name="stats",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-17 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backups", "0006_job_stats"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="restore",
+            name="paths",
+            field=models.TextField(
+                blank=True,
+                help_text="Media only: path prefixes or globs to restore, one per line. "
+                "Leave empty to restore everything.",
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-17 15:21
+
+import os
+
+from django.db import migrations, models
+
+
+def set_existing_sizes(apps, schema_editor):
+    # Sizes of backups made before they were tracked, shared media chunks aren't attributed
+    for backup in apps.get_model("backups", "Backup").objects.exclude(file=""):
+        paths = [backup.file.path, f"{backup.file.path}.manifest.json"]
+        backup.size = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+        backup.save(update_fields=["size"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backups", "0007_restore_paths"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="backup",
+            name="size",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_existing_sizes, migrations.RunPython.noop),
+    ]
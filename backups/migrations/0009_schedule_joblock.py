@@ -0,0 +1,84 @@
+# Generated by Django 4.2.30 on 2026-10-17 15:24
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("backups", "0008_backup_size"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="JobLock",
+            fields=[
+                (
+                    "name",
+                    models.CharField(max_length=100, primary_key=True, serialize=False),
+                ),
+                ("owner", models.CharField(max_length=200)),
+                ("expires_at", models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Schedule",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                (
+                    "type",
+                    models.CharField(
+                        choices=[
+                            ("database", "Database Backup"),
+                            ("media", "Media Backup"),
+                        ],
+                        max_length=10,
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("full", "Full"), ("incremental", "Incremental")],
+                        default="full",
+                        max_length=12,
+                    ),
+                ),
+                (
+                    "cron",
+                    models.CharField(
+                        help_text="minute hour day-of-month month day-of-week, e.g. '30 2 * * *'",
+                        max_length=100,
+                    ),
+                ),
+                (
+                    "jitter",
+                    models.PositiveIntegerField(
+                        default=0,
+                        help_text="Delay each run by up to this many random seconds",
+                    ),
+                ),
+                ("enabled", models.BooleanField(default=True)),
+                ("last_run_at", models.DateTimeField(blank=True, null=True)),
+                ("next_run_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "created_by",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-17 15:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backups", "0009_schedule_joblock"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="backup",
+            name="exclude_tables",
+            field=models.TextField(
+                blank=True,
+                help_text="Database only: tables to leave out, one per line.",
+            ),
+        ),
+        migrations.AddField(
+            model_name="backup",
+            name="include_tables",
+            field=models.TextField(
+                blank=True,
+                help_text="Database only: tables to back up, one per line. Leave empty for every table.",
+            ),
+        ),
+        migrations.AddField(
+            model_name="restore",
+            name="exclude_tables",
+            field=models.TextField(
+                blank=True,
+                help_text="Database only: tables to leave out, one per line.",
+            ),
+        ),
+        migrations.AddField(
+            model_name="restore",
+            name="include_tables",
+            field=models.TextField(
+                blank=True,
+                help_text="Database only: tables to restore, one per line. Leave empty for every table.",
+            ),
+        ),
+    ]
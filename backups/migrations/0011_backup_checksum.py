@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-17 15:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backups", "0010_table_selection"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="backup",
+            name="checksum",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name="backup",
+            name="verified_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="backup",
+            name="verify_error",
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-17 15:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backups", "0011_backup_checksum"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="restore",
+            name="point_in_time",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="Database only: restore the SQLite WAL archive as of this time instead of a backup",
+                null=True,
+            ),
+        ),
+    ]
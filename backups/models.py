@@ -1,23 +1,87 @@
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils.timezone import now
 
+# Stage that does the main work of each job, its throughput is shown in the admin
+MAIN_STAGES = ('dump', 'archive', 'restore', 'extract')
 
-class Backup(models.Model):
+JOB_STATUS_CHOICES = [
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+]
+
+
+def split_lines(text):
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+class JobMixin:
+    def get_duration(self):
+        if self.started_at and self.finished_at:
+            return self.finished_at - self.started_at
+        return None
+
+    def get_include_tables(self):
+        return split_lines(self.include_tables)
+
+    def get_exclude_tables(self):
+        return split_lines(self.exclude_tables)
+
+    def get_main_stage(self):
+        stages = (self.stats or {}).get('stages', {})
+        for stage in MAIN_STAGES:
+            if stage in stages:
+                return stages[stage]
+        return {}
+
+
+class Backup(JobMixin, models.Model):
     BACKUP_TYPE_CHOICES = [
         ('database', 'Database Backup'),
         ('media', 'Media Backup'),
     ]
+    BACKUP_KIND_CHOICES = [
+        ('full', 'Full'),
+        ('incremental', 'Incremental'),
+    ]
 
     type = models.CharField(max_length=10, choices=BACKUP_TYPE_CHOICES)
+    kind = models.CharField(max_length=12, choices=BACKUP_KIND_CHOICES, default='full')
+    parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.PROTECT, related_name='children')
+    include_tables = models.TextField(blank=True, help_text='Database only: tables to back up, one per line. '
+                                                         'Leave empty for every table.')
+    exclude_tables = models.TextField(blank=True, help_text='Database only: tables to leave out, one per line.')
     file = models.FileField(upload_to='backups/')
+    # Bytes on disk, see backups.retention.get_backup_size
+    size = models.BigIntegerField(null=True, blank=True)
+    # SHA-256 of the backup file, recorded while it is written and checked by verify_backups
+    checksum = models.CharField(max_length=64, blank=True)
+    verified_at = models.DateTimeField(null=True, blank=True)
+    verify_error = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(User, on_delete=models.PROTECT)
+    status = models.CharField(max_length=10, choices=JOB_STATUS_CHOICES, default='queued')
+    error = models.TextField(blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Per stage timings and counters, see backups.instrumentation.Stats
+    stats = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return f"{self.get_type_display()} Backup - {self.created_at}"
 
+    def get_chain(self):
+        # Backups to restore in order: the full backup this one builds on, then each incremental
+        chain = [self]
+        while chain[0].parent_id is not None:
+            chain.insert(0, chain[0].parent)
+        return chain
 
-class Restore(models.Model):
+
+class Restore(JobMixin, models.Model):
     RESTORE_TYPE_CHOICES = [
         ('database', 'Database Restore'),
         ('media', 'Media Restore'),
@@ -25,8 +89,79 @@ class Restore(models.Model):
 
     type = models.CharField(max_length=10, choices=RESTORE_TYPE_CHOICES)
     restored_at = models.DateTimeField(auto_now_add=True)
-    file = models.FileField(upload_to='backups/')
+    file = models.FileField(upload_to='backups/', blank=True)
+    backup = models.ForeignKey(Backup, null=True, blank=True, on_delete=models.SET_NULL,
+                               help_text='Restore this backup and its incremental chain instead of an uploaded file')
+    point_in_time = models.DateTimeField(null=True, blank=True,
+                                         help_text='Database only: restore the SQLite WAL archive as of this time '
+                                                   'instead of a backup')
+    paths = models.TextField(blank=True,
+                             help_text='Media only: path prefixes or globs to restore, one per line. '
+                                       'Leave empty to restore everything.')
+    include_tables = models.TextField(blank=True, help_text='Database only: tables to restore, one per line. '
+                                                         'Leave empty for every table.')
+    exclude_tables = models.TextField(blank=True, help_text='Database only: tables to leave out, one per line.')
     restored_by = models.ForeignKey(User, on_delete=models.PROTECT)
+    status = models.CharField(max_length=10, choices=JOB_STATUS_CHOICES, default='queued')
+    error = models.TextField(blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Per stage timings and counters, see backups.instrumentation.Stats
+    stats = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return f"{self.get_type_display()} Restore - {self.restored_at}"
+
+    def clean(self):
+        # Database restores need exactly one source. Media restores without one
+        # fall back to the media_backup.zip older versions wrote.
+        if self.point_in_time is not None and self.type != 'database':
+            raise ValidationError({'point_in_time': 'Only database restores can restore to a point in time.'})
+        sources = [source for source in (self.file, self.backup_id, self.point_in_time) if source]
+        if len(sources) > 1:
+            raise ValidationError('Pick only one of a file, a backup or a point in time to restore.')
+        if not sources and self.type == 'database':
+            raise ValidationError('Upload a file, pick a backup or a point in time to restore.')
+        if self.backup_id:
+            if self.backup.type != self.type:
+                raise ValidationError({'backup': f'Pick a {self.type} backup for a {self.type} restore.'})
+            if self.backup.status != 'done':
+                raise ValidationError({'backup': 'Only finished backups can be restored.'})
+
+    def get_paths(self):
+        return split_lines(self.paths)
+
+
+class Schedule(models.Model):
+    # Backups queued by the run_scheduler management command
+    name = models.CharField(max_length=100)
+    type = models.CharField(max_length=10, choices=Backup.BACKUP_TYPE_CHOICES)
+    kind = models.CharField(max_length=12, choices=Backup.BACKUP_KIND_CHOICES, default='full')
+    cron = models.CharField(max_length=100, help_text="minute hour day-of-month month day-of-week, e.g. '30 2 * * *'")
+    jitter = models.PositiveIntegerField(default=0, help_text='Delay each run by up to this many random seconds')
+    enabled = models.BooleanField(default=True)
+    last_run_at = models.DateTimeField(null=True, blank=True)
+    next_run_at = models.DateTimeField(null=True, blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.PROTECT)
+
+    def __str__(self):
+        return f"{self.name} ({self.cron})"
+
+    def clean(self):
+        from backups.scheduler import CronExpression
+
+        try:
+            # Expressions that parse can still never match, e.g. '0 0 31 2 *'
+            CronExpression(self.cron).next_after(now())
+        except Exception as e:
+            raise ValidationError({'cron': str(e)})
+
+
+class JobLock(models.Model):
+    # A row per held lock, see backups.jobs.acquire_lock
+    name = models.CharField(max_length=100, primary_key=True)
+    owner = models.CharField(max_length=200)
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name} held by {self.owner}"
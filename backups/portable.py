@@ -0,0 +1,226 @@
+import base64
+import json
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from uuid import UUID
+
+from django.apps import apps
+from django.conf import settings
+
+# Extension of backups in the portable format, restorable into any supported engine
+PORTABLE_EXTENSION = 'portable.tar'
+PORTABLE_VERSION = 1
+
+# Django field types grouped by how their values are written in portable backups
+FIELD_TYPES = {
+    'integer': ('AutoField', 'BigAutoField', 'SmallAutoField', 'IntegerField', 'BigIntegerField', 'SmallIntegerField',
+                'PositiveIntegerField', 'PositiveBigIntegerField', 'PositiveSmallIntegerField'),
+    'float': ('FloatField',),
+    'decimal': ('DecimalField',),
+    'boolean': ('BooleanField', 'NullBooleanField'),
+    'binary': ('BinaryField',),
+    'date': ('DateField',),
+    'time': ('TimeField',),
+    'datetime': ('DateTimeField',),
+    'duration': ('DurationField',),
+    'uuid': ('UUIDField',),
+    'json': ('JSONField',),
+}
+PORTABLE_TYPES = {field_type: portable_type for portable_type, field_types in FIELD_TYPES.items()
+                  for field_type in field_types}
+
+
+def is_portable_backup(backup_file):
+    return str(backup_file.name).endswith(f'.{PORTABLE_EXTENSION}')
+
+
+def get_portable_type(field_type):
+    # Text-like fields (CharField, EmailField, ...) and anything unknown keep their value as is
+    return PORTABLE_TYPES.get(field_type, 'text')
+
+
+def get_table_columns(connection, cursor, table_name):
+    """
+    (column, portable type) of every column of a table. Types come from the
+    Django model using the table, or from introspection for other tables, so
+    they mean the same whichever engine wrote or reads the backup.
+    """
+    fields = {}
+    for model in apps.get_models(include_auto_created=True):
+        if model._meta.db_table == table_name:
+            for field in model._meta.local_concrete_fields:
+                target = field
+                # A foreign key column holds values of the field it points to
+                while target.is_relation:
+                    target = target.target_field
+                fields[field.column] = target.get_internal_type()
+    columns = []
+    for description in connection.introspection.get_table_description(cursor, table_name):
+        field_type = fields.get(description.name)
+        if field_type is None:
+            try:
+                field_type = connection.introspection.get_field_type(description.type_code, description)
+            except KeyError:
+                field_type = 'TextField'
+        columns.append((description.name, get_portable_type(field_type)))
+    return columns
+
+
+def encode_value(portable_type, value):
+    """
+    Turn a value as the database driver returned it into its JSON form. Every
+    engine stores some types differently (SQLite keeps booleans as integers,
+    datetimes, decimals and UUIDs as text, durations as microseconds), the
+    portable form is the same for all of them.
+    """
+    if value is None:
+        return None
+    if portable_type == 'integer':
+        return int(value)
+    if portable_type == 'float':
+        return float(value)
+    if portable_type == 'boolean':
+        return bool(value)
+    if portable_type == 'decimal':
+        return str(value)
+    if portable_type == 'text':
+        # SQLite columns may hold numbers whatever their declared type, those stay numbers
+        return value if isinstance(value, (str, int, float)) else str(value)
+    if portable_type == 'binary':
+        return base64.b64encode(bytes(value)).decode()
+    if portable_type == 'uuid':
+        return str(value if isinstance(value, UUID) else UUID(str(value)))
+    if portable_type == 'duration':
+        return value // timedelta(microseconds=1) if isinstance(value, timedelta) else int(value)
+    if portable_type == 'json':
+        return value if isinstance(value, str) else json.dumps(value)
+    if portable_type == 'datetime':
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        # Naive datetimes are stored in UTC when USE_TZ is on
+        if settings.USE_TZ and value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        elif value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        return value.isoformat()
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return value
+
+
+def decode_value(portable_type, value):
+    # The Python value of a portable JSON value
+    if value is None:
+        return None
+    if portable_type == 'binary':
+        return base64.b64decode(value)
+    if portable_type == 'decimal':
+        return Decimal(value)
+    if portable_type == 'uuid':
+        return UUID(value)
+    if portable_type == 'duration':
+        return timedelta(microseconds=value)
+    if portable_type == 'datetime':
+        return datetime.fromisoformat(value)
+    if portable_type == 'date':
+        return date.fromisoformat(value)
+    if portable_type == 'time':
+        return time.fromisoformat(value)
+    return value
+
+
+def adapt_value(connection, portable_type, value):
+    # The Python value of a column of portable_type in the database behind connection
+    if value is None:
+        return None
+    if portable_type == 'boolean':
+        return bool(value)
+    if portable_type == 'datetime':
+        return connection.ops.adapt_datetimefield_value(value)
+    if portable_type == 'date':
+        return connection.ops.adapt_datefield_value(value)
+    if portable_type == 'time':
+        return connection.ops.adapt_timefield_value(value)
+    if portable_type == 'uuid':
+        return value if connection.features.has_native_uuid_field else value.hex
+    if portable_type == 'duration':
+        return value if connection.features.has_native_duration_field else value // timedelta(microseconds=1)
+    return value
+
+
+def iter_table_rows(connection, cursor, table_name, columns, fetch_size=2000):
+    # Rows of a table in their portable JSON form, one line each
+    types = [portable_type for _, portable_type in columns]
+    names = ', '.join(connection.ops.quote_name(column) for column, _ in columns)
+    cursor.execute(f'SELECT {names} FROM {connection.ops.quote_name(table_name)}')
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield json.dumps([encode_value(portable_type, value) for portable_type, value in zip(types, row)],
+                             separators=(',', ':')) + '\n'
+
+
+def iter_lines(file_obj, chunk_size=1024 * 1024):
+    # Lines of a decompressed table file, JSON escapes every newline inside values
+    pending = b''
+    while True:
+        chunk = file_obj.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+
+def iter_load_rows(lines, source_columns, target_columns, connection):
+    """
+    Rows of a portable table file ready to insert into target_columns of the
+    live database. Columns the backup has but the live table doesn't are
+    dropped, columns only the live table has are left to their defaults.
+    """
+    positions = {column: index for index, (column, _) in enumerate(source_columns)}
+    source_types = dict(source_columns)
+    picks = [(positions[column], source_types[column], target_type) for column, target_type in target_columns]
+    for line in lines:
+        values = json.loads(line)
+        yield [adapt_value(connection, target_type, decode_value(source_type, values[position]))
+               for position, source_type, target_type in picks]
+
+
+def copy_text(value):
+    # A value in PostgreSQL's COPY text format
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # bytea's \x hex form, with the backslash escaped for COPY
+        return '\\\\x' + bytes(value).hex()
+    if isinstance(value, timedelta):
+        return f'{value.days} days {value.seconds} seconds {value.microseconds} microseconds'
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+
+
+class CopyRowsFile:
+    # Readable file of rows in COPY text format, produced as COPY FROM STDIN reads it
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.buffer += '\t'.join(copy_text(value) for value in row) + '\n'
+            self.count += 1
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
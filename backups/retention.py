@@ -0,0 +1,216 @@
+import json
+import os
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.timezone import localtime
+
+from backups.db_connectors import get_manifest_path
+from backups.media_store import MediaStore
+from backups.models import Backup, Restore
+from backups.storage import delete_mirrors
+
+# Period name: function giving the bucket a backup falls into
+RETENTION_PERIODS = {
+    'hourly': lambda date: (date.year, date.month, date.day, date.hour),
+    'daily': lambda date: (date.year, date.month, date.day),
+    'weekly': lambda date: date.isocalendar()[:2],
+    'monthly': lambda date: (date.year, date.month),
+    'yearly': lambda date: date.year,
+}
+# Chunks younger than this are never collected, a running media backup may not have written its manifest yet
+CHUNK_GRACE_SECONDS = 60 * 60
+
+
+def get_backup_size(backup, stats=None):
+    """
+    Bytes on disk owned by a backup: its file, the manifest stored next to
+    database backups and, for media store backups, the chunks it added.
+    """
+    size = 0
+    for path in (backup.file.path, get_manifest_path(backup.file.path)):
+        if os.path.exists(path):
+            size += os.path.getsize(path)
+    if stats is not None and backup.type == 'media':
+        size += stats.stages.get('archive', {}).get('stored_bytes', 0)
+    return size
+
+
+def get_retention_policy():
+    # e.g. {'hourly': 24, 'daily': 7, 'weekly': 4}, None keeps every backup
+    return getattr(settings, 'BACKUP_RETENTION', None)
+
+
+def get_max_bytes():
+    return getattr(settings, 'BACKUP_MAX_BYTES', None)
+
+
+def select_gfs(backups, policy):
+    # backups are newest first. Each period keeps the newest backup of its
+    # last N buckets, a backup can count for several periods.
+    keep = set()
+    for period, count in policy.items():
+        if period not in RETENTION_PERIODS:
+            raise Exception(f"Unknown retention period '{period}', use one of {', '.join(RETENTION_PERIODS)}")
+        buckets = set()
+        for backup in backups:
+            if len(buckets) >= count:
+                break
+            bucket = RETENTION_PERIODS[period](localtime(backup.created_at))
+            if bucket not in buckets:
+                buckets.add(bucket)
+                keep.add(backup.pk)
+    return keep
+
+
+def add_chains(keep, backups_by_pk):
+    # An incremental backup is useless without the backups it builds on
+    for pk in list(keep):
+        backup = backups_by_pk[pk]
+        while backup.parent_id is not None and backup.parent_id in backups_by_pk:
+            keep.add(backup.parent_id)
+            backup = backups_by_pk[backup.parent_id]
+    return keep
+
+
+def get_descendants(pk, children):
+    descendants = {pk}
+    stack = [pk]
+    while stack:
+        for child in children.get(stack.pop(), ()):
+            if child not in descendants:
+                descendants.add(child)
+                stack.append(child)
+    return descendants
+
+
+def apply_budget(keep, backups, max_bytes):
+    # Drops the oldest kept backups, each together with the incrementals built
+    # on it, until the kept ones fit in max_bytes. The newest backup always stays.
+    children = {}
+    for backup in backups:
+        if backup.parent_id is not None:
+            children.setdefault(backup.parent_id, []).append(backup.pk)
+    sizes = {backup.pk: backup.size or 0 for backup in backups}
+    total = sum(sizes[pk] for pk in keep)
+    newest = backups[0].pk
+    for backup in reversed(backups):
+        if total <= max_bytes:
+            break
+        if backup.pk not in keep:
+            continue
+        dropped = get_descendants(backup.pk, children) & keep
+        if newest in dropped:
+            continue
+        keep -= dropped
+        total -= sum(sizes[pk] for pk in dropped)
+    return keep
+
+
+def plan_prune(policy=None, max_bytes=None):
+    """
+    Return the finished backups to delete, children before their parents.
+
+    Every backup type is handled on its own. Backups kept by the policy pull
+    in the full and incremental backups they build on, backups used by queued
+    or running restores are never deleted.
+    """
+    policy = get_retention_policy() if policy is None else policy
+    max_bytes = get_max_bytes() if max_bytes is None else max_bytes
+    if not policy and not max_bytes:
+        return []
+
+    in_use = set(Restore.objects.filter(status__in=['queued', 'running'], backup__isnull=False)
+                 .values_list('backup_id', flat=True))
+    to_delete = []
+    for backup_type, _ in Backup.BACKUP_TYPE_CHOICES:
+        backups = list(Backup.objects.filter(type=backup_type, status='done').order_by('-created_at', '-pk'))
+        if not backups:
+            continue
+        backups_by_pk = {backup.pk: backup for backup in backups}
+        if policy:
+            keep = select_gfs(backups, policy)
+        else:
+            keep = set(backups_by_pk)
+        # The newest backup is always kept, whatever the policy says
+        keep.add(backups[0].pk)
+        add_chains(keep, backups_by_pk)
+        if max_bytes:
+            apply_budget(keep, backups, max_bytes)
+        keep |= in_use & set(backups_by_pk)
+        add_chains(keep, backups_by_pk)
+        to_delete += [backup for backup in backups if backup.pk not in keep]
+    return to_delete
+
+
+def delete_backup(backup):
+    # The row goes first, files are only removed once nothing can point at them anymore
+    with transaction.atomic():
+        # Failed or unfinished incrementals built on the backup restore nothing, they let go of it
+        Backup.objects.filter(parent=backup).exclude(status='done').update(parent=None)
+        backup.delete()
+        shared = bool(backup.file) and Backup.objects.filter(file=backup.file.name).exists()
+    # A file still used by another row stays
+    if backup.file and not shared:
+        manifest_path = get_manifest_path(backup.file.path)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+            delete_mirrors(manifest_path)
+        delete_mirrors(backup.file.path)
+        backup.file.delete(save=False)
+
+
+def collect_media_chunks(store=None, dry_run=False):
+    """
+    Delete chunks of the media store that no manifest and no index entry
+    refers to. Returns the number of chunks and bytes freed.
+    """
+    store = store or MediaStore()
+    if not store.objects_dir.exists():
+        return 0, 0
+    referenced = set()
+    for entry in store.load_index().values():
+        referenced.update(entry['chunks'])
+    manifest_dir = store.root / 'manifests'
+    if manifest_dir.exists():
+        for manifest_path in manifest_dir.glob('*.json'):
+            with open(manifest_path) as f:
+                for entry in json.load(f)['files']:
+                    referenced.update(entry['chunks'])
+
+    chunks = size = 0
+    cutoff = time.time() - CHUNK_GRACE_SECONDS
+    for path in store.objects_dir.glob('*/*'):
+        if path.name in referenced:
+            continue
+        file_stat = path.stat()
+        if file_stat.st_mtime > cutoff:
+            continue
+        chunks += 1
+        size += file_stat.st_size
+        if not dry_run:
+            path.unlink()
+            delete_mirrors(path, store.storages)
+    return chunks, size
+
+
+def prune_backups(policy=None, max_bytes=None, dry_run=False):
+    """
+    Apply BACKUP_RETENTION and BACKUP_MAX_BYTES: delete the backups they
+    don't keep, then the media chunks nothing refers to anymore. Returns the
+    deleted (or, with dry_run, deletable) backups and the bytes they freed.
+    """
+    to_delete = plan_prune(policy, max_bytes)
+    freed = sum(backup.size or 0 for backup in to_delete)
+    if dry_run:
+        return to_delete, freed
+
+    for backup in to_delete:
+        print(f'Deleting {backup}')
+        delete_backup(backup)
+    if any(backup.type == 'media' for backup in to_delete):
+        # Sizes of media backups already include the chunks they added
+        chunks, chunk_bytes = collect_media_chunks()
+        print(f'Deleted {chunks} unreferenced media chunks ({chunk_bytes} bytes)')
+    return to_delete, freed
@@ -0,0 +1,133 @@
+import random
+from datetime import timedelta
+
+from django.utils.timezone import localtime, make_aware, now
+
+from backups import jobs
+from backups.models import Backup, Schedule
+
+# (name, lowest value, highest value) of the five cron fields
+CRON_FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day of month', 1, 31),
+    ('month', 1, 12),
+    ('day of week', 0, 7),
+)
+# A schedule that can't match within this many days (e.g. '0 0 31 2 *') is rejected
+MAX_SEARCH_DAYS = 366 * 5
+
+
+class CronExpression:
+    """
+    Five field cron expression: minute hour day-of-month month day-of-week.
+
+    Fields accept '*', numbers, ranges ('1-5'), steps ('*/15', '0-30/10') and
+    comma separated lists of those. Sunday is 0 or 7. As in cron, when both
+    day fields are restricted a day matching either of them matches.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        parts = expression.split()
+        if len(parts) != len(CRON_FIELDS):
+            raise Exception(f"Cron expression '{expression}' needs {len(CRON_FIELDS)} fields")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self.parse_field(part, name, low, high) for part, (name, low, high) in zip(parts, CRON_FIELDS)
+        )
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    @staticmethod
+    def parse_field(field, name, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (int(value) for value in part.split('-', 1))
+            else:
+                start = end = int(part)
+                if step != 1:
+                    end = high
+            if step < 1 or start < low or end > high or start > end:
+                raise Exception(f"Invalid {name} '{field}', values go from {low} to {high}")
+            values.update(range(start, end + 1, step))
+        if name == 'day of week' and 7 in values:
+            # 7 is Sunday like 0
+            values = (values - {7}) | {0}
+        return values
+
+    def match_day(self, date):
+        day_matches = date.day in self.days
+        # weekday() is 0 for Monday, cron counts from Sunday
+        weekday_matches = (date.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_matches and weekday_matches
+        return day_matches or weekday_matches
+
+    def next_after(self, after):
+        # The first matching minute after the given aware datetime, in the local time zone
+        date = localtime(after).replace(tzinfo=None, second=0, microsecond=0) + timedelta(minutes=1)
+        limit = date + timedelta(days=MAX_SEARCH_DAYS)
+        while date < limit:
+            if date.month not in self.months:
+                date = (date.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.match_day(date):
+                date = date.replace(hour=0, minute=0) + timedelta(days=1)
+            elif date.hour not in self.hours:
+                date = date.replace(minute=0) + timedelta(hours=1)
+            elif date.minute not in self.minutes:
+                date += timedelta(minutes=1)
+            else:
+                return make_aware(date)
+        raise Exception(f"Cron expression '{self.expression}' never matches")
+
+
+def get_next_run(schedule, after=None):
+    next_run = CronExpression(schedule.cron).next_after(after or now())
+    if schedule.jitter:
+        # Spreads schedules sharing a cron expression so they don't all start at once
+        next_run += timedelta(seconds=random.randint(0, schedule.jitter))
+    return next_run
+
+
+def run_due_schedules():
+    """
+    Queue a backup for every enabled schedule whose next run has come.
+
+    Runs missed while the scheduler was down are collapsed into one, and a
+    schedule is skipped while a backup of the same type is still queued or
+    running so runs never pile up. Jobs left behind by a dead worker are
+    failed first, so they don't hold schedules back. Returns the queued backups.
+    """
+    jobs.fail_stale_jobs()
+    queued = []
+    current_time = now()
+    for schedule in Schedule.objects.filter(enabled=True):
+        if schedule.next_run_at is None:
+            schedule.next_run_at = get_next_run(schedule, current_time)
+            schedule.save(update_fields=['next_run_at'])
+            continue
+        if schedule.next_run_at > current_time:
+            continue
+
+        # Claim this run, another scheduler that read the same row loses the update
+        next_run = get_next_run(schedule, current_time)
+        claimed = Schedule.objects.filter(pk=schedule.pk, next_run_at=schedule.next_run_at) \
+            .update(next_run_at=next_run, last_run_at=current_time)
+        if not claimed:
+            continue
+
+        if Backup.objects.filter(type=schedule.type, status__in=['queued', 'running']).exists():
+            print(f'Skipping {schedule}, a {schedule.type} backup is still queued or running')
+            continue
+        backup = Backup.objects.create(type=schedule.type, kind=schedule.kind, created_by=schedule.created_by,
+                                       status='queued')
+        jobs.enqueue(backup)
+        queued.append(backup)
+    return queued
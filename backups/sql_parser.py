@@ -0,0 +1,255 @@
+import codecs
+import re
+
+# Characters that can change the tokenizer state outside of a quoted section
+SPECIAL_CHARS = re.compile(r"[;'\"$/-]")
+DOLLAR_TAG = re.compile(r"\$(?:[A-Za-z_][A-Za-z_0-9]*)?\$")
+DOLLAR_NAME = re.compile(r"\$[A-Za-z_0-9]*")
+IDENTIFIER_CHAR = re.compile(r"[A-Za-z_0-9]")
+COPY_FROM_STDIN = re.compile(r"^COPY\s.+\sFROM\s+stdin\b", re.IGNORECASE | re.DOTALL)
+COPY_END_MARKER = '\\.'
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def iter_chunks(file_obj, chunk_size=DEFAULT_CHUNK_SIZE, encoding='utf-8'):
+    # Read the file in fixed size chunks, decoding bytes incrementally so
+    # multi-byte characters split across chunks are handled
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while True:
+        chunk = file_obj.read(chunk_size)
+        if not chunk:
+            break
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        if chunk:
+            yield chunk
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def search_special_chars(text, pos):
+    match = SPECIAL_CHARS.search(text, pos)
+    return -1 if match is None else match.start()
+
+
+class CopyStatement(str):
+    """
+    A ``COPY ... FROM stdin`` statement. ``data`` is a file-like object over the
+    rows that follow it in the dump, to be passed to ``cursor.copy_expert``.
+    """
+    data = None
+
+
+class CopyData:
+    def __init__(self, reader):
+        self.reader = reader
+        self.done = False
+        self.skip_line = True
+        # Rows read so far, COPY's text format has one per line
+        self.rows = 0
+
+    def readline(self):
+        if self.done:
+            return ''
+        reader = self.reader
+        end = reader.find('\n', reader.pos)
+        line = reader.buf[reader.pos:] if end == -1 else reader.buf[reader.pos:end + 1]
+        reader.start = reader.pos = reader.pos + len(line)
+        if self.skip_line:
+            # Rest of the line holding the COPY statement itself
+            self.skip_line = False
+            return self.readline()
+        if not line or line.rstrip('\r\n') == COPY_END_MARKER:
+            self.done = True
+            return ''
+        self.rows += 1
+        return line
+
+    def read(self, size=-1):
+        lines = []
+        length = 0
+        while size < 0 or length < size:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            length += len(line)
+        return ''.join(lines)
+
+    def drain(self):
+        while self.readline():
+            pass
+
+
+class SpooledCopyData:
+    """
+    The rows of a ``CopyData``, written to ``spool`` as they are read so a
+    COPY that fails can be replayed row by row afterwards.
+    """
+
+    def __init__(self, data, spool):
+        self.data = data
+        self.spool = spool
+
+    def readline(self):
+        line = self.data.readline()
+        self.spool.write(line)
+        return line
+
+    def read(self, size=-1):
+        data = self.data.read(size)
+        self.spool.write(data)
+        return data
+
+    def drain(self):
+        while self.readline():
+            pass
+
+
+class StatementReader:
+    """
+    Split a SQL dump into complete statements while reading it chunk by chunk.
+
+    Statements end on ';' outside of quoted strings, quoted identifiers,
+    dollar-quoted bodies and comments. Comments are dropped and the terminating
+    ';' is not part of the yielded statement, so memory is bounded by the
+    largest single statement instead of the dump size. ``COPY ... FROM stdin``
+    statements are yielded as ``CopyStatement`` with their rows streamed.
+    """
+
+    def __init__(self, file_obj, chunk_size=DEFAULT_CHUNK_SIZE, encoding='utf-8'):
+        self.chunks = iter_chunks(file_obj, chunk_size, encoding)
+        self.buf = ''
+        # Start of the statement being scanned and the scan position in buf
+        self.start = 0
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        # Drop the already yielded text and append the next chunk. Returns the
+        # number of characters the buffer shifted by, or None at end of file.
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return None
+        shift = self.start
+        self.buf = self.buf[shift:] + chunk
+        self.start = 0
+        self.pos -= shift
+        return shift
+
+    def find(self, token, start):
+        # Find token in the buffer, pulling in more data until it shows up
+        return self.search(lambda text, pos: text.find(token, pos), start, len(token) - 1)
+
+    def search(self, search, start, overlap):
+        """
+        Index of the first match of search(text, pos) in the buffer from
+        start, -1 at end of file. Chunks read while looking are searched on
+        their own, along with the overlap characters before them a match may
+        start in, and joined into the buffer once. A statement spanning many
+        chunks is copied a constant number of times instead of once per chunk.
+        """
+        end = search(self.buf, start)
+        if end != -1:
+            return end
+        pending = []
+        length = len(self.buf)
+        tail = self.buf[max(start, length - overlap):]
+        while True:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.eof = True
+                break
+            pending.append(chunk)
+            window = tail + chunk
+            end = search(window, 0)
+            if end != -1:
+                end += length - len(tail)
+                break
+            length += len(chunk)
+            tail = window[max(len(window) - overlap, 0):] if overlap else ''
+
+        shift = self.start
+        self.buf = ''.join([self.buf[shift:], *pending])
+        self.start = 0
+        self.pos -= shift
+        return end - shift if end != -1 else -1
+
+    def __iter__(self):
+        while True:
+            pos = self.search(search_special_chars, self.pos, 0)
+            if pos == -1:
+                self.pos = len(self.buf)
+                break
+
+            self.pos = pos
+            char = self.buf[pos]
+
+            # Two character tokens need a lookahead, make sure it is loaded
+            if char in '-/$' and pos + 1 >= len(self.buf) and not self.eof:
+                self.read_more()
+                continue
+
+            if char == ';':
+                statement = self.buf[self.start:pos].strip()
+                self.start = self.pos = pos + 1
+                if COPY_FROM_STDIN.match(statement):
+                    statement = CopyStatement(statement)
+                    statement.data = CopyData(self)
+                    yield statement
+                    # Skip whatever rows the consumer did not read
+                    statement.data.drain()
+                elif statement:
+                    yield statement
+            elif char in '\'"':
+                end = self.find(char, pos + 1)
+                if end == -1:
+                    break
+                self.pos = end + 1
+            elif char == '-' and self.buf.startswith('--', pos):
+                end = self.find('\n', self.pos + 2)
+                if end == -1:
+                    self.buf = self.buf[:self.pos]
+                    break
+                self.buf = self.buf[:self.pos] + self.buf[end:]
+            elif char == '/' and self.buf.startswith('/*', pos):
+                end = self.find('*/', self.pos + 2)
+                if end == -1:
+                    self.buf = self.buf[:self.pos]
+                    break
+                self.buf = self.buf[:self.pos] + ' ' + self.buf[end + 2:]
+            elif char == '$' and (pos == 0 or not IDENTIFIER_CHAR.match(self.buf[pos - 1])):
+                tag = self.match_dollar_tag()
+                if tag is None:
+                    self.pos += 1
+                    continue
+                end = self.find(tag, self.pos + len(tag))
+                if end == -1:
+                    break
+                self.pos = end + len(tag)
+            else:
+                self.pos += 1
+
+        statement = self.buf[self.start:].strip()
+        self.buf = ''
+        if statement:
+            yield statement
+
+    def match_dollar_tag(self):
+        # A dollar quote tag like $$ or $body$ may itself be split across chunks
+        while True:
+            tag = DOLLAR_TAG.match(self.buf, self.pos)
+            if tag is not None:
+                return tag.group()
+            name = DOLLAR_NAME.match(self.buf, self.pos)
+            if name.end() < len(self.buf) or self.read_more() is None:
+                return None
+
+
+def iter_statements(file_obj, chunk_size=DEFAULT_CHUNK_SIZE, encoding='utf-8'):
+    return iter(StatementReader(file_obj, chunk_size, encoding))
@@ -0,0 +1,309 @@
+import hashlib
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from backups.file_io import copy_range, open_mapped
+
+# Bytes hashed per update, hashlib releases the GIL for each of them
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def get_storages():
+    """
+    Offsite storages backups are copied to while they are written, built from
+    BACKUP_STORAGES: [{'BACKEND': 'backups.storage.S3Storage', 'OPTIONS': {...}}].
+    The local copy under MEDIA_ROOT is always kept, restores read it.
+    """
+    return [import_string(storage['BACKEND'])(**storage.get('OPTIONS', {}))
+            for storage in getattr(settings, 'BACKUP_STORAGES', [])]
+
+
+def get_storage_name(path):
+    # Backups keep the path they have under MEDIA_ROOT on every storage
+    return os.path.relpath(path, settings.MEDIA_ROOT).replace('\\', '/')
+
+
+class LocalStorage:
+    """
+    Copies backups into another directory, e.g. a mounted network share.
+    Files are written as <name>.part and renamed once complete, an
+    interrupted upload_file continues from the end of its .part file.
+    """
+
+    def __init__(self, location):
+        self.location = location
+
+    def path(self, name):
+        return os.path.join(self.location, name)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def size(self, name):
+        return os.path.getsize(self.path(name)) if self.exists(name) else None
+
+    def delete(self, name):
+        if self.exists(name):
+            os.remove(self.path(name))
+
+    def open_upload(self, name):
+        return LocalUpload(self.path(name))
+
+    def upload_file(self, path, name):
+        upload = LocalUpload(self.path(name), resume=True)
+        with open(path, 'rb') as f:
+            # Copied in the kernel from where the .part file ends
+            upload.size += copy_range(f.fileno(), upload.file_obj.fileno(), upload.size,
+                                      os.fstat(f.fileno()).st_size - upload.size)
+        upload.close()
+        upload.complete()
+
+
+class LocalUpload:
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.part_path = f'{path}.part'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Resumed uploads continue at the end of the .part file. It isn't opened for appending,
+        # copy_file_range() can't write to such files.
+        self.file_obj = open(self.part_path, 'r+b' if resume and os.path.exists(self.part_path) else 'wb')
+        self.size = self.file_obj.seek(0, os.SEEK_END)
+
+    def write(self, data):
+        self.size += len(data)
+        return self.file_obj.write(data)
+
+    def close(self):
+        self.file_obj.close()
+
+    def complete(self):
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        self.file_obj.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+
+class S3Storage:
+    """
+    S3 compatible object storage (AWS, MinIO, ...), needs the boto3 package.
+
+    Data is sent as a multipart upload whose parts are uploaded by a thread
+    pool while the backup is still being written. upload_file resumes an
+    unfinished multipart upload of the same key, re-sending only parts that
+    are missing or whose MD5 doesn't match.
+    """
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, access_key=None, secret_key=None, region=None,
+                 part_size=64 * 1024 * 1024, workers=4):
+        if boto3 is None:
+            raise Exception("The 'boto3' package is required for the S3 backup storage.")
+        self.bucket = bucket
+        self.prefix = prefix
+        # S3 parts are at least 5 MiB, except the last one
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.workers = workers
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, aws_access_key_id=access_key,
+                                   aws_secret_access_key=secret_key, region_name=region)
+
+    def key(self, name):
+        return f'{self.prefix}{name}'
+
+    def exists(self, name):
+        return self.size(name) is not None
+
+    def size(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))['ContentLength']
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def open_upload(self, name):
+        return S3Upload(self, self.key(name))
+
+    def find_upload(self, key):
+        # Id and uploaded parts of the newest unfinished multipart upload of key
+        uploads = [upload for upload in self.client.list_multipart_uploads(Bucket=self.bucket, Prefix=key)
+                   .get('Uploads', []) if upload['Key'] == key]
+        if not uploads:
+            return None, {}
+        upload_id = max(uploads, key=lambda upload: upload['Initiated'])['UploadId']
+        parts = {}
+        marker = 0
+        while True:
+            response = self.client.list_parts(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                              PartNumberMarker=marker)
+            for part in response.get('Parts', []):
+                parts[part['PartNumber']] = part
+            if not response.get('IsTruncated'):
+                return upload_id, parts
+            marker = response['NextPartNumberMarker']
+
+    def upload_file(self, path, name):
+        key = self.key(name)
+        size = os.path.getsize(path)
+        if size <= self.part_size:
+            with open(path, 'rb') as f:
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=f)
+            return
+
+        upload_id, uploaded = self.find_upload(key)
+        if upload_id is None:
+            upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+        else:
+            print(f'Resuming upload of {key}, {len(uploaded)} parts already uploaded')
+
+        def upload_part(part_number):
+            with open(path, 'rb') as f:
+                f.seek((part_number - 1) * self.part_size)
+                data = f.read(self.part_size)
+            etag = f'"{hashlib.md5(data).hexdigest()}"'
+            part = uploaded.get(part_number)
+            if part is not None and part['Size'] == len(data) and part['ETag'] == etag:
+                return {'PartNumber': part_number, 'ETag': etag}
+            response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                               PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+        part_count = (size + self.part_size - 1) // self.part_size
+        with ThreadPoolExecutor(self.workers) as pool:
+            parts = list(pool.map(upload_part, range(1, part_count + 1)))
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                              MultipartUpload={'Parts': parts})
+
+
+class S3Upload:
+    # File-like object turning writes into parts of a multipart upload, sent in parallel
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.client = storage.client
+        self.key = key
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.pool = None
+        self.pending = deque()
+        self.parts = []
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.storage.part_size:
+            self.send_part(bytes(self.buffer[:self.storage.part_size]))
+            del self.buffer[:self.storage.part_size]
+        return len(data)
+
+    def send_part(self, data):
+        if self.upload_id is None:
+            # Only backups larger than a part become multipart uploads
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.storage.bucket,
+                                                                 Key=self.key)['UploadId']
+            self.pool = ThreadPoolExecutor(self.storage.workers)
+        part_number = len(self.parts) + len(self.pending) + 1
+        self.pending.append(self.pool.submit(self.upload_part, part_number, data))
+        # Bound the parts held in memory while waiting for their upload
+        while len(self.pending) > self.storage.workers:
+            self.parts.append(self.pending.popleft().result())
+
+    def upload_part(self, part_number, data):
+        response = self.client.upload_part(Bucket=self.storage.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=part_number, Body=data)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def close(self):
+        # Sends what is left, complete() makes the object visible
+        if self.upload_id is not None:
+            if self.buffer:
+                self.send_part(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.parts.append(self.pending.popleft().result())
+            self.pool.shutdown()
+
+    def complete(self):
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.storage.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            self.client.complete_multipart_upload(Bucket=self.storage.bucket, Key=self.key,
+                                                  UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.client.abort_multipart_upload(Bucket=self.storage.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class MirroredFile:
+    """
+    Writable file that writes to a local path and streams the same bytes to
+    every storage, so offsite copies never read the backup a second time.
+    Uploads only become visible on complete(), abort() drops them. The bytes
+    are hashed on the way through, checksum() is the file's SHA-256.
+    """
+
+    def __init__(self, path, storages=None):
+        self.name = str(path)
+        self.file_obj = open(path, 'wb')
+        self.digest = hashlib.sha256()
+        name = get_storage_name(path)
+        self.uploads = [storage.open_upload(name) for storage in (get_storages() if storages is None else storages)]
+
+    def write(self, data):
+        self.digest.update(data)
+        for upload in self.uploads:
+            upload.write(data)
+        return self.file_obj.write(data)
+
+    def checksum(self):
+        return self.digest.hexdigest()
+
+    def flush(self):
+        self.file_obj.flush()
+
+    def close(self):
+        self.file_obj.close()
+        for upload in self.uploads:
+            upload.close()
+
+    def complete(self):
+        for upload in self.uploads:
+            upload.complete()
+
+    def abort(self):
+        self.file_obj.close()
+        for upload in self.uploads:
+            upload.abort()
+
+
+def file_checksum(path):
+    # SHA-256 of a file on disk, hashed from a memory map of it. hashlib releases
+    # the GIL so several files can be hashed by threads
+    digest = hashlib.sha256()
+    with open_mapped(path) as data:
+        for start in range(0, len(data), HASH_BLOCK_SIZE):
+            digest.update(data[start:start + HASH_BLOCK_SIZE])
+    return digest.hexdigest()
+
+
+def mirror_file(path, storages=None):
+    # Copy a finished file to every storage, for outputs that can't be streamed while written
+    for storage in get_storages() if storages is None else storages:
+        storage.upload_file(path, get_storage_name(path))
+
+
+def delete_mirrors(path, storages=None):
+    for storage in get_storages() if storages is None else storages:
+        storage.delete(get_storage_name(path))
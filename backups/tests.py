@@ -1,3 +1,1594 @@
-from django.test import TestCase
+import errno
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import threading
+import zipfile
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+from uuid import UUID
 
-# Create your tests here.
+from django.contrib import admin
+from django.contrib.auth.models import Group, Permission, User
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, IntegrityError, connection
+from django.db.models import ProtectedError
+from django.db.models.fields.files import FieldFile
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils.timezone import now, override
+
+from backups import file_io, jobs
+from backups.admin import BackupBackupAdmin
+from backups.compression import (CODEC_EXTENSIONS, detect_codec, get_codec, iter_compressed, open_reader,
+                                 open_writer, zstandard)
+from backups.db_connectors import (SQLITE_MAGIC, DumpRowCounter, PostgresConnector, SqliteConnector, extract_tar,
+                                   get_db_connector, get_manifest_path, get_statement_table, read_backup_manifest,
+                                   sort_tables_by_dependencies)
+from backups.instrumentation import MeteredFile, Stats
+from backups.media_archive import ZIP_DEFLATED, ZIP_STORED, write_media_archive
+from backups.media_manager import backup_media_to_store, compress_media_file, match_media_path, restore_media
+from backups.media_store import MediaStore
+from backups.models import Backup, JobLock, Restore, Schedule
+from backups.portable import decode_value, encode_value, iter_load_rows
+from backups.retention import delete_backup, prune_backups
+from backups.scheduler import CronExpression, run_due_schedules
+from backups.sql_parser import CopyStatement, StatementReader, iter_statements
+from backups.storage import MirroredFile, S3Storage, file_checksum
+from backups.uploads import BackupUploadHandler
+from backups.verification import verify_backup, verify_backups
+from backups.wal_archive import WalArchiver, list_generations, recover_to_time
+
+
+class MediaRootMixin:
+    # Every test gets its own MEDIA_ROOT, backup files are written under it
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root, BACKUP_STORAGES=[],
+                                           BACKUP_ROOT=Path(self.media_root) / 'backups',
+                                           BACKUP_UPLOAD_DIR=os.path.join(self.media_root, 'uploads'))
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        os.makedirs(os.path.join(self.media_root, 'backups'))
+        self.user = User.objects.create(username='admin')
+
+    def create_backup(self, name, status='done', parent=None, age=0):
+        with open(os.path.join(self.media_root, 'backups', name), 'wb') as f:
+            f.write(b'backup')
+        backup = Backup.objects.create(type='database', kind='incremental' if parent else 'full', parent=parent,
+                                       file=f'backups/{name}', status=status, size=6, created_by=self.user)
+        Backup.objects.filter(pk=backup.pk).update(created_at=now() - timedelta(minutes=age))
+        backup.refresh_from_db()
+        return backup
+
+
+class RetentionTests(MediaRootMixin, TestCase):
+    def test_prune_deletes_parent_of_failed_incremental(self):
+        full = self.create_backup('full.sql', age=3)
+        failed = self.create_backup('failed.sql', status='failed', parent=full, age=2)
+        newest = self.create_backup('newest.sql', age=1)
+
+        deleted, _ = prune_backups(policy={'hourly': 1})
+
+        self.assertEqual(len(deleted), 1)
+        self.assertFalse(Backup.objects.filter(pk=full.pk).exists())
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'backups', 'full.sql')))
+        failed.refresh_from_db()
+        self.assertIsNone(failed.parent_id)
+        self.assertTrue(Backup.objects.filter(pk=newest.pk).exists())
+
+    def test_protected_backup_keeps_its_file(self):
+        full = self.create_backup('full.sql', age=2)
+        self.create_backup('incremental.sql', parent=full, age=1)
+
+        with self.assertRaises(ProtectedError):
+            delete_backup(full)
+
+        self.assertTrue(Backup.objects.filter(pk=full.pk).exists())
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, 'backups', 'full.sql')))
+
+
+class FilterStatementsTests(SimpleTestCase):
+    def test_session_settings_are_dropped(self):
+        statements = [
+            "SET statement_timeout = 0",
+            "SELECT pg_catalog.set_config('search_path', '', false)",
+            "select set_config('search_path', '', false)",
+            "SELECT pg_catalog.setval('public.auth_user_id_seq', 3, true)",
+            "INSERT INTO public.auth_user VALUES (1)",
+        ]
+        self.assertEqual(list(PostgresConnector.filter_statements(statements)), statements[3:])
+
+
+@override_settings(BACKUP_JOB_RUNNER='command')
+class SchedulerTests(MediaRootMixin, TestCase):
+    def create_schedule(self):
+        return Schedule.objects.create(name='nightly', type='database', cron='0 2 * * *',
+                                       next_run_at=now() - timedelta(minutes=1), created_by=self.user)
+
+    def test_stale_running_backup_is_failed(self):
+        stale = self.create_backup('stale.sql', status='running')
+        self.create_schedule()
+
+        queued = run_due_schedules()
+
+        self.assertEqual(len(queued), 1)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, 'failed')
+
+    def test_live_running_backup_skips_schedule(self):
+        running = self.create_backup('running.sql', status='running')
+        JobLock.objects.create(name='job-database', owner='worker', expires_at=now() + timedelta(hours=1))
+        self.create_schedule()
+
+        self.assertEqual(run_due_schedules(), [])
+        running.refresh_from_db()
+        self.assertEqual(running.status, 'running')
+
+    def test_cron_that_never_matches_is_invalid(self):
+        schedule = Schedule(name='never', type='database', cron='0 0 31 2 *', created_by=self.user)
+        with self.assertRaises(ValidationError):
+            schedule.clean()
+
+
+class CronExpressionTests(SimpleTestCase):
+    def next_after(self, expression, after):
+        with override(timezone.utc):
+            return CronExpression(expression).next_after(after)
+
+    def test_fields(self):
+        cron = CronExpression('*/15 0-6/3 1,15 * 1-5')
+        self.assertEqual(cron.minutes, {0, 15, 30, 45})
+        self.assertEqual(cron.hours, {0, 3, 6})
+        self.assertEqual(cron.days, {1, 15})
+        self.assertEqual(cron.months, set(range(1, 13)))
+        self.assertEqual(cron.weekdays, {1, 2, 3, 4, 5})
+        # Sunday is 0 or 7
+        self.assertEqual(CronExpression('0 0 * * 5-7').weekdays, {0, 5, 6})
+        self.assertEqual(CronExpression('50/5 * * * *').minutes, {50, 55})
+
+    def test_invalid_expressions(self):
+        for expression in ['* * * *', '60 * * * *', '* * 0 * *', '*/0 * * * *', '5-1 * * * *', 'a * * * *']:
+            with self.subTest(expression=expression), self.assertRaises(Exception):
+                CronExpression(expression)
+
+    def test_next_after(self):
+        after = datetime(2026, 1, 1, 10, 7, 30, tzinfo=timezone.utc)  # a Thursday
+        self.assertEqual(self.next_after('*/15 * * * *', after), datetime(2026, 1, 1, 10, 15, tzinfo=timezone.utc))
+        self.assertEqual(self.next_after('7 10 * * *', after), datetime(2026, 1, 2, 10, 7, tzinfo=timezone.utc))
+        # Restricted day of month and day of week match either one
+        self.assertEqual(self.next_after('0 0 13 * 5', after), datetime(2026, 1, 2, tzinfo=timezone.utc))
+        self.assertEqual(self.next_after('0 0 29 2 *', after), datetime(2028, 2, 29, tzinfo=timezone.utc))
+
+    def test_never_matches(self):
+        with self.assertRaisesMessage(Exception, 'never matches'):
+            self.next_after('0 0 31 2 *', now())
+
+
+class QueuedJobsTests(MediaRootMixin, TestCase):
+    def test_run_queued_jobs_runs_jobs_left_queued(self):
+        with open(os.path.join(self.media_root, 'photo.jpg'), 'wb') as f:
+            f.write(b'photo')
+        backup = Backup.objects.create(type='media', created_by=self.user, status='queued')
+
+        jobs.run_queued_jobs()
+
+        backup.refresh_from_db()
+        self.assertEqual(backup.status, 'done', backup.error)
+        self.assertIn('stages', backup.stats)
+        self.assertFalse(JobLock.objects.exists())
+
+
+class StatsTests(SimpleTestCase):
+    def test_stages_and_rates(self):
+        stats = Stats()
+        stats.add('dump', seconds=2.0, rows=100, bytes=4096)
+        stats.add('dump', rows=100, chunks=1)
+        with mock.patch('backups.instrumentation.time.perf_counter', side_effect=[10.0, 10.5]):
+            with stats.stage('checksum', bytes=1024):
+                pass
+        stats.add_table('auth_group', 50, 0.25)
+
+        self.assertEqual(stats.as_dict(), {
+            'stages': {
+                'dump': {'seconds': 2.0, 'rows': 200, 'bytes': 4096, 'chunks': 1, 'rows_per_second': 100,
+                         'bytes_per_second': 2048},
+                'checksum': {'seconds': 0.5, 'bytes': 1024, 'bytes_per_second': 2048},
+            },
+            'tables': {'auth_group': {'rows': 50, 'seconds': 0.25, 'rows_per_second': 200}},
+        })
+
+    def test_metered_file(self):
+        stats = Stats()
+        with MeteredFile(io.BytesIO(), stats, 'compress') as f:
+            f.write(b'abc')
+            f.write(b'defg')
+            self.assertEqual(f.getvalue(), b'abcdefg')
+        reader = MeteredFile(io.BytesIO(b'abcdefg'), stats, 'read')
+        self.assertEqual(reader.read(5), b'abcde')
+        self.assertEqual(reader.read(), b'fg')
+        stages = stats.as_dict()['stages']
+        self.assertEqual((stages['compress']['bytes'], stages['read']['bytes']), (7, 7))
+
+
+class JobStatsTests(MediaRootMixin, TestCase):
+    def test_backup_and_restore_record_their_stages(self):
+        Group.objects.bulk_create(Group(name=f'group {i}') for i in range(3))
+        backup = Backup.objects.create(type='database', include_tables='auth_group', created_by=self.user)
+        jobs.run_queued_jobs()
+        backup.refresh_from_db()
+        self.assertEqual(backup.status, 'done', backup.error)
+        self.assertLessEqual({'dump', 'compress'}, set(backup.stats['stages']))
+        self.assertEqual(backup.stats['stages']['dump']['rows'], 3)
+        self.assertEqual(backup.stats['tables']['auth_group']['rows'], 3)
+        self.assertEqual(backup.get_main_stage(), backup.stats['stages']['dump'])
+        self.assertIsNotNone(backup.get_duration())
+
+        Group.objects.all().delete()
+        restore = Restore.objects.create(type='database', backup=backup, include_tables='auth_group',
+                                         restored_by=self.user)
+        jobs.run_queued_jobs()
+        restore.refresh_from_db()
+        self.assertEqual(restore.status, 'done', restore.error)
+        self.assertLessEqual({'read', 'decompress', 'restore'}, set(restore.stats['stages']))
+        self.assertEqual(restore.stats['stages']['restore']['statements'], 4)
+        # Rows per table come from the INSERTs, not the CREATE TABLE before them
+        self.assertEqual(restore.stats['stages']['restore']['rows'], 3)
+        self.assertEqual(restore.stats['tables']['auth_group']['rows'], 3)
+
+    def test_admin_throughput(self):
+        backup = Backup(stats={'stages': {'checksum': {'bytes_per_second': 1}, 'dump': {
+            'rows_per_second': 2000, 'bytes_per_second': 3 * 1024 * 1024}}})
+        self.assertEqual(BackupBackupAdmin(Backup, admin.site).throughput(backup), '2000 rows/s, 3.0 MB/s')
+        self.assertEqual(BackupBackupAdmin(Backup, admin.site).throughput(Backup()), '-')
+
+
+class JobLockTests(MediaRootMixin, TestCase):
+    def claim(self):
+        backup = Backup.objects.create(type='media', created_by=self.user, status='queued')
+        return jobs.claim_job(Backup, backup.pk)
+
+    @override_settings(BACKUP_LOCK_TIMEOUT=60, BACKUP_PROGRESS_INTERVAL=0)
+    def test_running_job_extends_its_lock(self):
+        backup = self.claim()
+        JobLock.objects.update(expires_at=now() + timedelta(seconds=1))
+        # Two intervals go by, then the job finishes
+        finished = mock.Mock(wait=mock.Mock(side_effect=[False, False, True]))
+
+        jobs.save_progress(backup, Stats(), finished, 'job-media', jobs.get_lock_owner())
+
+        self.assertEqual(finished.wait.call_args.args, (15,))
+        self.assertGreater(JobLock.objects.get().expires_at, now() + timedelta(seconds=50))
+        self.assertEqual(jobs.fail_stale_jobs(), 0)
+
+    def test_lock_of_another_owner_is_not_extended(self):
+        self.assertFalse(jobs.extend_lock('job-media', 'someone', 60))
+        JobLock.objects.create(name='job-media', owner='someone', expires_at=now())
+        self.assertFalse(jobs.extend_lock('job-media', 'me', 60))
+        self.assertTrue(jobs.extend_lock('job-media', 'someone', 60))
+
+    def test_lock_is_released_when_saving_the_job_fails(self):
+        backup = self.claim()
+        with mock.patch('backups.jobs.run_backup'), \
+                mock.patch.object(Backup, 'save', side_effect=DatabaseError('database is locked')):
+            with self.assertRaises(DatabaseError):
+                jobs.run_job(backup)
+        self.assertFalse(JobLock.objects.exists())
+
+
+class RestoreSourceTests(MediaRootMixin, TestCase):
+    def test_database_restore_needs_one_source(self):
+        backup = self.create_backup('full.sql')
+        valid = [{'file': 'backups/full.sql'}, {'backup': backup}, {'point_in_time': now()}]
+        for sources in valid:
+            with self.subTest(sources=sources):
+                Restore(type='database', restored_by=self.user, **sources).clean()
+        for sources in [{}, {'file': 'backups/full.sql', 'backup': backup}, {'backup': backup, 'point_in_time': now()}]:
+            with self.subTest(sources=sources), self.assertRaises(ValidationError):
+                Restore(type='database', restored_by=self.user, **sources).clean()
+
+    def test_backup_must_match_the_restore(self):
+        database = self.create_backup('full.sql')
+        media = Backup.objects.create(type='media', file='backups/media.json', status='done', created_by=self.user)
+        running = self.create_backup('running.sql', status='running')
+        for restore_type, backup in (('database', media), ('media', database), ('database', running)):
+            with self.subTest(restore_type=restore_type, backup=backup.file.name), \
+                    self.assertRaises(ValidationError) as raised:
+                Restore(type=restore_type, backup=backup, restored_by=self.user).full_clean()
+            self.assertIn('backup', raised.exception.message_dict)
+
+    def test_admin_offers_finished_backups_of_the_restore_type(self):
+        database = self.create_backup('full.sql')
+        media = Backup.objects.create(type='media', file='backups/media.json', status='done', created_by=self.user)
+        self.create_backup('failed.sql', status='failed')
+        restore_admin = admin.site._registry[Restore]
+        field = Restore._meta.get_field('backup')
+        for query, expected in (({}, [database, media]), ({'type': 'media'}, [media])):
+            with self.subTest(query=query):
+                request = RequestFactory().get('/', query)
+                form_field = restore_admin.formfield_for_foreignkey(field, request)
+                self.assertEqual(list(form_field.queryset.order_by('pk')), expected)
+
+    def test_point_in_time_is_database_only(self):
+        with self.assertRaises(ValidationError):
+            Restore(type='media', restored_by=self.user, point_in_time=now()).clean()
+        Restore(type='media', restored_by=self.user).clean()
+
+    def test_media_restore_without_source_uses_legacy_archive(self):
+        with zipfile.ZipFile(os.path.join(self.media_root, 'media_backup.zip'), 'w') as archive:
+            archive.writestr('photos/cat.jpg', b'legacy')
+        restore = Restore.objects.create(type='media', restored_by=self.user)
+
+        jobs.run_queued_jobs()
+
+        restore.refresh_from_db()
+        self.assertEqual(restore.status, 'done', restore.error)
+        with open(os.path.join(self.media_root, 'restored_media', 'photos', 'cat.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), b'legacy')
+
+
+class IncrementalBackupTests(MediaRootMixin, TestCase):
+    def run_backup(self, kind):
+        backup = Backup.objects.create(type='database', kind=kind, include_tables='auth_group\nauth_group_permissions',
+                                       created_by=self.user)
+        jobs.run_queued_jobs()
+        backup.refresh_from_db()
+        self.assertEqual(backup.status, 'done', backup.error)
+        return backup, read_backup_manifest(backup.file.path)
+
+    def test_incremental_chain(self):
+        permission = Permission.objects.first()
+        Group.objects.create(name='a').permissions.add(permission)
+        Group.objects.create(name='b')
+        full, full_manifest = self.run_backup('incremental')
+        # Without a finished backup to build on, the first one is full
+        self.assertEqual((full.kind, full_manifest['kind']), ('full', 'full'))
+        self.assertEqual(sorted(full_manifest['tables']), ['auth_group', 'auth_group_permissions'])
+
+        Group.objects.filter(name='b').update(name='B')
+        Group.objects.create(name='c')
+        incremental, manifest = self.run_backup('incremental')
+        self.assertEqual((incremental.kind, incremental.parent), ('incremental', full))
+        self.assertEqual(manifest['tables'], ['auth_group'])
+        self.assertEqual(manifest['fingerprints']['auth_group_permissions'],
+                         full_manifest['fingerprints']['auth_group_permissions'])
+        self.assertEqual(self.run_backup('incremental')[1]['tables'], [])
+
+        Group.objects.all().delete()
+        restore = Restore.objects.create(type='database', backup=incremental, restored_by=self.user,
+                                         include_tables='auth_group\nauth_group_permissions')
+        close = File.close
+        with mock.patch.object(FieldFile, 'close', autospec=True, side_effect=close) as close_file:
+            jobs.run_queued_jobs()
+        restore.refresh_from_db()
+        self.assertEqual(restore.status, 'done', restore.error)
+        # Each file of the chain was closed
+        self.assertEqual(len({id(call.args[0]) for call in close_file.call_args_list}), 2)
+        self.assertEqual(list(Group.objects.order_by('name').values_list('name', flat=True)), ['B', 'a', 'c'])
+        self.assertEqual(list(Group.objects.get(name='a').permissions.all()), [permission])
+
+    def test_postgres_incremental_quotes_table_names(self):
+        connector = PostgresConnector()
+        with mock.patch.object(connector, 'run_command') as run_command:
+            connector.create_incremental_backup('', ['odd"name', 'auth_group'])
+        with open(connector.backup_path, 'rb') as f:
+            self.assertEqual(open_reader(f).read(), b'DELETE FROM "odd""name";\nDELETE FROM "auth_group";\n')
+        self.assertIn("--table='\"odd\"\"name\"' --table='\"auth_group\"'", run_command.call_args.args[0])
+
+
+@mock.patch('backups.media_store.MEDIA_CHUNK_SIZE', 4)
+class MediaStoreTests(MediaRootMixin, TestCase):
+    def write_media(self, name, data):
+        path = os.path.join(self.media_root, 'backups', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def backup(self):
+        stats = Stats()
+        manifest_name = backup_media_to_store(stats)
+        return manifest_name, stats.as_dict()['stages']['archive']
+
+    def test_identical_chunks_are_stored_once(self):
+        store = MediaStore()
+        self.assertEqual(store.put(b'data'), (hashlib.sha256(b'data').hexdigest(), True))
+        self.assertEqual(store.put(b'data'), (hashlib.sha256(b'data').hexdigest(), False))
+
+        self.write_media('a.txt', b'samesame')
+        self.write_media('photos/b.txt', b'samesame!')
+        _, archive = self.backup()
+        self.assertEqual(archive['read_bytes'], 17)
+        # 'same' twice per file, '!' once
+        self.assertEqual(archive['stored_bytes'], 5)
+        self.assertEqual(len([path for path in store.objects_dir.rglob('*') if path.is_file()]), 3)
+
+    def test_unchanged_files_are_reused(self):
+        self.write_media('a.txt', b'first')
+        path = self.write_media('b.txt', b'second')
+        self.backup()
+        _, archive = self.backup()
+        self.assertEqual((archive['files'], archive['reused_files']), (2, 2))
+        self.assertNotIn('read_bytes', archive)
+
+        with open(path, 'ab') as f:
+            f.write(b'!')
+        _, archive = self.backup()
+        self.assertEqual((archive['reused_files'], archive['read_bytes']), (1, 7))
+
+    def test_missing_chunks_are_stored_again(self):
+        self.write_media('a.txt', b'first')
+        self.backup()
+        store = MediaStore()
+        missing = store.load_index()['a.txt']['chunks'][0]
+        os.remove(store.object_path(missing))
+
+        manifest_name, archive = self.backup()
+        self.assertNotIn('reused_files', archive)
+        self.assertTrue(store.has(missing))
+
+        with open(os.path.join(self.media_root, manifest_name), 'rb') as f:
+            restored = restore_media(File(f, name=manifest_name))
+        with open(os.path.join(restored, 'a.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'first')
+
+    def test_restore_keeps_modes_and_mtimes(self):
+        path = self.write_media('photos/cat.jpg', b'a cat picture')
+        os.chmod(path, 0o640)
+        os.utime(path, ns=(1_000_000_000, 1_000_000_000))
+        manifest_name, _ = self.backup()
+
+        with open(os.path.join(self.media_root, manifest_name), 'rb') as f:
+            restored = restore_media(File(f, name=manifest_name))
+        restored_path = os.path.join(restored, 'photos', 'cat.jpg')
+        with open(restored_path, 'rb') as f:
+            self.assertEqual(f.read(), b'a cat picture')
+        self.assertEqual(os.stat(restored_path).st_mode & 0o777, 0o640)
+        self.assertEqual(os.stat(restored_path).st_mtime_ns, 1_000_000_000)
+        # The store itself isn't backed up into itself
+        self.assertFalse(os.path.exists(os.path.join(restored, 'media_store')))
+
+
+class SelectiveMediaRestoreTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.archive_path = os.path.join(self.media_root, 'media.zip')
+        with zipfile.ZipFile(self.archive_path, 'w') as archive:
+            for name in ('photos/2023/cat.jpg', 'photos/2024/dog.jpg', 'docs/report.pdf', 'notes.txt'):
+                archive.writestr(name, name.encode())
+
+    def restore(self, patterns=None):
+        stats = Stats()
+        with open(self.archive_path, 'rb') as f:
+            restored = restore_media(File(f, name=self.archive_path), stats, patterns)
+        files = sorted(os.path.relpath(os.path.join(dir_path, name), restored).replace(os.sep, '/')
+                       for dir_path, _, names in os.walk(restored) for name in names)
+        return files, stats.as_dict()['stages']['extract']
+
+    def test_patterns(self):
+        self.assertTrue(match_media_path('a/b.txt'))
+        for pattern in ('photos/2023', '/photos/2023/', 'photos', '*.jpg', 'photos/*/cat.jpg'):
+            with self.subTest(pattern=pattern):
+                self.assertTrue(match_media_path('photos/2023/cat.jpg', [pattern]))
+        for pattern in ('photos/20', 'cat.jpg', '*.pdf'):
+            with self.subTest(pattern=pattern):
+                self.assertFalse(match_media_path('photos/2023/cat.jpg', [pattern]))
+
+    def test_only_matching_files_are_restored(self):
+        files, extract = self.restore(['photos/2023', '*.pdf'])
+        self.assertEqual(files, ['docs/report.pdf', 'photos/2023/cat.jpg'])
+        self.assertEqual(extract['files'], 2)
+
+    def test_unchanged_files_are_skipped(self):
+        self.restore()
+        with open(os.path.join(self.media_root, 'restored_media', 'notes.txt'), 'wb') as f:
+            f.write(b'changed!!')
+        files, extract = self.restore()
+        self.assertEqual(len(files), 4)
+        self.assertEqual((extract['files'], extract['skipped_files']), (1, 3))
+        with open(os.path.join(self.media_root, 'restored_media', 'notes.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'notes.txt')
+
+    def test_members_outside_the_restore_directory_are_refused(self):
+        with zipfile.ZipFile(self.archive_path, 'w') as archive:
+            archive.writestr('../outside.txt', b'outside')
+        with self.assertRaises(Exception):
+            self.restore()
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'outside.txt')))
+
+
+class ZipMediaBackupTests(MediaRootMixin, TestCase):
+    def write_media(self, name, data):
+        path = os.path.join(self.media_root, 'backups', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def test_every_backup_gets_its_own_archive(self):
+        self.write_media('photos/cat.jpg', b'first')
+        first = compress_media_file()
+        self.write_media('photos/cat.jpg', b'second')
+        second = compress_media_file()
+
+        self.assertNotEqual(first, second)
+        with open(os.path.join(self.media_root, first), 'rb') as f:
+            restored = restore_media(File(f, name=first))
+        with open(os.path.join(restored, 'photos', 'cat.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), b'first')
+
+
+class MediaArchiveTests(SimpleTestCase):
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source, ignore_errors=True)
+        self.files = {
+            'notes.txt': b'compressible ' * 1000,
+            'photos/cat.jpg': b'jpeg data ' * 100,
+            'random.bin': os.urandom(100 * 1024),
+            'empty': b'',
+            'déjà vu/café.txt': 'café'.encode(),
+        }
+        for name, data in self.files.items():
+            path = os.path.join(self.source, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        os.chmod(os.path.join(self.source, 'notes.txt'), 0o600)
+
+    @override_settings(MEDIA_ARCHIVE_WORKERS=3)
+    def test_archive_is_readable_by_zipfile(self):
+        archive_path = f'{self.source}.zip'
+        self.addCleanup(os.remove, archive_path)
+        write_media_archive(self.source, archive_path)
+
+        with zipfile.ZipFile(archive_path) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(sorted(archive.namelist()), sorted(self.files))
+            for name, data in self.files.items():
+                self.assertEqual(archive.read(name), data)
+            self.assertEqual(archive.getinfo('notes.txt').compress_type, ZIP_DEFLATED)
+            self.assertEqual(archive.getinfo('photos/cat.jpg').compress_type, ZIP_STORED)
+            self.assertEqual(archive.getinfo('random.bin').compress_type, ZIP_STORED)
+            self.assertEqual(archive.getinfo('notes.txt').external_attr >> 16 & 0o777, 0o600)
+
+
+@override_settings(BACKUP_RESTORE_MODE='staged', BACKUP_SQLITE_CHUNK_ROWS=2)
+class StagedSqliteRestoreTests(MediaRootMixin, TransactionTestCase):
+    def restore(self, backup_path):
+        connector = get_db_connector()
+        connector.select_tables(['auth_group'], [])
+        with open(backup_path, 'rb') as f:
+            connector.restore_backup_chain([File(f, name=backup_path)])
+        return connector.stats.as_dict()
+
+    def test_shadow_tables_are_swapped_in(self):
+        Group.objects.bulk_create(Group(name=f'group {i}') for i in range(5))
+        connector = get_db_connector()
+        connector.select_tables(['auth_group'], [])
+        backup_path = os.path.join(self.media_root, connector.create_backup())
+        Group.objects.filter(name='group 1').delete()
+        Group.objects.create(name='new')
+
+        stats = self.restore(backup_path)
+
+        # Five rows copied two at a time
+        self.assertEqual(stats['stages']['restore']['chunks'], 3)
+        self.assertEqual(list(Group.objects.order_by('name').values_list('name', flat=True)),
+                         [f'group {i}' for i in range(5)])
+        self.assertNotIn('backups_staged_auth_group', connection.introspection.table_names())
+        with self.assertRaises(IntegrityError):
+            Group.objects.create(name='group 1')
+
+
+class DatabaseFileMixin:
+    def use_database_file(self):
+        # Parallel dump workers open the database file themselves, the in-memory test database is copied to one
+        path = os.path.join(self.media_root, 'live.db')
+        target = sqlite3.connect(path)
+        connection.ensure_connection()
+        connection.connection.backup(target)
+        target.close()
+        for patch in (mock.patch.dict(connection.settings_dict, NAME=path),
+                      mock.patch.object(connection, 'is_in_memory_db', return_value=False)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+
+@override_settings(BACKUP_SQLITE_MODE='snapshot')
+class SnapshotBackupTests(MediaRootMixin, TransactionTestCase):
+    def test_snapshot_backup_and_restore(self):
+        Group.objects.bulk_create([Group(name='a'), Group(name='b')])
+        connector = get_db_connector()
+        backup_path = os.path.join(self.media_root, connector.create_backup())
+
+        self.assertTrue(backup_path.endswith('.db'))
+        with open(backup_path, 'rb') as f:
+            self.assertEqual(f.read(len(SQLITE_MAGIC)), SQLITE_MAGIC)
+        self.assertEqual(read_backup_manifest(backup_path)['fingerprints'], {})
+        self.assertGreater(connector.stats.as_dict()['stages']['dump']['pages'], 0)
+
+        Group.objects.filter(name='a').delete()
+        Group.objects.create(name='c')
+        backup = Backup.objects.create(type='database', file=os.path.relpath(backup_path, self.media_root),
+                                       status='done', created_by=self.user)
+        connector = get_db_connector()
+        with backup.file.open('rb') as f:
+            connector.restore_backup(f)
+        self.assertEqual(list(Group.objects.order_by('name').values_list('name', flat=True)), ['a', 'b'])
+        # The backup app's own tables keep their live rows
+        self.assertTrue(Backup.objects.filter(pk=backup.pk).exists())
+        self.assertEqual(connector.stats.tables['auth_group']['rows'], 2)
+
+    def test_selected_tables_are_dumped_as_sql(self):
+        connector = get_db_connector()
+        connector.select_tables(['auth_group'], [])
+        self.assertTrue(connector.create_backup().endswith('.sql.gz'))
+
+
+@override_settings(BACKUP_PARALLEL_WORKERS=3)
+class ParallelBackupTests(DatabaseFileMixin, MediaRootMixin, TransactionTestCase):
+    tables = ['auth_group', 'auth_user', 'auth_user_groups']
+
+    def test_parallel_dump_and_restore(self):
+        groups = Group.objects.bulk_create(Group(name=f'group {i}') for i in range(3))
+        self.user.groups.set(groups[1:])
+        self.use_database_file()
+        connector = get_db_connector()
+        connector.select_tables(self.tables, [])
+
+        backup_path = os.path.join(self.media_root, connector.create_backup())
+
+        self.assertTrue(backup_path.endswith('.tar'))
+        with tarfile.open(backup_path) as tar:
+            self.assertEqual(tar.getnames()[0], 'manifest.json')
+            manifest = json.load(tar.extractfile('manifest.json'))
+        # Referenced tables come first
+        self.assertEqual([table['name'] for table in manifest['tables']], self.tables)
+        self.assertEqual(connector.stats.tables['auth_group']['rows'], 3)
+
+        User.objects.all().delete()
+        Group.objects.all().delete()
+        connector = get_db_connector()
+        connector.select_tables(self.tables, [])
+        with open(backup_path, 'rb') as f:
+            result = connector.restore_backup(File(f, name=backup_path))
+        self.assertEqual(result['failed'], 0)
+        self.assertEqual(list(Group.objects.order_by('name').values_list('name', flat=True)),
+                         ['group 0', 'group 1', 'group 2'])
+        self.assertEqual(list(User.objects.get().groups.order_by('name').values_list('name', flat=True)),
+                         ['group 1', 'group 2'])
+
+
+class ExtractTarTests(SimpleTestCase):
+    # Python before 3.10.12 and 3.11.4 has no extraction filters
+    tarfile_modules = [tarfile, SimpleNamespace()]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+
+    def write_tar(self, member):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as tar:
+            tar.addfile(member, io.BytesIO(b'data'))
+        buffer.seek(0)
+        return tarfile.open(fileobj=buffer, mode='r:')
+
+    def file_member(self, name):
+        member = tarfile.TarInfo(name)
+        member.size = 4
+        return member
+
+    def test_extract(self):
+        for tarfile_module in self.tarfile_modules:
+            with self.subTest(tarfile_module=tarfile_module), \
+                    mock.patch('backups.db_connectors.tarfile', tarfile_module), \
+                    self.write_tar(self.file_member('dump/toc.dat')) as tar:
+                extract_tar(tar, self.tmp_dir)
+                with open(os.path.join(self.tmp_dir, 'dump', 'toc.dat'), 'rb') as f:
+                    self.assertEqual(f.read(), b'data')
+
+    def test_members_leaving_the_directory_are_refused(self):
+        link = tarfile.TarInfo('dump/link')
+        link.type, link.linkname = tarfile.SYMTYPE, '/etc/passwd'
+        for tarfile_module in self.tarfile_modules:
+            for member in (self.file_member('../outside'), link):
+                with self.subTest(tarfile_module=tarfile_module, member=member.name), \
+                        mock.patch('backups.db_connectors.tarfile', tarfile_module), \
+                        self.write_tar(member) as tar, self.assertRaises(Exception):
+                    extract_tar(tar, self.tmp_dir)
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(self.tmp_dir), 'outside')))
+
+
+class TableSelectionTests(MediaRootMixin, TestCase):
+    def test_sort_tables_by_dependencies(self):
+        dependencies = {'c': {'b'}, 'b': {'a', 'b'}, 'a': set(), 'd': {'missing'}}
+        self.assertEqual(sort_tables_by_dependencies(dependencies), ['a', 'd', 'b', 'c'])
+        # Tables in a reference cycle fall back to name order
+        self.assertEqual(sort_tables_by_dependencies({'b': {'a'}, 'a': {'b'}}), ['a', 'b'])
+
+    def test_statement_table(self):
+        statements = [
+            ('INSERT INTO "auth_group" VALUES(1)', 'auth_group'),
+            ('insert into public.auth_group (id) values (1)', 'auth_group'),
+            ('DELETE FROM "odd ""name"""', 'odd "name"'),
+            ('COPY public.auth_group (id, name) FROM stdin', 'auth_group'),
+            ('CREATE TABLE IF NOT EXISTS "auth_group" ("id" integer)', 'auth_group'),
+            ("SELECT pg_catalog.setval('auth_group_id_seq', 3, true)", None),
+        ]
+        for statement, table_name in statements:
+            with self.subTest(statement=statement):
+                self.assertEqual(get_statement_table(statement), table_name)
+
+    def test_statements_are_replayed_in_foreign_key_order(self):
+        connector = get_db_connector()
+        connector.select_tables(['auth_user_groups', 'auth_group', 'auth_user'], ['auth_user'])
+        sql = b"""INSERT INTO "auth_user_groups" VALUES(1,1,1);
+INSERT INTO "auth_permission" VALUES(1,1,'add','x');
+COPY "auth_user" (id) FROM stdin;
+1
+\\.
+SELECT setval('seq', 1);
+INSERT INTO "auth_group" VALUES(1,'a');
+INSERT INTO "auth_user_groups" VALUES(2,1,2);
+"""
+        statements = connector.select_statements(iter_statements(io.BytesIO(sql)))
+        self.assertEqual([str(statement) for statement in statements], [
+            "SELECT setval('seq', 1)",
+            """INSERT INTO "auth_group" VALUES(1,'a')""",
+            'INSERT INTO "auth_user_groups" VALUES(1,1,1)',
+            'INSERT INTO "auth_user_groups" VALUES(2,1,2)',
+        ])
+
+    def test_excluded_tables_keep_their_rows(self):
+        self.user.groups.add(Group.objects.create(name='a'))
+        connector = get_db_connector()
+        connector.select_tables(['auth_group', 'auth_user', 'auth_user_groups'], [])
+        backup_path = os.path.join(self.media_root, connector.create_backup())
+        self.assertEqual(sorted(read_backup_manifest(backup_path)['tables']),
+                         ['auth_group', 'auth_user', 'auth_user_groups'])
+        # Full dumps only insert rows, so the restored tables are emptied first
+        Group.objects.all().delete()
+        User.objects.update(username='changed')
+
+        connector = get_db_connector()
+        connector.select_tables([], ['auth_user'])
+        with open(backup_path, 'rb') as f:
+            connector.restore_backup(File(f, name=backup_path))
+        self.assertEqual(list(Group.objects.values_list('name', flat=True)), ['a'])
+        self.assertEqual(User.objects.get().username, 'changed')
+        self.assertEqual(list(User.objects.get().groups.values_list('name', flat=True)), ['a'])
+
+
+@override_settings(BACKUP_SQLITE_CHUNK_ROWS=2)
+class ChunkedDumpTests(TestCase):
+    def dump(self, table_name, sql, rows):
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            for row in rows:
+                cursor.execute(f'INSERT INTO "{table_name}" VALUES ({", ".join("%s" for _ in row)})', row)
+        connector = get_db_connector()
+        cursor = connection.connection.cursor()
+        self.addCleanup(cursor.close)
+        output = io.BytesIO()
+        fingerprint = connector._write_table(cursor, table_name, sql, output)
+        statements = output.getvalue().decode().splitlines()[1:]
+        return statements, fingerprint, connector.stats.as_dict()['stages'].get('dump', {}).get('chunks')
+
+    def test_rowid_table(self):
+        # The last full chunk is followed by one empty read
+        for count, chunks in ((3, 2), (4, 3), (1, 1), (0, 1)):
+            with self.subTest(count=count):
+                statements, _, dump_chunks = self.dump(
+                    f'rows_{count}', f'CREATE TABLE "rows_{count}" ("value" text)',
+                    [(f'row {i}',) for i in range(count)],
+                )
+                self.assertEqual(statements,
+                                 [f"""INSERT INTO "rows_{count}" VALUES('row {i}');""" for i in range(count)])
+                self.assertEqual(dump_chunks, chunks)
+
+    def test_without_rowid_table_is_paged_by_its_primary_key(self):
+        # Row value comparison carries a composite key across chunk boundaries
+        rows = [('b', 1, 'x'), ('a', 2, 'x'), ('a', 1, 'x'), ('b', 2, 'x'), ('a', 3, 'x')]
+        statements, _, chunks = self.dump(
+            'pairs', 'CREATE TABLE "pairs" ("second" integer, "first" text, "value" text, '
+                     'PRIMARY KEY ("first", "second")) WITHOUT ROWID',
+            [(second, first, value) for first, second, value in rows],
+        )
+        self.assertEqual(statements, [f"""INSERT INTO "pairs" VALUES({second},'{first}','x');"""
+                                      for first, second, _ in sorted(rows)])
+        self.assertEqual(chunks, 3)
+
+    def test_braces_in_identifiers(self):
+        # Rowid tables come out in insertion order, WITHOUT ROWID ones in key order
+        for table_name, sql, order in (
+            ('{rows}', 'CREATE TABLE "{rows}" ("{value}" text)', 'cab'),
+            ('keys}', 'CREATE TABLE "keys}" ("{key" text PRIMARY KEY) WITHOUT ROWID', 'abc'),
+        ):
+            with self.subTest(table_name=table_name):
+                statements, _, chunks = self.dump(table_name, sql, [('c',), ('a',), ('b',)])
+                self.assertEqual(statements, [f"""INSERT INTO "{table_name}" VALUES('{value}');""" for value in order])
+                self.assertEqual(chunks, 2)
+
+    def test_columns_hiding_the_rowid(self):
+        sql = 'CREATE TABLE "hidden" ("rowid" text, "_rowid_" text, "oid" text)'
+        statements, _, chunks = self.dump('hidden', sql, [('c', 'c', 'c'), ('a', 'a', 'a'), ('b', 'b', 'b')])
+        # Read in one go, without a key to page by
+        self.assertEqual(len(statements), 3)
+        self.assertIsNone(chunks)
+        # A column hiding one alias pages by the next
+        self.assertEqual(SqliteConnector.get_key_columns('CREATE TABLE "t" ("rowid" text)', [(0, 'rowid')]),
+                         ['_rowid_'])
+
+    def test_fingerprint_does_not_depend_on_the_chunk_size(self):
+        _, chunked, _ = self.dump('chunked', 'CREATE TABLE "chunked" ("value" text)', [('b',), ('a',), ('c',)])
+        with override_settings(BACKUP_SQLITE_CHUNK_ROWS=0):
+            cursor = connection.connection.cursor()
+            self.addCleanup(cursor.close)
+            whole = get_db_connector()._write_table(cursor, 'chunked', 'CREATE TABLE "chunked" ("value" text)', None)
+        self.assertEqual(chunked, whole)
+
+
+class VerificationTests(MediaRootMixin, TestCase):
+    def run_backup(self):
+        Group.objects.bulk_create([Group(name='a'), Group(name='b')])
+        backup = Backup.objects.create(type='database', include_tables='auth_group\nauth_user', created_by=self.user)
+        jobs.run_queued_jobs()
+        backup.refresh_from_db()
+        self.assertEqual(backup.status, 'done', backup.error)
+        return backup
+
+    def verify(self, backup):
+        [(verified, error, stats)] = verify_backups([backup], workers=2)
+        backup.refresh_from_db()
+        self.assertIsNotNone(backup.verified_at)
+        self.assertEqual(backup.verify_error, error or '')
+        return error, stats.as_dict()
+
+    def test_backup_restores_to_its_fingerprints(self):
+        backup = self.run_backup()
+        checksum = backup.checksum
+        self.assertEqual(checksum, file_checksum(backup.file.path))
+        # Backups made before checksums were recorded get one from their first verification
+        Backup.objects.update(checksum='')
+        backup.refresh_from_db()
+        error, stats = self.verify(backup)
+        self.assertIsNone(error)
+        self.assertEqual(backup.checksum, checksum)
+        self.assertEqual(stats['stages']['verify']['tables'], 2)
+
+    def test_corrupt_file_fails_its_checksum(self):
+        backup = self.run_backup()
+        with open(backup.file.path, 'ab') as f:
+            f.write(b'!')
+        error, _ = self.verify(backup)
+        self.assertIn('Checksum mismatch', error)
+
+    def test_restored_rows_must_match_the_manifest(self):
+        backup = Backup.objects.create(type='database', status='done', created_by=self.user,
+                                       file='backups/groups.sql')
+        with open(backup.file.path, 'w') as f:
+            f.write('CREATE TABLE "auth_group" ("id" integer PRIMARY KEY, "name" varchar(150));\n'
+                    """INSERT INTO "auth_group" VALUES(1,'a');\n""")
+        with open(get_manifest_path(backup.file.path), 'w') as f:
+            json.dump({'engine': 'sqlite', 'kind': 'full', 'fingerprints': {'auth_group': '2:0'}}, f)
+        error, _ = self.verify(backup)
+        self.assertIn("Rows of 'auth_group' don't match the backup manifest", error)
+
+        with open(backup.file.path, 'a') as f:
+            f.write('INSERT INTO "missing" VALUES(1);\n')
+        with self.assertRaisesMessage(Exception, 'Statement 3 failed in the test restore'):
+            verify_backup(backup, chain=[backup], stats=Stats())
+
+    def test_media_store_chunks_are_checked(self):
+        with open(os.path.join(self.media_root, 'backups', 'cat.jpg'), 'wb') as f:
+            f.write(b'cat')
+        backup = Backup.objects.create(type='media', status='done', created_by=self.user,
+                                       file=backup_media_to_store(Stats()))
+        self.assertEqual(self.verify(backup), (None, mock.ANY))
+
+        chunk_path = MediaStore().object_path(hashlib.sha256(b'cat').hexdigest())
+        with open(chunk_path, 'wb') as f:
+            f.write(b'dog')
+        error, _ = self.verify(backup)
+        self.assertIn('1 of 1 media chunks are missing or corrupt', error)
+
+    def test_media_archive_is_read_back(self):
+        with zipfile.ZipFile(os.path.join(self.media_root, 'backups', 'media.zip'), 'w') as archive:
+            archive.writestr('photos/cat.jpg', b'cat')
+        backup = Backup.objects.create(type='media', status='done', created_by=self.user,
+                                       file='backups/media.zip')
+        error, stats = self.verify(backup)
+        self.assertIsNone(error)
+        self.assertEqual(stats['stages']['verify']['files'], 1)
+
+
+@override_settings(BACKUP_STORAGES=[])
+class WalArchiveTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        self.root = os.path.join(self.tmp_dir, 'wal')
+        self.database_path = os.path.join(self.tmp_dir, 'live.db')
+        self.writer = sqlite3.connect(self.database_path, isolation_level=None)
+        self.addCleanup(self.writer.close)
+        self.writer.execute('PRAGMA journal_mode = WAL')
+        self.writer.execute('CREATE TABLE "notes" ("text" text)')
+        self.time = datetime(2026, 1, 1, 10, tzinfo=timezone.utc)
+        # Segments are stamped with the clock of the test, the archiver's progress messages are dropped
+        for patch in (mock.patch('backups.wal_archive.now', side_effect=lambda: self.time),
+                      mock.patch('sys.stdout', io.StringIO())):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def write(self, text, minutes=1):
+        self.writer.execute('INSERT INTO "notes" VALUES (?)', (text,))
+        self.time += timedelta(minutes=minutes)
+
+    def recover(self, target):
+        output_path = os.path.join(self.tmp_dir, 'recovered.db')
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        recovered_at = recover_to_time(target, output_path, root=self.root)
+        recovered = sqlite3.connect(output_path)
+        try:
+            return recovered_at, [text for text, in recovered.execute('SELECT "text" FROM "notes" ORDER BY rowid')]
+        finally:
+            recovered.close()
+
+    def archive(self, checkpoint_frames=1000):
+        with override_settings(BACKUP_WAL_CHECKPOINT_FRAMES=checkpoint_frames):
+            archiver = WalArchiver(self.database_path, self.root)
+        archiver.open()
+        self.addCleanup(archiver.close)
+        return archiver
+
+    def test_recover_between_segments(self):
+        self.write('base')
+        started_at = self.time
+        archiver = self.archive()
+        self.write('first')
+        self.assertGreater(archiver.archive(), 0)
+        first_at = self.time
+        self.write('second')
+        self.assertGreater(archiver.archive(), 0)
+        self.assertEqual(archiver.archive(), 0)
+
+        self.assertEqual(self.recover(started_at), (started_at, ['base']))
+        self.assertEqual(self.recover(first_at + timedelta(seconds=30)), (first_at, ['base', 'first']))
+        self.assertEqual(self.recover(self.time)[1], ['base', 'first', 'second'])
+        with self.assertRaisesMessage(Exception, 'The WAL archive has no generation started before'):
+            self.recover(started_at - timedelta(seconds=1))
+
+    def test_archive_keeps_up_with_checkpoints(self):
+        archiver = self.archive(checkpoint_frames=1)
+        expected = []
+        for i in range(5):
+            self.write(f'note {i}')
+            expected.append(f'note {i}')
+            archiver.archive()
+        # Every checkpoint let the WAL start over, the frames written after it are still archived
+        self.assertEqual(len(list_generations(self.root)), 1)
+        self.assertEqual(self.recover(self.time)[1], expected)
+
+
+@override_settings(BACKUP_DATABASE_FORMAT='portable')
+class PortableBackupTests(MediaRootMixin, TestCase):
+    tables = ['auth_group', 'auth_user', 'auth_user_groups']
+
+    def test_round_trip(self):
+        User.objects.filter(pk=self.user.pk).update(is_staff=True, last_login=datetime(2026, 1, 1, tzinfo=timezone.utc))
+        self.user.groups.set(Group.objects.bulk_create([Group(name='a'), Group(name='b')]))
+        snapshot = list(User.objects.values()), list(Group.objects.values()), list(self.user.groups.values('pk'))
+        connector = get_db_connector()
+        connector.select_tables(self.tables, [])
+        backup_path = os.path.join(self.media_root, connector.create_backup())
+
+        self.assertTrue(backup_path.endswith('.portable.tar'))
+        with tarfile.open(backup_path) as tar:
+            self.assertEqual(tar.getnames()[0], 'manifest.json')
+            manifest = json.load(tar.extractfile('manifest.json'))
+        self.assertEqual([(table['name'], table['rows']) for table in manifest['tables']],
+                         [('auth_group', 2), ('auth_user', 1), ('auth_user_groups', 2)])
+        self.assertIn(['is_staff', 'boolean'], manifest['tables'][1]['columns'])
+
+        Group.objects.all().delete()
+        User.objects.update(username='changed', is_staff=False, last_login=None)
+        User.objects.create(username='new')
+        permissions = Permission.objects.count()
+
+        connector = get_db_connector()
+        connector.select_tables(self.tables, [])
+        with open(backup_path, 'rb') as f:
+            result = connector.restore_backup(File(f, name=backup_path))
+        self.assertEqual(result, {'tables': 3, 'rows': 5})
+        self.assertEqual((list(User.objects.values()), list(Group.objects.values()),
+                          list(self.user.groups.values('pk'))), snapshot)
+        self.assertEqual(Permission.objects.count(), permissions)
+
+    def test_values_round_trip(self):
+        values = [
+            ('integer', 3), ('float', 1.5), ('decimal', Decimal('1.10')), ('boolean', True), ('binary', b'\x00\xff'),
+            ('date', date(2026, 1, 2)), ('time', time(10, 30)), ('duration', timedelta(days=1, microseconds=1)),
+            ('uuid', UUID('12345678-1234-5678-1234-567812345678')), ('text', 'line\nbreak'), ('text', None),
+            ('datetime', datetime(2026, 1, 2, 10, tzinfo=timezone.utc)),
+        ]
+        for portable_type, value in values:
+            with self.subTest(portable_type=portable_type, value=value):
+                encoded = json.loads(json.dumps(encode_value(portable_type, value)))
+                self.assertEqual(decode_value(portable_type, encoded), value)
+        # SQLite returns naive UTC datetimes and keeps UUIDs as text
+        self.assertEqual(encode_value('datetime', '2026-01-02 10:00:00'), '2026-01-02T10:00:00+00:00')
+        self.assertEqual(encode_value('uuid', '12345678123456781234567812345678'),
+                         '12345678-1234-5678-1234-567812345678')
+
+    def test_columns_are_matched_by_name(self):
+        lines = [json.dumps([1, 'dropped', 'a']), json.dumps([2, 'dropped', None])]
+        source_columns = [('id', 'integer'), ('gone', 'text'), ('name', 'text')]
+        target_columns = [('name', 'text'), ('id', 'integer')]
+        self.assertEqual(list(iter_load_rows(lines, source_columns, target_columns, connection)),
+                         [['a', 1], [None, 2]])
+
+
+class ExecuteStatementsTests(TestCase):
+    @override_settings(BACKUP_RESTORE_BATCH_SIZE=0)
+    def test_restore_without_batches_is_one_transaction(self):
+        statements = iter([
+            "INSERT INTO auth_group (id, name) VALUES (1, 'first')",
+            "INSERT INTO auth_group (id, name) VALUES (1, 'duplicate')",
+        ])
+        with self.assertRaises(IntegrityError):
+            get_db_connector().execute_statements(statements)
+        self.assertFalse(Group.objects.exists())
+
+    @override_settings(BACKUP_RESTORE_BATCH_SIZE=10)
+    def test_failing_statement_of_a_batch_is_skipped(self):
+        statements = [
+            "INSERT INTO auth_group (id, name) VALUES (1, 'first')",
+            "INSERT INTO auth_group (id, name) VALUES (1, 'duplicate')",
+        ]
+        with self.assertWarns(UserWarning):
+            result = get_db_connector().execute_statements(statements)
+        self.assertEqual((result['executed'], result['failed']), (1, 1))
+        self.assertEqual(list(Group.objects.values_list('name', flat=True)), ['first'])
+
+
+class CopyCursor:
+    # Runs COPY ... FROM stdin on SQLite as INSERTs, like psycopg2's copy_expert reads the whole file
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cursor.close()
+
+    def copy_expert(self, sql, file, size=8192):
+        table_name, columns = re.match(r'COPY (\S+) \((.+)\) FROM stdin', sql).groups()
+        data = ''
+        while True:
+            chunk = file.read(size)
+            if not chunk:
+                break
+            data += chunk
+        for line in data.splitlines():
+            values = line.split('\t')
+            self.cursor.execute(f'INSERT INTO {table_name} ({columns}) VALUES ({", ".join(["%s"] * len(values))})',
+                                values)
+
+
+class CopyRestoreTests(TestCase):
+    def restore(self, sql):
+        self.connector = get_db_connector()
+        cursor = self.connector.connection.cursor
+        with mock.patch.object(self.connector.connection, 'cursor', side_effect=lambda: CopyCursor(cursor())):
+            return self.connector.restore_backup(File(io.BytesIO(sql.encode()), name='backup.sql'))
+
+    def test_copy_block_is_loaded(self):
+        result = self.restore(
+            "COPY auth_group (id, name) FROM stdin;\n1\tfirst\n2\tsecond\n\\.\n"
+            "INSERT INTO auth_group (id, name) VALUES (3, 'third');\n"
+        )
+        self.assertEqual((result['executed'], result['failed']), (2, 0))
+        self.assertEqual(list(Group.objects.order_by('id').values_list('name', flat=True)),
+                         ['first', 'second', 'third'])
+        self.assertEqual(self.connector.stats.tables['auth_group']['rows'], 3)
+
+    def test_failing_copy_block_is_replayed_row_by_row(self):
+        Group.objects.create(id=2, name='existing')
+        with self.assertWarns(UserWarning):
+            result = self.restore("COPY auth_group (id, name) FROM stdin;\n1\tfirst\n2\tsecond\n3\tthird\n\\.\n")
+        self.assertEqual((result['executed'], result['failed']), (2, 1))
+        self.assertEqual(list(Group.objects.order_by('id').values_list('name', flat=True)),
+                         ['first', 'existing', 'third'])
+        self.assertEqual(self.connector.stats.tables['auth_group']['rows'], 2)
+
+
+class DumpRowCounterTests(SimpleTestCase):
+    def test_rows_are_counted_per_table(self):
+        dump = (
+            b"SET statement_timeout = 0;\n"
+            b"COPY public.auth_group (id, name) FROM stdin;\n1\ta\n2\tb\\nc\n\\.\n"
+            b"COPY public.auth_group_permissions (id, group_id) FROM stdin;\n\\.\n"
+            b"INSERT INTO public.auth_user VALUES (1, 'line\n');\nINSERT INTO public.auth_user VALUES (2, '');\n"
+            b"INSERT INTO public.auth_user_groups VALUES (1, 1, 1);\n"
+            b"SELECT pg_catalog.setval('public.auth_group_id_seq', 2, true);\n"
+        )
+        # Chunk boundaries fall inside every line and end marker
+        for chunk_size in range(1, len(dump) + 1):
+            with self.subTest(chunk_size=chunk_size):
+                output = io.BytesIO()
+                stats = Stats()
+                counter = DumpRowCounter(output, stats)
+                for start in range(0, len(dump), chunk_size):
+                    counter.write(dump[start:start + chunk_size])
+                counter.finish()
+                self.assertEqual(output.getvalue(), dump)
+                self.assertEqual({table_name: table['rows'] for table_name, table in stats.tables.items()},
+                                 {'auth_group': 2, 'auth_group_permissions': 0, 'auth_user': 2,
+                                  'auth_user_groups': 1})
+                self.assertEqual(stats.as_dict()['stages']['dump']['rows'], 5)
+
+
+class CompressionTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        self.data = b'INSERT INTO t VALUES (1);\n' * 1000
+
+    def round_trip(self, codec):
+        path = os.path.join(self.tmp_dir, f'backup.sql{CODEC_EXTENSIONS[codec]}')
+        with open_writer(path, codec) as f:
+            for start in range(0, len(self.data), 999):
+                f.write(self.data[start:start + 999])
+        with open(path, 'rb') as f:
+            self.assertEqual(detect_codec(f), codec)
+            self.assertEqual(f.tell(), 0)
+            self.assertEqual(open_reader(f).read(), self.data)
+        return os.path.getsize(path)
+
+    def test_gzip(self):
+        self.assertLess(self.round_trip('gzip'), len(self.data) // 10)
+
+    @skipUnless(zstandard, 'zstandard is not installed')
+    def test_zstd(self):
+        self.assertLess(self.round_trip('zstd'), len(self.data) // 10)
+
+    def test_none(self):
+        self.assertEqual(self.round_trip('none'), len(self.data))
+
+    def test_writer_closes_the_file_it_was_given(self):
+        for codec in ['gzip', 'zstd'] if zstandard else ['gzip']:
+            with self.subTest(codec=codec):
+                file_obj = open(os.path.join(self.tmp_dir, codec), 'wb')
+                writer = open_writer(file_obj, codec)
+                writer.write(self.data)
+                writer.close()
+                self.assertTrue(file_obj.closed)
+
+    @override_settings(BACKUP_COMPRESSION='rar')
+    def test_unknown_codec(self):
+        with self.assertRaises(Exception):
+            get_codec()
+
+    def test_iter_compressed(self):
+        compressed = b''.join(iter_compressed(io.BytesIO(self.data), 'gzip', chunk_size=1000))
+        self.assertEqual(gzip.decompress(compressed), self.data)
+
+
+class IterStatementsTests(SimpleTestCase):
+    def parse(self, sql, chunk_size=64 * 1024):
+        statements = []
+        for statement in iter_statements(io.BytesIO(sql.encode()), chunk_size=chunk_size):
+            if isinstance(statement, CopyStatement):
+                statements.append((str(statement), statement.data.read()))
+            else:
+                statements.append(statement)
+        return statements
+
+    def test_every_chunk_size_gives_the_same_statements(self):
+        sql = (
+            "-- comment; with a semicolon\n"
+            "INSERT INTO t VALUES('it''s; ok', \"a;b\");\n"
+            "/* block; comment */ CREATE FUNCTION f() RETURNS text AS $body$ SELECT 'x;y'; $body$ LANGUAGE sql;\n"
+            "COPY t (a, b) FROM stdin;\n1\tcafé;\n2\t$$\n\\.\n"
+            "SELECT $$a;b$$, a$b FROM t;\n"
+        )
+        expected = self.parse(sql)
+        self.assertEqual(expected, [
+            "INSERT INTO t VALUES('it''s; ok', \"a;b\")",
+            "CREATE FUNCTION f() RETURNS text AS $body$ SELECT 'x;y'; $body$ LANGUAGE sql",
+            ("COPY t (a, b) FROM stdin", "1\tcafé;\n2\t$$\n"),
+            "SELECT $$a;b$$, a$b FROM t",
+        ])
+        # Chunk boundaries fall inside every token, including the two bytes of 'é'
+        for chunk_size in range(1, len(sql.encode()) + 1):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.parse(sql, chunk_size), expected)
+
+    def test_doubled_quotes_stay_in_the_string(self):
+        self.assertEqual(self.parse("SELECT 'a'';''b';SELECT ''''", chunk_size=1),
+                         ["SELECT 'a'';''b'", "SELECT ''''"])
+
+    def test_dollar_tags_must_match(self):
+        sql = "SELECT $a$ $b$; $a$; SELECT $b$;$b$"
+        self.assertEqual(self.parse(sql, chunk_size=2), ["SELECT $a$ $b$; $a$", "SELECT $b$;$b$"])
+
+    def test_statements_spanning_many_chunks_are_copied_a_few_times(self):
+        class CountingReader(StatementReader):
+            # Characters written to the buffer, a statement rebuilt per chunk grows with its size squared
+            copied = 0
+
+            @property
+            def buf(self):
+                return self._buf
+
+            @buf.setter
+            def buf(self, value):
+                self.copied += len(value)
+                self._buf = value
+
+        blob = 'ab' * 50000
+        sql = (f"INSERT INTO t VALUES(X'{blob}', $${blob}$$, {', '.join(['1'] * 20000)});\n"
+               f"/* {blob} */ SELECT 1;")
+        reader = CountingReader(io.BytesIO(sql.encode()), chunk_size=64)
+        self.assertEqual(list(reader), [f"INSERT INTO t VALUES(X'{blob}', $${blob}$$, {', '.join(['1'] * 20000)})",
+                                        'SELECT 1'])
+        self.assertLess(reader.copied, 4 * len(sql))
+
+    def test_unread_copy_rows_are_skipped(self):
+        sql = "COPY t FROM stdin;\n1\n2\n\\.\nSELECT 1;"
+        statements = list(iter_statements(io.BytesIO(sql.encode()), chunk_size=3))
+        self.assertIsInstance(statements[0], CopyStatement)
+        self.assertEqual(statements[1:], ['SELECT 1'])
+
+
+class FileIOTests(SimpleTestCase):
+    data = b'0123456789' * 10
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        self.source_path = os.path.join(self.tmp_dir, 'source')
+        self.target_path = os.path.join(self.tmp_dir, 'target')
+        with open(self.source_path, 'wb') as f:
+            f.write(self.data)
+
+    def copy_range(self, offset, count):
+        with open(self.source_path, 'rb') as source, open(self.target_path, 'wb') as target:
+            copied = file_io.copy_range(source.fileno(), target.fileno(), offset, count)
+        with open(self.target_path, 'rb') as f:
+            self.assertEqual(f.read(), self.data[offset:offset + count])
+        return copied
+
+    def unsupported(self, code):
+        return mock.Mock(side_effect=OSError(code, os.strerror(code)))
+
+    def test_copy_range(self):
+        self.assertEqual(self.copy_range(5, 20), 20)
+        # Fewer bytes than asked for when the source ends first
+        self.assertEqual(self.copy_range(90, 20), 10)
+
+    def test_unsupported_kernel_copies_fall_back(self):
+        copy_file_range = self.unsupported(errno.EXDEV)
+        sendfile = mock.Mock(side_effect=file_io._sendfile)
+        with mock.patch.object(file_io, '_copy_file_range', copy_file_range), \
+                mock.patch.object(file_io, '_sendfile', sendfile), \
+                mock.patch.object(os, 'copy_file_range', create=True):
+            self.assertEqual(self.copy_range(5, 50), 50)
+        self.assertEqual(copy_file_range.call_count, 1)
+        self.assertTrue(sendfile.called)
+
+        # Plain reads and writes go COPY_BUFFER_SIZE bytes at a time
+        with mock.patch.object(file_io, '_copy_file_range', self.unsupported(errno.EXDEV)), \
+                mock.patch.object(file_io, '_sendfile', self.unsupported(errno.ENOSYS)), \
+                mock.patch.object(file_io, 'COPY_BUFFER_SIZE', 7), \
+                mock.patch.object(os, 'copy_file_range', create=True):
+            self.assertEqual(self.copy_range(5, 50), 50)
+
+    def test_fallback_continues_after_a_partial_copy(self):
+        def copy_once(source_fd, target_fd, offset, count):
+            copy_once.side_effect = OSError(errno.EINVAL, 'Invalid argument')
+            return file_io._read_write(source_fd, target_fd, offset, 4)
+        copy_once = mock.Mock(side_effect=copy_once)
+        with mock.patch.object(file_io, '_copy_file_range', copy_once), \
+                mock.patch.object(os, 'copy_file_range', create=True):
+            self.assertEqual(self.copy_range(5, 50), 50)
+
+    def test_other_errors_are_raised(self):
+        with mock.patch.object(file_io, '_copy_file_range', self.unsupported(errno.ENOSPC)), \
+                mock.patch.object(os, 'copy_file_range', create=True), self.assertRaises(OSError):
+            self.copy_range(0, 10)
+
+    def test_copy_file(self):
+        self.assertEqual(file_io.copy_file(self.source_path, self.target_path), len(self.data))
+        with open(self.target_path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_copy_fileobj(self):
+        target = io.BytesIO()
+        file_io.copy_fileobj(io.BytesIO(self.data), target)
+        self.assertEqual(target.getvalue(), self.data)
+
+        # Both files are left at the end of what was copied, the target's buffered bytes go first
+        with open(self.source_path, 'rb') as source, open(self.target_path, 'wb') as target:
+            source.seek(90)
+            target.write(b'head')
+            file_io.copy_fileobj(source, target)
+            self.assertEqual((source.tell(), target.tell()), (100, 14))
+            target.write(b'tail')
+        with open(self.target_path, 'rb') as f:
+            self.assertEqual(f.read(), b'head' + self.data[90:] + b'tail')
+
+    def test_file_range(self):
+        file_range = file_io.FileRange(self.source_path, 10, 29)
+        self.addCleanup(file_range.close)
+        # Servers using sendfile() start at the position of the file descriptor
+        self.assertEqual(os.lseek(file_range.fileno(), 0, os.SEEK_CUR), 10)
+        self.assertEqual(file_range.read(5), self.data[10:15])
+        self.assertEqual(file_range.read(), self.data[15:30])
+        self.assertEqual(file_range.read(), b'')
+        self.assertEqual(file_range.seek(-5, os.SEEK_END), 15)
+        self.assertEqual(file_range.read(100), self.data[25:30])
+        self.assertEqual(file_range.seek(-3, os.SEEK_CUR), 17)
+        self.assertEqual(file_range.seek(50), 20)
+        self.assertEqual(file_range.file_obj.tell(), 30)
+
+    def test_open_mapped(self):
+        with file_io.open_mapped(self.source_path) as view:
+            self.assertEqual(hashlib.sha256(view[10:20]).hexdigest(), hashlib.sha256(self.data[10:20]).hexdigest())
+        open(self.target_path, 'wb').close()
+        with file_io.open_mapped(self.target_path) as view:
+            self.assertEqual(view.tobytes(), b'')
+
+
+class FakeClientError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3Client:
+    # In-memory stand-in for the boto3 S3 client, with the calls S3Storage makes
+    exceptions = SimpleNamespace(ClientError=FakeClientError)
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.uploaded_parts = []
+        self.lock = threading.Lock()
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise FakeClientError('404')
+        return {'ContentLength': len(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body if isinstance(Body, bytes) else Body.read()
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def create_multipart_upload(self, Bucket, Key):
+        with self.lock:
+            upload_id = str(len(self.uploads) + 1)
+            self.uploads[upload_id] = {'Key': Key, 'Initiated': now(), 'Parts': {}}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        etag = f'"{hashlib.md5(Body).hexdigest()}"'
+        with self.lock:
+            self.uploads[UploadId]['Parts'][PartNumber] = (Body, etag)
+            self.uploaded_parts.append(PartNumber)
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)['Parts']
+        for part in MultipartUpload['Parts']:
+            if parts[part['PartNumber']][1] != part['ETag']:
+                raise FakeClientError('InvalidPart')
+        self.objects[Key] = b''.join(parts[part['PartNumber']][0] for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        del self.uploads[UploadId]
+
+    def list_multipart_uploads(self, Bucket, Prefix):
+        return {'Uploads': [{'Key': upload['Key'], 'UploadId': upload_id, 'Initiated': upload['Initiated']}
+                            for upload_id, upload in self.uploads.items() if upload['Key'].startswith(Prefix)]}
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0):
+        # Two parts per page so callers have to follow the markers
+        numbers = sorted(number for number in self.uploads[UploadId]['Parts'] if number > PartNumberMarker)
+        parts = [{'PartNumber': number, 'Size': len(self.uploads[UploadId]['Parts'][number][0]),
+                  'ETag': self.uploads[UploadId]['Parts'][number][1]} for number in numbers[:2]]
+        if len(numbers) > 2:
+            return {'Parts': parts, 'IsTruncated': True, 'NextPartNumberMarker': numbers[1]}
+        return {'Parts': parts, 'IsTruncated': False}
+
+
+class S3StorageTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = FakeS3Client()
+        boto3 = mock.patch('backups.storage.boto3', SimpleNamespace(client=lambda *args, **kwargs: self.client))
+        boto3.start()
+        self.addCleanup(boto3.stop)
+        self.storage = S3Storage('bucket', prefix='offsite/', workers=3)
+        # S3 asks for parts of 5 MiB, the fake takes any size
+        self.storage.part_size = 10
+        self.data = os.urandom(95)
+
+    def test_streamed_multipart_upload(self):
+        path = os.path.join(self.media_root, 'backups', 'backup.sql')
+        output = MirroredFile(path, [self.storage])
+        for start in range(0, len(self.data), 7):
+            output.write(self.data[start:start + 7])
+        output.close()
+        output.complete()
+
+        self.assertEqual(self.client.objects['offsite/backups/backup.sql'], self.data)
+        self.assertEqual(sorted(self.client.uploaded_parts), list(range(1, 11)))
+        self.assertEqual(self.client.uploads, {})
+
+    def test_small_file_is_one_put(self):
+        upload = self.storage.open_upload('small')
+        upload.write(b'tiny')
+        upload.close()
+        upload.complete()
+
+        self.assertEqual(self.client.objects['offsite/small'], b'tiny')
+        self.assertEqual(self.client.uploaded_parts, [])
+
+    def test_failed_backup_aborts_its_upload(self):
+        path = os.path.join(self.media_root, 'backups', 'backup.sql')
+        output = MirroredFile(path, [self.storage])
+        output.write(self.data)
+        output.abort()
+
+        self.assertEqual(self.client.uploads, {})
+        self.assertEqual(self.client.objects, {})
+
+    def test_upload_file_resumes_unfinished_upload(self):
+        path = os.path.join(self.media_root, 'backups', 'backup.sql')
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        upload_id = self.client.create_multipart_upload(Bucket='bucket', Key='offsite/backup.sql')['UploadId']
+        for part_number in range(1, 6):
+            start = (part_number - 1) * 10
+            self.client.upload_part(Bucket='bucket', Key='offsite/backup.sql', UploadId=upload_id,
+                                    PartNumber=part_number, Body=self.data[start:start + 10])
+        # A part that doesn't match the file is sent again
+        self.client.upload_part(Bucket='bucket', Key='offsite/backup.sql', UploadId=upload_id, PartNumber=3,
+                                Body=b'corrupted!')
+        self.client.uploaded_parts.clear()
+
+        self.storage.upload_file(path, 'backup.sql')
+
+        self.assertEqual(self.client.objects['offsite/backup.sql'], self.data)
+        self.assertEqual(sorted(self.client.uploaded_parts), [3, 6, 7, 8, 9, 10])
+        self.assertEqual(self.client.uploads, {})
+
+    def test_missing_object(self):
+        self.assertFalse(self.storage.exists('missing'))
+        self.client.put_object(Bucket='bucket', Key='offsite/there', Body=b'data')
+        self.assertEqual(self.storage.size('there'), 4)
+        self.storage.delete('there')
+        self.assertFalse(self.storage.exists('there'))
+
+
+class DownloadBackupTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(1000)
+        with open(os.path.join(self.media_root, 'backups', 'backup.sql'), 'wb') as f:
+            f.write(self.data)
+        self.backup = Backup.objects.create(type='database', file='backups/backup.sql', status='done',
+                                            created_by=self.user)
+        self.url = reverse('backups:download', args=[self.backup.pk])
+        staff = User.objects.create(username='staff', is_staff=True)
+        staff.user_permissions.add(Permission.objects.get(codename='view_backup'))
+        self.client.force_login(staff)
+
+    def test_download(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['Content-Length'], '1000')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('attachment; filename="backup.sql"', response['Content-Disposition'])
+
+    def test_head_is_allowed(self):
+        response = self.client.head(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '1000')
+
+    def test_range(self):
+        for header, start, end in (('bytes=100-199', 100, 199), ('bytes=900-', 900, 999), ('bytes=-50', 950, 999),
+                                   ('bytes=990-2000', 990, 999)):
+            with self.subTest(header=header):
+                response = self.client.get(self.url, HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response['Content-Range'], f'bytes {start}-{end}/1000')
+                self.assertEqual(b''.join(response.streaming_content), self.data[start:end + 1])
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=1000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1000')
+
+    def test_compress_on_the_fly(self):
+        response = self.client.get(self.url, {'compress': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertIn('filename="backup.sql.gz"', response['Content-Disposition'])
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.data)
+        self.assertEqual(self.client.get(self.url, {'compress': 'rar'}).status_code, 400)
+
+    @mock.patch('backups.compression.zstandard', None)
+    def test_codec_that_is_not_installed(self):
+        response = self.client.get(self.url, {'compress': 'zstd'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.has_header('Content-Disposition'))
+
+    def test_compressed_backup_is_sent_as_stored(self):
+        with open(os.path.join(self.media_root, 'backups', 'backup.sql'), 'wb') as f:
+            f.write(gzip.compress(self.data))
+        response = self.client.get(self.url, {'compress': 'gzip'}, HTTP_RANGE='bytes=0-1')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'\x1f\x8b')
+
+    def test_staff_without_permission_is_forbidden(self):
+        self.client.force_login(User.objects.create(username='other', is_staff=True))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    def test_missing_file(self):
+        os.remove(os.path.join(self.media_root, 'backups', 'backup.sql'))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+class BackupUploadTests(MediaRootMixin, TestCase):
+    def test_upload_is_written_to_the_upload_dir(self):
+        handler = BackupUploadHandler()
+        handler.new_file('file', 'backup.sql', 'application/sql', 6)
+        handler.receive_data_chunk(b'backup', 0)
+        uploaded = handler.file_complete(6)
+        self.addCleanup(uploaded.close)
+        self.assertEqual(os.path.dirname(uploaded.temporary_file_path()), os.path.join(self.media_root, 'uploads'))
+        self.assertTrue(uploaded.temporary_file_path().endswith('.upload.sql'))
+        uploaded.seek(0)
+        self.assertEqual(uploaded.read(), b'backup')
+
+    @override_settings(BACKUP_JOB_RUNNER='command')
+    def test_restore_upload_through_the_admin(self):
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+        data = os.urandom(3 * 1024 * 1024)
+        response = self.client.post(reverse('admin:backups_restore_add'), {
+            'type': 'database', 'file': SimpleUploadedFile('backup.sql', data),
+        })
+        self.assertEqual(response.status_code, 302)
+        restore = Restore.objects.get()
+        self.assertEqual(restore.status, 'queued')
+        with restore.file.open('rb') as f:
+            self.assertEqual(f.read(), data)
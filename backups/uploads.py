@@ -0,0 +1,32 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, TemporaryFileUploadHandler
+
+
+def get_upload_dir():
+    path = getattr(settings, 'BACKUP_UPLOAD_DIR', os.path.join(settings.MEDIA_ROOT, 'backups', 'uploads'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class BackupUploadedFile(TemporaryUploadedFile):
+    # Lives next to the backups, so storing it is a rename instead of a copy from the system temp dir
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        file = tempfile.NamedTemporaryFile(suffix='.upload' + os.path.splitext(name)[1], dir=get_upload_dir())
+        UploadedFile.__init__(self, file, name, content_type, size, charset, content_type_extra)
+
+
+class BackupUploadHandler(TemporaryFileUploadHandler):
+    """
+    Write uploaded backups to disk chunk by chunk, however small they are,
+    so a multi GB upload never sits in worker memory.
+    """
+
+    chunk_size = 1024 * 1024
+
+    def new_file(self, *args, **kwargs):
+        FileUploadHandler.new_file(self, *args, **kwargs)
+        self.file = BackupUploadedFile(self.file_name, self.content_type, 0, self.charset, self.content_type_extra)
@@ -0,0 +1,9 @@
+from django.urls import path
+
+from backups import views
+
+app_name = 'backups'
+
+urlpatterns = [
+    path('<int:pk>/download/', views.download_backup, name='download'),
+]
@@ -0,0 +1,283 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zipfile import ZipFile
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.timezone import now
+
+from backups.compression import open_reader
+from backups.db_connectors import (MANIFEST_NAME, SQLITE_MAGIC, SqliteConnector, get_db_connector, is_parallel_backup,
+                                   read_backup_manifest)
+from backups.instrumentation import Stats
+from backups.media_manager import run_in_parallel
+from backups.media_store import MediaStore
+from backups.portable import decode_value, is_portable_backup, iter_lines
+from backups.sql_parser import CopyStatement
+from backups.storage import file_checksum
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def get_backup_engine(backup):
+    # Database backups record the engine in their manifest, older ones are assumed to match the live database
+    manifest = read_backup_manifest(backup.file.path)
+    if manifest is not None:
+        return manifest['engine']
+    return connections[DEFAULT_DB_ALIAS].vendor
+
+
+def verify_checksum(backup, stats):
+    if not os.path.exists(backup.file.path):
+        raise Exception(f'Backup file {backup.file.name} is missing')
+    with stats.stage('checksum', bytes=os.path.getsize(backup.file.path)):
+        checksum = file_checksum(backup.file.path)
+    if backup.checksum and checksum != backup.checksum:
+        raise Exception(f'Checksum mismatch for {backup.file.name}: recorded {backup.checksum}, found {checksum}')
+    return checksum
+
+
+def open_scratch_database(directory):
+    # Test restores never touch the live database, they load into an in-memory or temporary SQLite database
+    if getattr(settings, 'BACKUP_VERIFY_IN_MEMORY', False):
+        return sqlite3.connect(':memory:')
+    scratch = sqlite3.connect(os.path.join(directory, 'scratch.db'))
+    # Nothing needs to survive a crash of the scratch database
+    scratch.execute('PRAGMA journal_mode = OFF')
+    scratch.execute('PRAGMA synchronous = OFF')
+    return scratch
+
+
+def load_snapshot(scratch, path):
+    source = sqlite3.connect(Path(path).resolve().as_uri() + '?mode=ro', uri=True)
+    try:
+        # Pages are read straight from a memory map of the snapshot
+        source.execute(f"PRAGMA mmap_size = {getattr(settings, 'BACKUP_SQLITE_MMAP_SIZE', 1024 * 1024 * 1024)}")
+        source.backup(scratch)
+    finally:
+        source.close()
+
+
+def replay_statements(scratch, statements, stats):
+    executed = 0
+    for statement in statements:
+        try:
+            scratch.execute(statement)
+        except sqlite3.Error as err:
+            raise Exception(f'Statement {executed + 1} failed in the test restore: {err}')
+        executed += 1
+    scratch.commit()
+    stats.add('verify', statements=executed)
+
+
+def replay_sqlite_backup(connector, scratch, backup, stats):
+    with open(backup.file.path, 'rb') as f:
+        if is_parallel_backup(backup.file):
+            with tarfile.open(fileobj=f, mode='r:') as tar:
+                manifest = json.load(tar.extractfile(MANIFEST_NAME))
+                for table in manifest['tables']:
+                    replay_statements(scratch, connector.iter_statements(tar.extractfile(table['file'])), stats)
+        elif f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC:
+            load_snapshot(scratch, backup.file.path)
+        else:
+            f.seek(0)
+            replay_statements(scratch, connector.iter_statements(f), stats)
+
+
+def restore_sqlite_scratch(chain, stats):
+    """
+    Replay a SQLite backup and the backups it builds on into a scratch
+    database, then check its integrity and that the rows of every table hash
+    to the fingerprint the backup's manifest recorded for it.
+    """
+    connector = SqliteConnector(stats)
+    with tempfile.TemporaryDirectory(dir=connector.backup_root) as tmp_dir:
+        scratch = open_scratch_database(tmp_dir)
+        try:
+            for backup in chain:
+                try:
+                    replay_sqlite_backup(connector, scratch, backup, stats)
+                except Exception as e:
+                    # A chain fails on whichever of its files is broken, name it
+                    raise Exception(f'{backup.file.name}: {e}')
+
+            result = scratch.execute('PRAGMA integrity_check').fetchone()[0]
+            if result != 'ok':
+                raise Exception(f'Integrity check of the restored database failed: {result}')
+
+            fingerprints = (read_backup_manifest(chain[-1].file.path) or {}).get('fingerprints', {})
+            cursor = scratch.cursor()
+            tables = dict(connector.get_tables(cursor))
+            for table_name, fingerprint in fingerprints.items():
+                if table_name not in tables:
+                    raise Exception(f"Table '{table_name}' is missing from the restored database")
+                restored = connector._write_table(cursor, table_name, tables[table_name], None)
+                if restored != fingerprint:
+                    raise Exception(f"Rows of '{table_name}' don't match the backup manifest: "
+                                    f"expected {fingerprint}, restored {restored}")
+            cursor.close()
+            stats.add('verify', tables=len(tables))
+        finally:
+            scratch.close()
+
+
+def read_postgres_chain(chain, stats):
+    # pg_dump output can't be loaded into SQLite, it is decompressed and parsed through to the end instead
+    connector = get_db_connector(stats)
+    for backup in chain:
+        try:
+            read_postgres_backup(connector, backup, stats)
+        except Exception as e:
+            raise Exception(f'{backup.file.name}: {e}')
+
+
+def read_postgres_backup(connector, backup, stats):
+    with open(backup.file.path, 'rb') as f:
+        if is_parallel_backup(backup.file):
+            with tarfile.open(fileobj=f, mode='r:') as tar:
+                for member in tar:
+                    if member.isfile():
+                        member_file = tar.extractfile(member)
+                        while member_file.read(COPY_BUFFER_SIZE):
+                            pass
+                        stats.add('verify', files=1)
+            return
+        statements = 0
+        for statement in connector.iter_statements(f):
+            if isinstance(statement, CopyStatement):
+                statement.data.drain()
+            statements += 1
+        stats.add('verify', statements=statements)
+
+
+def read_portable_chain(chain, stats):
+    # Portable backups load into any engine, every row is decoded and the rows of each table counted instead
+    for backup in chain:
+        try:
+            read_portable_backup(backup, stats)
+        except Exception as e:
+            raise Exception(f'{backup.file.name}: {e}')
+
+
+def read_portable_backup(backup, stats):
+    with tarfile.open(backup.file.path, mode='r:') as tar:
+        manifest = json.load(tar.extractfile(MANIFEST_NAME))
+        for table in manifest['tables']:
+            types = [portable_type for _, portable_type in table['columns']]
+            rows = 0
+            for line in iter_lines(open_reader(tar.extractfile(table['file']))):
+                values = json.loads(line)
+                if len(values) != len(types):
+                    raise Exception(f"Row {rows + 1} of '{table['name']}' has {len(values)} values "
+                                    f"for {len(types)} columns")
+                for portable_type, value in zip(types, values):
+                    decode_value(portable_type, value)
+                rows += 1
+            if rows != table['rows']:
+                raise Exception(f"'{table['name']}' has {rows} rows, the manifest recorded {table['rows']}")
+            stats.add('verify', rows=rows)
+        stats.add('verify', tables=len(manifest['tables']))
+
+
+def verify_media_archive(path, stats):
+    # Reading a zip member to the end checks its CRC
+    with ZipFile(path) as archive:
+        def check(member):
+            with archive.open(member) as f:
+                while f.read(COPY_BUFFER_SIZE):
+                    pass
+            stats.add('verify', files=1, bytes=member.file_size)
+
+        run_in_parallel(check, [member for member in archive.infolist() if not member.is_dir()])
+
+
+def verify_media_store(path, stats):
+    # Every chunk the manifest refers to must exist and still hash to its name
+    store = MediaStore()
+    with open(path) as f:
+        manifest = json.load(f)
+    chunks = {digest for entry in manifest['files'] for digest in entry['chunks']}
+    bad = []
+
+    def check(digest):
+        chunk_path = store.object_path(digest)
+        if not chunk_path.exists():
+            bad.append(digest)
+            return
+        with open(chunk_path, 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            bad.append(digest)
+        stats.add('verify', bytes=len(data))
+
+    run_in_parallel(check, sorted(chunks))
+    stats.add('verify', files=len(manifest['files']), chunks=len(chunks))
+    if bad:
+        raise Exception(f'{len(bad)} of {len(chunks)} media chunks are missing or corrupt, e.g. {bad[0]}')
+
+
+def verify_backup(backup, chain=None, test_restore=True, stats=None):
+    """
+    Re-hash a backup file against its recorded checksum and, with
+    test_restore, check its contents can be restored: database backups are
+    replayed into a scratch SQLite database along with the backups they build
+    on (portable ones are decoded row by row), media backups have every file
+    or chunk read back. Returns the
+    checksum, raises an Exception describing the first problem found.
+    """
+    stats = stats or Stats()
+    checksum = verify_checksum(backup, stats)
+    if not test_restore:
+        return checksum
+
+    with stats.stage('verify'):
+        if backup.type == 'database':
+            chain = chain or backup.get_chain()
+            if is_portable_backup(backup.file):
+                read_portable_chain(chain, stats)
+            elif get_backup_engine(backup) == 'sqlite':
+                restore_sqlite_scratch(chain, stats)
+            else:
+                read_postgres_chain(chain, stats)
+        elif backup.file.name.endswith('.json'):
+            verify_media_store(backup.file.path, stats)
+        else:
+            verify_media_archive(backup.file.path, stats)
+    return checksum
+
+
+def verify_backups(backups, test_restore=True, workers=None):
+    """
+    Verify backups in parallel, BACKUP_VERIFY_WORKERS at a time, and record
+    the outcome on each of them. Backups made before checksums were recorded
+    get theirs from the first verification. Returns (backup, error, stats)
+    for every backup, error is None when it passed.
+    """
+    workers = workers or getattr(settings, 'BACKUP_VERIFY_WORKERS', None) or os.cpu_count() or 1
+    # Chains are loaded up front, worker threads don't query the database
+    chains = {backup.pk: backup.get_chain() if backup.type == 'database' else None for backup in backups}
+
+    def verify(backup):
+        stats = Stats()
+        try:
+            checksum = verify_backup(backup, chains[backup.pk], test_restore, stats)
+        except Exception as e:
+            return backup, None, str(e), stats
+        return backup, checksum, None, stats
+
+    results = []
+    with ThreadPoolExecutor(workers) as pool:
+        for backup, checksum, error, stats in pool.map(verify, backups):
+            if checksum and not backup.checksum:
+                backup.checksum = checksum
+            backup.verified_at = now()
+            backup.verify_error = error or ''
+            backup.save(update_fields=['checksum', 'verified_at', 'verify_error'])
+            results.append((backup, error, stats))
+    return results
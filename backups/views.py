@@ -1,3 +1,92 @@
-from django.shortcuts import render
+import os
+import re
 
-# Create your views here.
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_safe
+
+from backups.compression import CODEC_EXTENSIONS, check_codec, detect_codec, iter_compressed
+from backups.file_io import FileRange
+from backups.models import Backup
+
+RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def parse_range(header, size):
+    # (start, end) of a single 'bytes=' range, None for no usable range, False if unsatisfiable
+    match = RANGE_HEADER.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        # 'bytes=-500' is the last 500 bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def iter_compressed_file(path, codec):
+    # The file is closed when the response closes the generator
+    with open(path, 'rb') as f:
+        yield from iter_compressed(f, codec, chunk_size=STREAM_CHUNK_SIZE)
+
+
+@require_safe
+@staff_member_required
+def download_backup(request, pk):
+    """
+    Stream a backup file to staff users allowed to view backups. Supports
+    single byte Range requests so interrupted downloads can resume (HEAD
+    probes them first), and ?compress=gzip|zstd to compress backups stored
+    uncompressed on the fly.
+    """
+    # Backups hold the whole database, being staff isn't enough
+    if not request.user.has_perm('backups.view_backup'):
+        return HttpResponse('You are not allowed to download backups', status=403)
+    backup = get_object_or_404(Backup, pk=pk)
+    if not backup.file:
+        return HttpResponse('This backup has no file', status=404)
+    path = backup.file.path
+    if not os.path.exists(path):
+        return HttpResponse('The backup file is missing', status=404)
+    size = os.path.getsize(path)
+    filename = os.path.basename(path)
+
+    codec = request.GET.get('compress')
+    if codec:
+        with open(path, 'rb') as f:
+            stored_codec = detect_codec(f)
+        if codec not in CODEC_EXTENSIONS or codec == 'none':
+            return HttpResponse(f"Unknown compression '{codec}'", status=400)
+        if stored_codec == 'none':
+            # Fail before the response starts, not partway through the stream
+            try:
+                check_codec(codec)
+            except Exception as e:
+                return HttpResponse(str(e), status=400)
+            # The compressed size isn't known up front, so no Content-Length and no ranges
+            response = StreamingHttpResponse(iter_compressed_file(path, codec), content_type='application/octet-stream')
+            response['Content-Disposition'] = f'attachment; filename="{filename}{CODEC_EXTENSIONS[codec]}"'
+            return response
+
+    byte_range = parse_range(request.headers.get('Range', ''), size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+    # FileResponse lets servers with a wsgi.file_wrapper send the file with sendfile()
+    if byte_range is not None:
+        start, end = byte_range
+        response = FileResponse(FileRange(path, start, end), status=206, as_attachment=True, filename=filename,
+                                content_type='application/octet-stream')
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    else:
+        response = FileResponse(FileRange(path, 0, size - 1), as_attachment=True, filename=filename,
+                                content_type='application/octet-stream')
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -0,0 +1,317 @@
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
+
+from backups.compression import CODEC_EXTENSIONS, get_codec, open_reader, open_writer
+from backups.db_connectors import SqliteConnector
+from backups.file_io import copy_file
+from backups.storage import delete_mirrors, mirror_file
+
+# A WAL file is a 32 byte header followed by frames of a 24 byte header and one page
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+INDEX_NAME = 'index.json'
+BASE_NAME = 'base.db'
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def get_wal_archive_root():
+    return Path(getattr(settings, 'BACKUP_WAL_ROOT', Path(settings.BACKUP_ROOT) / 'wal'))
+
+
+def get_database_path():
+    database = settings.DATABASES[DEFAULT_DB_ALIAS]
+    if 'sqlite3' not in database['ENGINE']:
+        raise Exception('WAL archiving is only supported for SQLite databases.')
+    return str(database['NAME'])
+
+
+def load_index(generation_dir):
+    with open(Path(generation_dir) / INDEX_NAME) as f:
+        return json.load(f)
+
+
+def list_generations(root=None):
+    # (directory, index) of every archived generation, oldest first
+    root = Path(root or get_wal_archive_root())
+    if not root.exists():
+        return []
+    return [(path, load_index(path)) for path in sorted(root.iterdir()) if (path / INDEX_NAME).exists()]
+
+
+class WalArchiver:
+    """
+    Continuously copy the committed frames of a SQLite database's WAL into
+    segments under BACKUP_WAL_ROOT, for restores to a point in time.
+
+    Each generation starts with a base snapshot of the database followed by
+    segments of WAL frames in commit order, index.json records when each
+    segment was copied. The archiver keeps a read transaction open so SQLite
+    can't restart the WAL over frames it hasn't copied yet. Writers are only
+    held back while the last frames are copied before a checkpoint lets the
+    WAL start over.
+    """
+
+    def __init__(self, database_path=None, root=None):
+        self.database_path = database_path or get_database_path()
+        self.wal_path = f'{self.database_path}-wal'
+        self.root = Path(root or get_wal_archive_root())
+        self.codec = get_codec()
+        # WAL frames after which the archiver checkpoints, the WAL can't shrink before that
+        self.checkpoint_frames = getattr(settings, 'BACKUP_WAL_CHECKPOINT_FRAMES', 1000)
+        self.generation_seconds = getattr(settings, 'BACKUP_WAL_GENERATION_SECONDS', 24 * 60 * 60)
+        self.keep_generations = getattr(settings, 'BACKUP_WAL_KEEP_GENERATIONS', 7)
+        self.reader = self.probe = self.locker = None
+        self.generation_dir = None
+        self.index = None
+        # Checkpoint sequence and salts of the WAL being copied, and the frames of it copied so far
+        self.sequence = self.salt = None
+        self.frame = 0
+
+    def connect(self):
+        return sqlite3.connect(self.database_path, timeout=5, isolation_level=None)
+
+    def open(self):
+        self.probe = self.connect()
+        if self.probe.execute('PRAGMA journal_mode = WAL').fetchone()[0].lower() != 'wal':
+            raise Exception(f'Could not switch {self.database_path} to WAL mode')
+        self.reader = self.connect()
+        self.locker = self.connect()
+        self.start_generation()
+
+    def close(self):
+        for connection in (self.reader, self.probe, self.locker):
+            if connection is not None:
+                connection.close()
+        self.reader = self.probe = self.locker = None
+
+    def begin_read(self):
+        # The read starts with the first SELECT, it pins the WAL until it ends
+        self.reader.execute('BEGIN')
+        self.reader.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+
+    def end_read(self):
+        if self.reader.in_transaction:
+            self.reader.execute('COMMIT')
+
+    @contextmanager
+    def write_lock(self):
+        # Writers wait while this is held, keep it short
+        if self.locker.in_transaction:
+            yield
+            return
+        self.locker.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        finally:
+            self.locker.execute('ROLLBACK')
+
+    def committed_frames(self):
+        # A passive checkpoint never waits and reports the committed frames of the WAL
+        _, frames, _ = self.probe.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        return max(frames, 0)
+
+    def read_header(self):
+        # (page size, checkpoint sequence, salts) of the WAL, None while it is empty
+        if not os.path.exists(self.wal_path):
+            return None
+        with open(self.wal_path, 'rb') as f:
+            header = f.read(WAL_HEADER_SIZE)
+        if len(header) < WAL_HEADER_SIZE:
+            return None
+        _, _, page_size, sequence = struct.unpack('>IIII', header[:16])
+        return page_size, sequence, header[16:24]
+
+    def start_generation(self):
+        created_at = now()
+        # Names sort in the order generations were started
+        generation_dir = self.root / created_at.strftime('%Y%m%dT%H%M%S%f')
+        generation_dir.mkdir(parents=True)
+
+        # With writers held back the new read sees every committed frame, those are in the snapshot
+        with self.write_lock():
+            self.end_read()
+            self.begin_read()
+            self.frame = self.committed_frames()
+            header = self.read_header()
+            self.sequence, self.salt = header[1:] if header else (None, None)
+        # The snapshot is copied from the read transaction while writers carry on
+        base_path = generation_dir / BASE_NAME
+        target = sqlite3.connect(base_path)
+        try:
+            self.reader.backup(target)
+        finally:
+            target.close()
+        mirror_file(base_path)
+
+        self.generation_dir = generation_dir
+        self.index = {'created_at': created_at.isoformat(), 'database': self.database_path, 'segments': []}
+        self.save_index()
+        print(f'Started WAL archive generation {generation_dir.name}')
+        self.prune_generations()
+
+    def save_index(self):
+        index_path = self.generation_dir / INDEX_NAME
+        tmp_path = self.generation_dir / f'{INDEX_NAME}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, index_path)
+        mirror_file(index_path)
+
+    def prune_generations(self):
+        generations = list_generations(self.root)
+        for path, _ in generations[:max(len(generations) - self.keep_generations, 0)]:
+            if path == self.generation_dir:
+                continue
+            for file_path in path.iterdir():
+                delete_mirrors(file_path)
+            shutil.rmtree(path)
+            print(f'Deleted WAL archive generation {path.name}')
+
+    def copy_frames(self):
+        """
+        Write the frames committed since the last call to a new segment.
+        Returns the number of frames copied.
+        """
+        frames = self.committed_frames()
+        copied_at = now()
+        header = self.read_header()
+        if header is None or not frames:
+            return 0
+        page_size, sequence, salt = header
+        if salt != self.salt:
+            # A checkpoint emptied the WAL and writers started over at its beginning. Only
+            # the restart right after our own checkpoint is expected, anything else left a gap.
+            if self.sequence is not None and sequence != self.sequence + 1:
+                print('WAL was restarted behind the archiver, starting a new generation')
+                self.start_generation()
+                return 0
+            self.sequence, self.salt, self.frame = sequence, salt, 0
+        if frames <= self.frame:
+            return 0
+
+        frame_size = WAL_FRAME_HEADER_SIZE + page_size
+        count = frames - self.frame
+        segment_name = f"{len(self.index['segments']) + 1:06d}.wal{CODEC_EXTENSIONS[self.codec]}"
+        segment_path = self.generation_dir / segment_name
+        with open(self.wal_path, 'rb') as source, open_writer(segment_path, self.codec) as f:
+            source.seek(WAL_HEADER_SIZE + self.frame * frame_size)
+            remaining = count * frame_size
+            while remaining:
+                data = source.read(min(remaining, COPY_BUFFER_SIZE))
+                if not data:
+                    raise Exception(f'{self.wal_path} ended before its committed frames')
+                f.write(data)
+                remaining -= len(data)
+        mirror_file(segment_path)
+
+        # Commits in a segment happened before it was copied, restores up to a time only take older segments
+        self.index['segments'].append({'file': segment_name, 'frames': count, 'page_size': page_size,
+                                       'time': copied_at.isoformat()})
+        self.save_index()
+        self.frame = frames
+        return count
+
+    def checkpoint(self):
+        # First move the read to the end of the WAL so a passive checkpoint can
+        # copy what was archived into the database without holding up writers
+        with self.write_lock():
+            self.copy_frames()
+            self.end_read()
+            self.begin_read()
+        self.probe.execute('PRAGMA wal_checkpoint(PASSIVE)')
+        # Only frames written since are left, once they are archived and
+        # checkpointed too the next writer starts the WAL over
+        with self.write_lock():
+            self.copy_frames()
+            self.end_read()
+            self.probe.execute('PRAGMA wal_checkpoint(PASSIVE)')
+            self.begin_read()
+
+    def archive(self):
+        # One round of the archiver, returns the frames copied
+        created_at = parse_datetime(self.index['created_at'])
+        if now() - created_at >= timedelta(seconds=self.generation_seconds):
+            self.start_generation()
+        copied = self.copy_frames()
+        if self.frame >= self.checkpoint_frames:
+            try:
+                self.checkpoint()
+            except sqlite3.OperationalError as e:
+                # A long write transaction held the lock, the WAL is checkpointed next round
+                print(f'Skipped WAL checkpoint: {e}')
+        return copied
+
+
+def apply_segment(db_file, segment_path, page_size):
+    # Frames hold whole pages, a commit frame also records the database size in pages after it
+    frame_size = WAL_FRAME_HEADER_SIZE + page_size
+    with open(segment_path, 'rb') as raw, open_reader(raw) as f:
+        while True:
+            frame = f.read(frame_size)
+            if not frame:
+                return
+            if len(frame) != frame_size:
+                raise Exception(f'{segment_path} ends in a partial frame')
+            page_number, commit_size = struct.unpack('>II', frame[:8])
+            db_file.seek((page_number - 1) * page_size)
+            db_file.write(frame[WAL_FRAME_HEADER_SIZE:])
+            if commit_size:
+                db_file.truncate(commit_size * page_size)
+
+
+def recover_to_time(target, output_path, root=None):
+    """
+    Rebuild the database as it was at target into output_path from the WAL
+    archive: the base snapshot of the last generation started before target
+    plus its segments copied up to target. Segments are copied every
+    BACKUP_WAL_INTERVAL seconds, so commits of up to that long before target
+    may be missing. Returns the time of the recovered state.
+    """
+    generations = [(path, index) for path, index in list_generations(root)
+                   if parse_datetime(index['created_at']) <= target]
+    if not generations:
+        raise Exception(f'The WAL archive has no generation started before {target}')
+    generation_dir, index = generations[-1]
+
+    copy_file(generation_dir / BASE_NAME, output_path)
+    recovered_at = parse_datetime(index['created_at'])
+    with open(output_path, 'r+b') as db_file:
+        for segment in index['segments']:
+            segment_time = parse_datetime(segment['time'])
+            if segment_time > target:
+                break
+            apply_segment(db_file, generation_dir / segment['file'], segment['page_size'])
+            recovered_at = segment_time
+    # The base is copied from a database in WAL mode, the recovered file is opened on its own
+    connection = sqlite3.connect(output_path)
+    try:
+        connection.execute('PRAGMA journal_mode = DELETE')
+        result = connection.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        connection.close()
+    if result != 'ok':
+        raise Exception(f'The recovered database failed its integrity check: {result}')
+    return recovered_at
+
+
+def restore_to_time(connector, target):
+    # Recover the database at target from the WAL archive and restore it like a snapshot backup
+    if not isinstance(connector, SqliteConnector):
+        raise Exception('Point in time restores are only supported for SQLite databases.')
+    with tempfile.TemporaryDirectory(dir=connector.backup_root) as tmp_dir:
+        recovered_path = os.path.join(tmp_dir, 'recovered.db')
+        recovered_at = recover_to_time(target, recovered_path)
+        connector.restore_snapshot_file(recovered_path)
+    return recovered_at
@@ -0,0 +1,236 @@
+"""
+Benchmark backup and restore throughput on synthetic data.
+
+Every case generates a SQLite database or a media tree in a temporary
+directory, then times SqliteConnector.create_backup/restore_backup or
+compress_media_file/restore_media_file end to end. Cases run in their own
+subprocess so the reported peak RSS belongs to that case only. Results are
+written as one JSON object per line.
+
+    python benchmarks/backup_benchmark.py --cases small,blobs --output bench.jsonl
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# name: (tables, rows per table, blob bytes per row)
+DATABASE_CASES = {
+    'small': (4, 10_000, 0),
+    'medium': (8, 100_000, 0),
+    'large': (8, 1_000_000, 0),
+    'blobs': (2, 5_000, 4096),
+}
+# name: (files, bytes per file, share of incompressible files)
+MEDIA_CASES = {
+    'media-small': (200, 16 * 1024, 0.5),
+    'media-large': (2_000, 256 * 1024, 0.5),
+}
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def setup_django(work_dir, options):
+    sys.path.insert(0, str(BASE_DIR))
+    import django
+    from django.conf import settings
+
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': str(work_dir / 'bench.sqlite3')}},
+        INSTALLED_APPS=[],
+        MEDIA_ROOT=str(work_dir / 'media'),
+        BACKUP_ROOT=work_dir / 'media' / 'backups',
+        USE_TZ=True,
+        BACKUP_COMPRESSION=options.compression,
+        BACKUP_PARALLEL_WORKERS=options.parallel_workers,
+        BACKUP_RESTORE_BATCH_SIZE=options.batch_size,
+        BACKUP_SQLITE_MODE=options.sqlite_mode,
+        MEDIA_BACKUP_ENGINE=options.media_engine,
+        MEDIA_ARCHIVE_WORKERS=options.archive_workers or None,
+    )
+    django.setup()
+    os.makedirs(settings.BACKUP_ROOT, exist_ok=True)
+
+
+def generate_database(path, tables, rows, blob_size):
+    rng = random.Random(0)
+    connection = sqlite3.connect(path)
+    for table in range(tables):
+        connection.execute(
+            f'CREATE TABLE "bench_{table}" ("id" integer NOT NULL PRIMARY KEY AUTOINCREMENT, '
+            f'"name" varchar(100) NOT NULL, "value" real NOT NULL, "payload" blob NULL)'
+        )
+        connection.executemany(
+            f'INSERT INTO "bench_{table}" ("name", "value", "payload") VALUES (?, ?, ?)',
+            (
+                (f"row {row} it's", rng.random(), rng.randbytes(blob_size) if blob_size else None)
+                for row in range(rows)
+            ),
+        )
+    connection.commit()
+    connection.close()
+
+
+def generate_media(path, files, file_size, incompressible):
+    rng = random.Random(0)
+    for index in range(files):
+        directory = path / f'dir_{index % 20}'
+        directory.mkdir(parents=True, exist_ok=True)
+        if rng.random() < incompressible:
+            data = rng.randbytes(file_size)
+        else:
+            data = (f'line {index} of some compressible media text\n' * (file_size // 40 + 1)).encode()[:file_size]
+        (directory / f'file_{index}.bin').write_bytes(data)
+
+
+def result(case, operation, seconds, stats=None, **counters):
+    row = {'case': case, 'operation': operation, 'seconds': round(seconds, 6), **counters}
+    for name in ('rows', 'bytes', 'files'):
+        if counters.get(name) and seconds:
+            row[f'{name}_per_second'] = round(counters[name] / seconds)
+    row['peak_rss_kb'] = peak_rss_kb()
+    if stats is not None:
+        row['stats'] = stats.as_dict()
+    return row
+
+
+def run_database_case(case, work_dir):
+    from django.db import connection
+    from django.core.files import File
+
+    from backups.db_connectors import SqliteConnector
+    from backups.instrumentation import Stats
+
+    tables, rows, blob_size = DATABASE_CASES[case]
+    generate_database(work_dir / 'bench.sqlite3', tables, rows, blob_size)
+    results = [result(case, 'baseline', 0)]
+
+    stats = Stats()
+    connector = SqliteConnector(stats)
+    started = time.perf_counter()
+    backup_name = connector.create_backup()
+    seconds = time.perf_counter() - started
+    backup_path = work_dir / 'media' / backup_name
+    results.append(result(case, 'sqlite_backup', seconds, stats, rows=tables * rows,
+                          bytes=os.path.getsize(backup_path)))
+
+    # Restore into empty tables so every row goes through the restore path
+    with connection.cursor() as cursor:
+        for table in range(tables):
+            cursor.execute(f'DROP TABLE "bench_{table}"')
+
+    stats = Stats()
+    connector = SqliteConnector(stats)
+    started = time.perf_counter()
+    with open(backup_path, 'rb') as f:
+        connector.restore_backup(File(f, name=backup_name))
+    seconds = time.perf_counter() - started
+    results.append(result(case, 'sqlite_restore', seconds, stats, rows=tables * rows,
+                          bytes=os.path.getsize(backup_path)))
+    return results
+
+
+def run_media_case(case, work_dir):
+    from django.conf import settings
+
+    from backups.instrumentation import Stats
+    from django.core.files import File
+
+    from backups.media_manager import backup_media, directory_size, restore_media
+
+    files, file_size, incompressible = MEDIA_CASES[case]
+    media_dir = Path(settings.MEDIA_ROOT) / 'backups'
+    generate_media(media_dir, files, file_size, incompressible)
+    _, total_size = directory_size(media_dir)
+    results = [result(case, 'baseline', 0)]
+
+    stats = Stats()
+    started = time.perf_counter()
+    backup_name = backup_media(stats)
+    results.append(result(case, 'media_backup', time.perf_counter() - started, stats, files=files, bytes=total_size))
+
+    # A second run over unchanged files shows what incremental backups cost
+    stats = Stats()
+    started = time.perf_counter()
+    backup_media(stats)
+    results.append(result(case, 'media_backup_unchanged', time.perf_counter() - started, stats, files=files,
+                          bytes=total_size))
+
+    stats = Stats()
+    started = time.perf_counter()
+    with open(Path(settings.MEDIA_ROOT) / backup_name, 'rb') as f:
+        restore_media(File(f, name=backup_name), stats)
+    results.append(result(case, 'media_restore', time.perf_counter() - started, stats, files=files, bytes=total_size))
+    return results
+
+
+def run_case(case, options):
+    with tempfile.TemporaryDirectory(prefix='backup-bench-') as tmp_dir:
+        work_dir = Path(tmp_dir)
+        setup_django(work_dir, options)
+        if case in DATABASE_CASES:
+            return run_database_case(case, work_dir)
+        return run_media_case(case, work_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', default='small,blobs,media-small',
+                        help=f'Comma separated cases out of {", ".join([*DATABASE_CASES, *MEDIA_CASES])}')
+    parser.add_argument('--output', help='File to write JSON lines to, stdout by default')
+    parser.add_argument('--compression', default='gzip')
+    parser.add_argument('--parallel-workers', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--sqlite-mode', default='sql', choices=['sql', 'snapshot'])
+    parser.add_argument('--media-engine', default='store', choices=['store', 'zip'])
+    parser.add_argument('--archive-workers', type=int, default=0,
+                        help='Threads for zip media archives, 0 uses every CPU')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.run_case:
+        # Child process: run a single case and print its results
+        for row in run_case(options.run_case, options):
+            print(json.dumps(row))
+        return
+
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        for case in options.cases.split(','):
+            if case not in DATABASE_CASES and case not in MEDIA_CASES:
+                parser.error(f'unknown case {case!r}')
+            process = subprocess.run(
+                [sys.executable, __file__, '--run-case', case, '--compression', options.compression,
+                 '--parallel-workers', str(options.parallel_workers), '--batch-size', str(options.batch_size),
+                 '--sqlite-mode', options.sqlite_mode, '--media-engine', options.media_engine,
+                 '--archive-workers', str(options.archive_workers)],
+                stdout=subprocess.PIPE, text=True,
+            )
+            if process.returncode != 0:
+                output.write(json.dumps({'case': case, 'error': f'exited with {process.returncode}'}) + '\n')
+                continue
+            # Keep the result lines, the connectors also print progress
+            for line in process.stdout.splitlines():
+                if line.startswith('{'):
+                    output.write(line + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -150,3 +150,100 @@ MEDIA_ROOT= os.path.join(BASE_DIR, 'media')
 # Backup path
 BACKUP_ROOT = MEDIA_ROOT2 / 'backups'
 # BACKUP_ROOT = os.path.join(MEDIA_ROOT,'backups')
+
+# Statements per transaction when restoring a database backup. 0 runs the whole restore in one transaction,
+# where a failing statement rolls back the restore instead of being skipped
+BACKUP_RESTORE_BATCH_SIZE = 1000
+
+# Bytes read at a time while parsing a database backup on restore
+BACKUP_RESTORE_CHUNK_SIZE = 64 * 1024
+
+# 'direct' replays database backups into the live tables. 'staged' loads them into a separate SQLite file or
+# PostgreSQL shadow tables first and swaps them in with one short transaction. SQLite copies the staging file
+# into shadow tables BACKUP_SQLITE_CHUNK_ROWS rows per transaction, its swap still builds the tables' indexes
+BACKUP_RESTORE_MODE = 'direct'
+# Seconds the swap of a staged restore waits for queries holding the live tables before it fails
+BACKUP_RESTORE_LOCK_TIMEOUT = 30
+
+# Format of PostgreSQL table data in backups: 'copy' (COPY blocks) or 'inserts' (one INSERT per row).
+# A COPY block that fails on restore, e.g. on a duplicate key, is rolled back and replayed row by row
+BACKUP_POSTGRES_FORMAT = 'copy'
+
+# Workers used to dump and restore tables in parallel (0 or 1 writes a single .sql file)
+BACKUP_PARALLEL_WORKERS = 0
+
+# Codec database dumps are compressed with while they are written: 'gzip', 'zstd' (needs zstandard) or 'none'
+BACKUP_COMPRESSION = 'gzip'
+# Compression level, None uses the codec's default
+BACKUP_COMPRESSION_LEVEL = None
+
+# How queued backups and restores run: 'thread' in a pool inside the web process,
+# 'command' by the backup_worker management command
+BACKUP_JOB_RUNNER = 'thread'
+# Size of the in-process job pool
+BACKUP_JOB_WORKERS = 1
+# Seconds between saves of a running job's stats, so the admin shows its progress. 0 saves them only when it ends
+BACKUP_PROGRESS_INTERVAL = 10
+
+# How SQLite databases are backed up: 'sql' (INSERT statements) or 'snapshot'
+# (binary .db copy via the online backup API)
+BACKUP_SQLITE_MODE = 'sql'
+# Pages copied per step of a snapshot, writers can proceed between steps
+BACKUP_SQLITE_PAGES_PER_STEP = 1024
+
+# Media backups: 'store' (incremental, deduplicated chunk store) or 'zip' (full archive every time)
+MEDIA_BACKUP_ENGINE = 'store'
+# Threads compressing files of 'zip' media archives (None uses every CPU) and their deflate level
+MEDIA_ARCHIVE_WORKERS = None
+MEDIA_ARCHIVE_LEVEL = 6
+# Threads extracting files during media restores (None uses every CPU)
+MEDIA_RESTORE_WORKERS = None
+
+# Backups to keep per type, newest backup of each of the last N periods
+# (hourly, daily, weekly, monthly, yearly), e.g. {'hourly': 24, 'daily': 7, 'weekly': 4}. None keeps everything
+BACKUP_RETENTION = None
+# Oldest backups are deleted until the rest fit in this many bytes, None for no limit
+BACKUP_MAX_BYTES = None
+# Apply the retention policy after every finished backup, prune_backups does it on demand
+BACKUP_PRUNE_AFTER_BACKUP = True
+
+# Seconds after which the lock of a job whose worker died is taken over. Running jobs extend their lock
+# every BACKUP_PROGRESS_INTERVAL seconds (every quarter of this when that is 0), however long they take
+BACKUP_LOCK_TIMEOUT = 24 * 60 * 60
+
+# Uploaded backups are written here chunk by chunk, keep it on the same filesystem as MEDIA_ROOT
+# so saving an upload only renames it
+BACKUP_UPLOAD_DIR = MEDIA_ROOT2 / 'backups' / 'uploads'
+
+# Offsite copies of every backup, streamed while it is written. The local copy under MEDIA_ROOT is kept.
+# e.g. [{'BACKEND': 'backups.storage.S3Storage',
+#        'OPTIONS': {'bucket': 'backups', 'endpoint_url': 'http://localhost:9000', 'access_key': '...',
+#                    'secret_key': '...', 'part_size': 64 * 1024 * 1024, 'workers': 4}},
+#       {'BACKEND': 'backups.storage.LocalStorage', 'OPTIONS': {'location': '/mnt/offsite'}}]
+BACKUP_STORAGES = []
+
+# Rows read per query while dumping a SQLite table, ordered by rowid or primary key. The read is released
+# between chunks so writers and WAL checkpoints aren't blocked by a long dump. 0 reads a table in one query
+BACKUP_SQLITE_CHUNK_ROWS = 10000
+
+# Bytes of SQLite snapshot files read through a memory map by restores and verification, 0 turns it off
+BACKUP_SQLITE_MMAP_SIZE = 1024 * 1024 * 1024
+
+# Database backups: 'native' (the engine's own SQL, dumps or snapshots) or 'portable' (typed JSON rows per
+# table that restore into SQLite or PostgreSQL whichever engine wrote them, tables must be migrated first)
+BACKUP_DATABASE_FORMAT = 'native'
+
+# Backups verify_backups checks at the same time (None uses every CPU)
+BACKUP_VERIFY_WORKERS = None
+# Test restores load into an in-memory SQLite database instead of a temporary file, faster but needs RAM for the data
+BACKUP_VERIFY_IN_MEMORY = False
+
+# Point in time recovery for SQLite: archive_wal copies the WAL here every BACKUP_WAL_INTERVAL seconds,
+# so a restore to a time misses at most that many seconds of commits. The database is switched to WAL mode.
+BACKUP_WAL_ROOT = BACKUP_ROOT / 'wal'
+BACKUP_WAL_INTERVAL = 10
+# The archiver checkpoints the WAL once it holds this many frames, writers wait only while its last frames are copied
+BACKUP_WAL_CHECKPOINT_FRAMES = 1000
+# Each generation starts with a fresh base snapshot, restores replay at most a generation of WAL
+BACKUP_WAL_GENERATION_SECONDS = 24 * 60 * 60
+BACKUP_WAL_KEEP_GENERATIONS = 7
@@ -17,10 +17,11 @@ Including another URLconf
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import path
+from django.urls import include, path
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('backups/', include('backups.urls')),
 ]
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL,